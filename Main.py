@@ -6,164 +6,4061 @@
 
 import os
 import sys
-import cv2
+import time
+import argparse
+import platform
+import tempfile
+import hashlib
+import importlib
+import statistics
+import multiprocessing
 import sqlite3
 import shutil
 import csv
-import numpy as np
-import face_recognition
+import json
+import queue
+import threading
+import http.client
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+from urllib.parse import urlsplit, parse_qs, urlencode
 
-from PyQt5.QtCore import QTimer, Qt
+# ---------- Startup ----------
+class StartupTimer:
+    # Wall-clock phases of a cold start, reported by --startup-timing.
+    # Phases can overlap (the warm-up thread runs while the window is up),
+    # so each keeps its own start offset next to its duration.
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start):
+        now = time.perf_counter()
+        with self._lock:
+            self.phases.append((name, (start - self.t0) * 1000, (now - start) * 1000))
+
+    def phase(self, name):
+        return _StartupPhase(self, name)
+
+    def report(self):
+        lines = [f'{"phase":<28} {"start ms":>9} {"took ms":>9}']
+        for name, start, took in sorted(self.phases, key=lambda p: p[1] + p[2]):
+            lines.append(f'{name:<28} {start:>9.1f} {took:>9.1f}')
+        return '\n'.join(lines)
+
+class _StartupPhase:
+    __slots__ = ('timer', 'name', 't0')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, self.t0)
+
+STARTUP = StartupTimer()
+
+class LazyModule:
+    # Stands in for a heavy module under its global name. The first
+    # attribute access imports it and rebinds the global to the real module,
+    # so later lookups cost nothing. cv2, numpy and face_recognition (which
+    # loads the dlib models on import) take seconds on a cold start; with
+    # these the login window is up before any of them load.
+    _lock = threading.Lock()
+
+    def __init__(self, name, alias=None):
+        self._name = name
+        self._alias = alias or name
+        self._mod = None
+
+    def __getattr__(self, attr):
+        return getattr(self._mod or self._load(), attr)
+
+    def _load(self):
+        with LazyModule._lock:
+            if self._mod is None:
+                with STARTUP.phase(f'import {self._name}'):
+                    mod = importlib.import_module(self._name)
+                globals()[self._alias] = mod
+                self._mod = mod
+        return self._mod
+
+    @staticmethod
+    def resolve(mod):
+        return mod._load() if isinstance(mod, LazyModule) else mod
+
+cv2 = LazyModule('cv2')
+np = LazyModule('numpy', 'np')
+face_recognition = LazyModule('face_recognition')
+
+_t = time.perf_counter()
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal, QAbstractTableModel, QModelIndex
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QStackedWidget, QTabWidget, QLabel, QPushButton, QLineEdit,
     QMessageBox, QFileDialog, QComboBox, QListWidget, QInputDialog,
-    QDialog, QFormLayout, QTableWidget, QTableWidgetItem, QGroupBox,
-    QHeaderView, QListWidgetItem
+    QDialog, QFormLayout, QTableView, QAbstractItemView, QStyledItemDelegate,
+    QGroupBox, QHeaderView, QListWidgetItem, QCheckBox, QGridLayout
 )
+STARTUP.add('import PyQt5', _t)
+
+DB_NAME = "face_recognition.db"
+ANN_INDEX_FILE = "ann_index.npz"
+CASCADE_FILE = "haarcascade_frontalface_default.xml"
+
+GLOBAL_STYLESHEET = """
+QMainWindow, QWidget {
+    background-color: #2E3440;
+    color: #ECEFF4;
+    font-family: Helvetica;
+    font-size: 13px;
+}
+QTabWidget::pane { border: none; }
+QTabBar::tab {
+    background: #3B4252;
+    color: #ECEFF4;
+    padding: 10px 20px;
+    font-size: 14px;
+    min-width: 120px;
+    min-height: 40px;
+}
+QTabBar::tab:selected {
+    background: #88C0D0;
+    color: #2E3440;
+}
+QPushButton {
+    background-color: #88C0D0;
+    color: #2E3440;
+    border: none;
+    border-radius: 5px;
+    padding: 8px 16px;
+    font-weight: bold;
+    font-size: 14px;
+    min-height: 36px;
+}
+QPushButton:hover {
+    background-color: #81A1C1;
+}
+QLineEdit, QComboBox, QListWidget, QTableView {
+    background-color: #3B4252;
+    border: 1px solid #4C566A;
+    border-radius: 4px;
+    selection-background-color: #88C0D0;
+    selection-color: #2E3440;
+    font-size: 13px;
+}
+QHeaderView::section {
+    background-color: #3B4252;
+    padding: 6px;
+    border: 1px solid #4C566A;
+    font-size: 13px;
+}
+"""
+
+# ---------- Database ----------
+def _add_time_slot_batch(conn):
+    # databases created before time slots were per batch
+    cols = [c[1] for c in conn.execute("PRAGMA table_info(time_slots)")]
+    if 'batch_id' not in cols:
+        conn.execute("ALTER TABLE time_slots ADD COLUMN batch_id INTEGER")
+
+MIGRATIONS = [
+    (1, ["""CREATE TABLE IF NOT EXISTS admin (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+         )""",
+         """CREATE TABLE IF NOT EXISTS batch (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            batch_name TEXT,
+            UNIQUE(admin_id,batch_name),
+            FOREIGN KEY(admin_id) REFERENCES admin(id)
+         )""",
+         """CREATE TABLE IF NOT EXISTS time_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            batch_id INTEGER,
+            start_time TEXT,
+            end_time TEXT,
+            FOREIGN KEY(admin_id) REFERENCES admin(id)
+         )"""]),
+    (2, [_add_time_slot_batch]),
+    # batch lookups by admin are already covered by UNIQUE(admin_id,batch_name)
+    (3, ["""CREATE INDEX IF NOT EXISTS idx_time_slots_admin_batch
+            ON time_slots(admin_id, batch_id, start_time, end_time)"""]),
+    (4, ["""CREATE TABLE IF NOT EXISTS attendance_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            batch_id INTEGER,
+            slot_id INTEGER,
+            slot_label TEXT,
+            session_date TEXT,
+            started_at TEXT,
+            ended_at TEXT
+         )""",
+         """CREATE TABLE IF NOT EXISTS attendance_events (
+            session_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            name TEXT,
+            status TEXT NOT NULL,
+            first_seen TEXT,
+            best_distance REAL,
+            manual INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(session_id, user_id),
+            FOREIGN KEY(session_id) REFERENCES attendance_sessions(id)
+         ) WITHOUT ROWID""",
+         """CREATE INDEX IF NOT EXISTS idx_sessions_admin_date
+            ON attendance_sessions(admin_id, session_date, batch_id)"""]),
+    # detection areas as fractions of the frame; NULL batch / '' source = any
+    (5, ["""CREATE TABLE IF NOT EXISTS detection_rois (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            batch_id INTEGER,
+            source TEXT NOT NULL DEFAULT '',
+            x REAL NOT NULL,
+            y REAL NOT NULL,
+            w REAL NOT NULL,
+            h REAL NOT NULL,
+            upsample INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY(admin_id) REFERENCES admin(id)
+         )""",
+         """CREATE INDEX IF NOT EXISTS idx_rois_admin_batch
+            ON detection_rois(admin_id, batch_id, source)"""]),
+    # where an offline run saw the student (file, or video@position)
+    # earlier offline runs wrote that label into first_seen
+    (6, ["ALTER TABLE attendance_events ADD COLUMN source TEXT",
+         """UPDATE attendance_events SET source=first_seen, first_seen=NULL
+            WHERE first_seen IS NOT NULL AND first_seen NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'"""]),
+]
+
+class Database:
+    # One long-lived connection shared by the whole app. WAL lets several
+    # kiosks read while one writes, synchronous=NORMAL is durable enough in
+    # WAL mode, and sqlite3 keeps the prepared statements for the fixed SQL
+    # strings below in its statement cache. The lock serialises use from
+    # worker threads.
+    def __init__(self, path=DB_NAME):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10,
+                                    cached_statements=256)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def migrate(self):
+        with self.lock:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                                    version INTEGER PRIMARY KEY,
+                                    applied_at TEXT NOT NULL
+                                 )""")
+            latest = "SELECT COALESCE(MAX(version), 0) FROM schema_migrations"
+            if self.conn.execute(latest).fetchone()[0] >= MIGRATIONS[-1][0]:
+                return
+            for version, steps in MIGRATIONS:
+                with self.conn:
+                    # explicit BEGIN so DDL is part of the migration's transaction;
+                    # IMMEDIATE takes the write lock before the version is read, so
+                    # two processes opening a new database never both apply a step
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    if version <= self.conn.execute(latest).fetchone()[0]:
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            step(self.conn)
+                        else:
+                            self.conn.execute(step)
+                    self.conn.execute(
+                        "INSERT INTO schema_migrations(version, applied_at) VALUES(?,?)",
+                        (version, datetime.now().isoformat(timespec='seconds')))
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).lastrowid
+
+    # admins
+    def find_admin(self, username, password):
+        rows = self.query(
+            "SELECT id,name,username FROM admin WHERE username=? AND password=?",
+            (username, password))
+        return rows[0] if rows else None
+
+    def admin_id(self, username):
+        rows = self.query("SELECT id FROM admin WHERE username=?", (username,))
+        return rows[0][0] if rows else None
+
+    def add_admin(self, name, username, password):
+        return self.execute(
+            "INSERT INTO admin(name,username,password) VALUES(?,?,?)",
+            (name, username, password))
+
+    # batches
+    def batches(self, admin_id):
+        return self.query("SELECT id,batch_name FROM batch WHERE admin_id=?", (admin_id,))
+
+    def batch_id(self, admin_id, name):
+        rows = self.query("SELECT id FROM batch WHERE admin_id=? AND batch_name=?", (admin_id, name))
+        return rows[0][0] if rows else None
+
+    def add_batch(self, admin_id, name):
+        return self.execute("INSERT INTO batch(admin_id,batch_name) VALUES(?,?)", (admin_id, name))
+
+    def delete_batch(self, batch_id):
+        self.execute("DELETE FROM batch WHERE id=?", (batch_id,))
+
+    # time slots
+    def time_slots(self, admin_id, batch_id):
+        return self.query(
+            "SELECT id, start_time || ' - ' || end_time FROM time_slots "
+            "WHERE admin_id=? AND batch_id=?",
+            (admin_id, batch_id))
+
+    def add_time_slot(self, admin_id, batch_id, start, end):
+        return self.execute(
+            "INSERT INTO time_slots(admin_id,batch_id,start_time,end_time) VALUES(?,?,?,?)",
+            (admin_id, batch_id, start, end))
+
+    def delete_time_slot(self, slot_id):
+        self.execute("DELETE FROM time_slots WHERE id=?", (slot_id,))
+
+    # detection areas
+    def rois(self, admin_id, batch_id, source='', inherited=True):
+        # inherited also returns the areas saved for any batch / any source;
+        # without it only the ones saved for exactly this batch and source
+        if not inherited:
+            return self.query(
+                "SELECT x, y, w, h, upsample FROM detection_rois "
+                "WHERE admin_id=? AND batch_id IS ? AND source=? ORDER BY id",
+                (admin_id, batch_id, source))
+        return self.query(
+            "SELECT x, y, w, h, upsample FROM detection_rois "
+            "WHERE admin_id=? AND (batch_id=? OR batch_id IS NULL) AND source IN (?, '') "
+            "ORDER BY id",
+            (admin_id, batch_id, source))
+
+    def set_rois(self, admin_id, batch_id, source, rois):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM detection_rois WHERE admin_id=? AND batch_id IS ? AND source=?",
+                (admin_id, batch_id, source))
+            self.conn.executemany(
+                "INSERT INTO detection_rois(admin_id,batch_id,source,x,y,w,h,upsample) "
+                "VALUES(?,?,?,?,?,?,?,?)",
+                [(admin_id, batch_id, source, *r) for r in rois])
+
+    # attendance history
+    def start_session(self, admin_id, batch_id, slot_id, slot_label, roster):
+        now = datetime.now()
+        with self.lock, self.conn:
+            sid = self.conn.execute(
+                "INSERT INTO attendance_sessions(admin_id,batch_id,slot_id,slot_label,"
+                "session_date,started_at) VALUES(?,?,?,?,?,?)",
+                (admin_id, batch_id, slot_id, slot_label, now.strftime('%Y-%m-%d'),
+                 now.isoformat(timespec='seconds'))).lastrowid
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO attendance_events(session_id,user_id,name,status) "
+                "VALUES(?,?,?,'Absent')",
+                ((sid, uid, name) for uid, name in roster))
+        return sid
+
+    def end_session(self, session_id):
+        self.execute("UPDATE attendance_sessions SET ended_at=? WHERE id=?",
+                     (datetime.now().isoformat(timespec='seconds'), session_id))
+
+    def record_events(self, events):
+        # events: (session_id, user_id, name, status, first_seen, best_distance,
+        # manual, source); first_seen is an ISO timestamp, source the offline label
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO attendance_events(session_id,user_id,name,status,first_seen,"
+                "best_distance,manual,source) VALUES(?,?,?,?,?,?,?,?) "
+                "ON CONFLICT(session_id,user_id) DO UPDATE SET "
+                "status=excluded.status, "
+                "first_seen=COALESCE(attendance_events.first_seen, excluded.first_seen), "
+                "source=COALESCE(attendance_events.source, excluded.source), "
+                "best_distance=MIN(COALESCE(attendance_events.best_distance, excluded.best_distance), "
+                "COALESCE(excluded.best_distance, attendance_events.best_distance)), "
+                "manual=MAX(attendance_events.manual, excluded.manual)",
+                events)
+
+    def stream(self, sql, params=(), size=5000):
+        # Reports read through their own connection so a long export never
+        # holds the app's connection; with WAL it does not block writers.
+        conn = sqlite3.connect(self.path)
+        try:
+            cur = conn.execute(sql, params)
+            yield [d[0] for d in cur.description]
+            while True:
+                rows = cur.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+class AttendanceRecorder:
+    # Keeps per-student session state in memory and writes only the rows
+    # that changed, in one transaction at most every `flush_every` seconds.
+    def __init__(self, db, session_id, roster, flush_every=2.0):
+        self.db = db
+        self.session_id = session_id
+        self.flush_every = flush_every
+        self.state = {uid: {'name': name, 'status': 'Absent', 'first_seen': None,
+                            'best': None, 'manual': 0} for uid, name in roster}
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+
+    def add(self, uid, name):
+        self.state[uid] = {'name': name, 'status': 'Absent', 'first_seen': None,
+                           'best': None, 'manual': 0}
+        self._dirty.add(uid)
+        self._maybe_flush()
+
+    def seen(self, uid, distance):
+        st = self.state.get(uid)
+        if st is None: return
+        if st['first_seen'] is None:
+            st['first_seen'] = datetime.now().isoformat(timespec='seconds')
+            if not st['manual']:
+                st['status'] = 'Present'
+            self._dirty.add(uid)
+        if distance is not None and (st['best'] is None or distance < st['best'] - 1e-3):
+            st['best'] = distance
+            self._dirty.add(uid)
+        self._maybe_flush()
+
+    def set_status(self, uid, status, manual=False):
+        st = self.state.get(uid)
+        if st is None or (st['status'] == status and not manual): return
+        st['status'] = status
+        st['manual'] = max(st['manual'], int(manual))
+        self._dirty.add(uid)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._dirty: return
+        rows = [(self.session_id, uid, st['name'], st['status'], st['first_seen'],
+                 st['best'], st['manual'], None)
+                for uid, st in ((u, self.state[u]) for u in self._dirty if u in self.state)]
+        self._dirty.clear()
+        self.db.record_events(rows)
+
+    def close(self):
+        self.flush()
+        self.db.end_session(self.session_id)
+
+# ---------- Reports ----------
+def _report_filter(admin_id, date_from, date_to, batch_ids):
+    where = ["s.admin_id=?"]
+    params = [admin_id]
+    if date_from:
+        where.append("s.session_date>=?"); params.append(date_from)
+    if date_to:
+        where.append("s.session_date<=?"); params.append(date_to)
+    if batch_ids:
+        where.append(f"s.batch_id IN ({','.join('?' * len(batch_ids))})")
+        params.extend(batch_ids)
+    return ' AND '.join(where), params
+
+def attendance_report_query(admin_id, date_from=None, date_to=None, batch_ids=None, summary=False):
+    where, params = _report_filter(admin_id, date_from, date_to, batch_ids)
+    if summary:
+        # per-student percentages are aggregated by SQLite, not in Python
+        sql = (
+            "SELECT b.batch_name AS batch, e.user_id, MAX(e.name) AS name, "
+            "COUNT(*) AS sessions, SUM(e.status='Present') AS present, "
+            "ROUND(100.0 * SUM(e.status='Present') / COUNT(*), 1) AS percent "
+            "FROM attendance_events e JOIN attendance_sessions s ON s.id=e.session_id "
+            "LEFT JOIN batch b ON b.id=s.batch_id "
+            f"WHERE {where} GROUP BY s.batch_id, e.user_id ORDER BY b.batch_name, e.user_id"
+        )
+    else:
+        sql = (
+            "SELECT s.session_date AS date, b.batch_name AS batch, s.slot_label AS time_slot, "
+            "e.user_id, e.name, e.status, e.first_seen, e.best_distance, e.manual, e.source "
+            "FROM attendance_events e JOIN attendance_sessions s ON s.id=e.session_id "
+            "LEFT JOIN batch b ON b.id=s.batch_id "
+            f"WHERE {where} ORDER BY s.session_date, s.started_at, b.batch_name, e.user_id"
+        )
+    return sql, params
+
+def _report_time(value):
+    # first_seen as a timestamp; anything that is not ISO (or NULL) becomes null
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def export_attendance_report(db, path, admin_id, date_from=None, date_to=None,
+                             batch_ids=None, summary=False):
+    # Streams the query result chunk by chunk; .parquet paths need pyarrow.
+    sql, params = attendance_report_query(admin_id, date_from, date_to, batch_ids, summary)
+    chunks = db.stream(sql, params)
+    header = next(chunks)
+    count = 0
+    if path.lower().endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # declared up front: a chunk whose column is all NULL would otherwise
+        # infer type null and later chunks would not fit the file
+        types = {'user_id': pa.int64(), 'first_seen': pa.timestamp('s'), 'best_distance': pa.float64(),
+                 'manual': pa.int64(), 'sessions': pa.int64(), 'present': pa.int64(),
+                 'percent': pa.float64()}
+        schema = pa.schema([(h, types.get(h, pa.string())) for h in header])
+        seen = header.index('first_seen') if 'first_seen' in header else None
+        with pq.ParquetWriter(path, schema) as writer:
+            for rows in chunks:
+                if seen is not None:
+                    rows = [r[:seen] + (_report_time(r[seen]),) + r[seen + 1:]
+                            for r in rows]
+                writer.write_table(pa.Table.from_pylist([dict(zip(header, r)) for r in rows], schema=schema))
+                count += len(rows)
+        return count
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+def get_admin_folder(username):
+    # only a path: folders are created by the first write into them
+    return os.path.join('data', f'admin_{username}')
+
+def get_batch_folder(admin_folder, batch_id, batch_name):
+    return os.path.join(admin_folder, f'batch_{batch_id}_{batch_name}')
+
+def batch_folders(admin_folder):
+    if not os.path.isdir(admin_folder):
+        return []
+    return [os.path.join(admin_folder, entry) for entry in sorted(os.listdir(admin_folder))
+            if entry.startswith('batch_') and os.path.isdir(os.path.join(admin_folder, entry))]
+
+def load_legacy_faces(batch_folder):
+    known = {}
+    user_dir = os.path.join(batch_folder, 'users')
+    if not os.path.isdir(user_dir):
+        return known
+    for uid in os.listdir(user_dir):
+        try:
+            u = int(uid)
+        except:
+            continue
+        info_file = os.path.join(user_dir, uid, 'info.txt')
+        enc_file = os.path.join(user_dir, uid, 'encoding.npy')
+        if os.path.exists(info_file) and os.path.exists(enc_file):
+            name = open(info_file).read().strip()
+            encoding = np.load(enc_file)
+            known[u] = {'name': name, 'encoding': encoding}
+    return known
+
+def load_packed_faces(batch_folder):
+    # the per-batch packed gallery (gallery.json + gallery.<gen>.npy) that
+    # came before the identity store; None if the batch never had one
+    path = os.path.join(batch_folder, 'gallery.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        m = json.load(f)
+    known = {}
+    if not m['entries']:
+        return known
+    enc = np.load(os.path.join(batch_folder, m['file']), mmap_mode='r')
+    for uid, (name, rows) in m['entries'].items():
+        t = np.array(enc[rows])
+        known[int(uid)] = {'name': name, 'encoding': t[0]} if len(rows) == 1 else \
+            {'name': name, 'encoding': t.mean(axis=0), 'templates': t}
+    del enc
+    return known
+
+def load_known_faces(batch_folder):
+    # read-only: a batch not migrated yet is read from its old files
+    store = GalleryStore(batch_folder)
+    if store.exists():
+        return store.load()
+    old = load_packed_faces(batch_folder)
+    return old if old is not None else load_legacy_faces(batch_folder)
+
+def is_legacy_batch(batch_folder):
+    # still has its own gallery, not yet moved into the identity store
+    return not os.path.exists(os.path.join(batch_folder, GalleryStore.MANIFEST)) and (
+        os.path.exists(os.path.join(batch_folder, 'gallery.json'))
+        or os.path.isdir(os.path.join(batch_folder, 'users')))
+
+def require_migrated(admin_folder):
+    # readers of the whole identity store do not migrate behind the user's back
+    legacy = [f for f in batch_folders(admin_folder) if is_legacy_batch(f)]
+    if legacy:
+        raise ValueError(f'{len(legacy)} batch(es) of {admin_folder} still have their own gallery; '
+                         'log in once or run migrate-identities first')
+
+# ---------- Gallery store ----------
+def write_json_atomic(path, data):
+    # a temp name of its own, so two writers never share one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _file_stamp(path):
+    # every commit swaps a new file in, so the inode tells commits apart
+    # even within the mtime resolution
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+class StoreLock:
+    # Serialises writes to an admin's stores: the app's GUI and cache
+    # threads, the recognition server and CLI commands may all write the
+    # same identity store and member lists. A thread lock within the
+    # process, an exclusive lock on <admin>/.lock between processes.
+    # Reentrant; the file is locked by the outermost holder only.
+    _locks = {}
+    _guard = threading.Lock()
+
+    def __init__(self, admin_folder):
+        self.path = os.path.join(admin_folder, '.lock')
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    @classmethod
+    def of(cls, admin_folder):
+        key = os.path.abspath(admin_folder)
+        with cls._guard:
+            lock = cls._locks.get(key)
+            if lock is None:
+                lock = cls._locks[key] = cls(admin_folder)
+            return lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                f = open(self.path, 'a+b')
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                    else:
+                        f.seek(0)
+                        while True:
+                            try:
+                                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                                break
+                            except OSError:
+                                pass  # LK_LOCK gives up after 10 s
+                except BaseException:
+                    f.close()
+                    raise
+            except BaseException:
+                self._lock.release()
+                raise
+            self._file = f
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            f, self._file = self._file, None
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            f.close()
+        self._lock.release()
+
+def identity_key(name, encoding):
+    # content address of a student record: its name and exact encoding rows
+    h = hashlib.blake2b(digest_size=10)
+    h.update(name.encode('utf-8') + b'\0')
+    h.update(np.ascontiguousarray(np.atleast_2d(encoding), dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+class IdentityStore:
+    # Every student record of an admin, stored once however many batches it
+    # belongs to: one packed (capacity x 128) encodings file plus a compact
+    # JSON manifest of {key: [name, [rows]]}, key being identity_key() of
+    # the record. New rows are written into spare capacity and removal only
+    # drops the manifest entry (tombstone). The manifest is swapped in
+    # atomically and is the only thing that says which rows are live, so a
+    # crash can at worst leave unused rows behind. Compaction writes a new
+    # generation file. Batches point at records by key (GalleryStore);
+    # release() drops the records no batch points at any more.
+    FOLDER = 'identities'
+    MANIFEST = 'identities.json'
+
+    def __init__(self, admin_folder):
+        self.admin_folder = admin_folder
+        self.folder = os.path.join(admin_folder, self.FOLDER)
+        self.manifest_path = os.path.join(self.folder, self.MANIFEST)
+        self.lock = StoreLock.of(admin_folder)
+        self._manifest = None
+        self._stamp = None
+
+    @property
+    def manifest(self):
+        # every batch has its own store object, so re-read after their commits
+        stamp = _file_stamp(self.manifest_path)
+        if self._manifest is None or stamp != self._stamp:
+            if stamp is None:
+                self._manifest = {'version': 1, 'generation': 0, 'file': None,
+                                  'count': 0, 'entries': {}}
+            else:
+                with open(self.manifest_path) as f:
+                    self._manifest = json.load(f)
+            self._stamp = stamp
+        return self._manifest
+
+    def __contains__(self, key):
+        return key in self.manifest['entries']
+
+    def __len__(self):
+        return len(self.manifest['entries'])
+
+    def name_of(self, key):
+        return self.manifest['entries'][key][0]
+
+    def _open(self, mode='r'):
+        name = self.manifest['file']
+        if not name:
+            return None
+        return np.load(os.path.join(self.folder, name), mmap_mode=mode)
+
+    def gather(self, keys):
+        # rows of the given records, in order, with a row count per record;
+        # a single gather copies them out so the mapping is released right
+        # away (Windows will not replace a mapped file)
+        if not keys:
+            return np.zeros((0, 128)), []
+        # a compaction cannot swap the file out from under the read
+        with self.lock:
+            entries = self.manifest['entries']
+            rows = [entries[k][1] for k in keys]
+            enc = self._open()
+            packed = np.array(enc[[r for rs in rows for r in rs]])
+            del enc
+        return packed, [len(rs) for rs in rows]
+
+    def add_many(self, items):
+        # (key, name, encodings) items, encodings a 128-vector or a (k x 128)
+        # template set; records already stored are skipped. One manifest commit.
+        items = list(items)
+        with self.lock:
+            m = self._fresh()
+            entries = dict(m['entries'])
+            new = {}
+            for key, name, enc in items:
+                if key not in entries:
+                    new[key] = (key, name, np.atleast_2d(enc))
+            items = list(new.values())
+            if not items:
+                return
+            enc = self._open('r+')
+            end = m['count'] + sum(len(e) for _, _, e in items)
+            if enc is None or end > len(enc) or self._dead(entries, m['count']) > max(64, len(entries)):
+                del enc
+                self._commit(self._rewrite(entries, items))
+                return
+            r = m['count']
+            for key, name, encs in items:
+                enc[r:r + len(encs)] = encs
+                entries[key] = [name, list(range(r, r + len(encs)))]
+                r += len(encs)
+            enc.flush()
+            del enc
+            self._commit(dict(m, count=end, entries=entries))
+
+    def remove_many(self, keys):
+        with self.lock:
+            m = self._fresh()
+            entries = dict(m['entries'])
+            if not [entries.pop(k) for k in keys if k in entries]:
+                return
+            if self._dead(entries, m['count']) > max(64, len(entries)):
+                self._commit(self._rewrite(entries, []))
+            else:
+                self._commit(dict(m, entries=entries))
+
+    def release(self, keys):
+        # only the given records are candidates, so a record another writer
+        # has just added but not yet linked to its batch is never collected
+        with self.lock:
+            keys = set(keys) - batch_references(self.admin_folder)
+            if keys:
+                self.remove_many(keys)
+
+    def _fresh(self):
+        # writes start from the manifest on disk, never a cached one
+        self._manifest = None
+        return self.manifest
+
+    @staticmethod
+    def _dead(entries, count):
+        return count - sum(len(e[1]) for e in entries.values())
+
+    def _rewrite(self, entries, items):
+        m = self.manifest
+        old = self._open()
+        n = sum(len(e[1]) for e in entries.values()) + sum(len(e) for _, _, e in items)
+        gen = m['generation'] + 1
+        name = f'identities.{gen}.npy'
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = os.path.join(self.folder, name + '.tmp')
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64, shape=(max(16, 2 * n), 128))
+        new_entries, r = {}, 0
+        for key, (nm, rows) in entries.items():
+            out[r:r + len(rows)] = old[rows]
+            new_entries[key] = [nm, list(range(r, r + len(rows)))]
+            r += len(rows)
+        for key, nm, encs in items:
+            out[r:r + len(encs)] = encs
+            new_entries[key] = [nm, list(range(r, r + len(encs)))]
+            r += len(encs)
+        out.flush()
+        del out, old
+        os.replace(tmp, os.path.join(self.folder, name))
+        return {'version': 1, 'generation': gen, 'file': name, 'count': r, 'entries': new_entries}
+
+    def _commit(self, manifest):
+        old_file = self.manifest['file']
+        os.makedirs(self.folder, exist_ok=True)
+        write_json_atomic(self.manifest_path, manifest)
+        self._manifest = manifest
+        self._stamp = _file_stamp(self.manifest_path)
+        if old_file and old_file != manifest['file']:
+            try:
+                os.remove(os.path.join(self.folder, old_file))
+            except OSError:
+                pass
+
+def batch_members(batch_folder):
+    # {uid: identity key} of a batch, {} for one without a member list
+    try:
+        with open(os.path.join(batch_folder, GalleryStore.MANIFEST)) as f:
+            return json.load(f)['members']
+    except FileNotFoundError:
+        return {}
+
+def batch_references(admin_folder):
+    return {key for folder in batch_folders(admin_folder) for key in batch_members(folder).values()}
+
+def relink_identities(admin_folder, replaced, skip=None):
+    # re-enrolment: every batch holding an old record gets the new one
+    with StoreLock.of(admin_folder):
+        for folder in batch_folders(admin_folder):
+            if skip and os.path.samefile(folder, skip):
+                continue
+            members = batch_members(folder)
+            if any(key in replaced for key in members.values()):
+                GalleryStore(folder)._commit({uid: replaced.get(key, key) for uid, key in members.items()})
+
+def find_student(admin_folder, uid):
+    # [(batch folder, identity key)] of the batches a student id is enrolled in
+    return [(folder, members[str(uid)]) for folder in batch_folders(admin_folder)
+            for members in [batch_members(folder)] if str(uid) in members]
+
+class GalleryStore:
+    # A batch's students as a member list {uid: identity key} into the
+    # admin's IdentityStore, where the encodings live once per unique
+    # record; so a student in five batches costs five small JSON entries,
+    # not five copies of their encodings. The list is swapped in atomically.
+    # Replacing a student's record (re-enrolment) repoints every batch that
+    # held the old record, and records no batch refers to any more are
+    # released from the identity store.
+    MANIFEST = 'members.json'
+
+    def __init__(self, batch_folder):
+        self.folder = batch_folder
+        self.manifest_path = os.path.join(batch_folder, self.MANIFEST)
+        self.identities = IdentityStore(os.path.dirname(os.path.normpath(batch_folder)))
+        self.lock = self.identities.lock
+        self._members = None
+        self._stamp = None
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    @property
+    def members(self):
+        stamp = _file_stamp(self.manifest_path)
+        if self._members is None or stamp != self._stamp:
+            self._members = batch_members(self.folder)
+            self._stamp = stamp
+        return self._members
+
+    def __contains__(self, uid):
+        return str(uid) in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def key_of(self, uid):
+        return self.members.get(str(uid))
+
+    def rows(self):
+        # (uids, rows per uid, names, packed rows) of the batch, one gather
+        if not self.members:
+            return [], [], [], np.zeros((0, 128))
+        with self.lock:
+            members = self.members
+            keys = list(members.values())
+            packed, counts = self.identities.gather(keys)
+            names = [self.identities.name_of(k) for k in keys]
+        return [int(u) for u in members], counts, names, packed
+
+    def record(self, uid):
+        key = self.members[str(uid)]
+        t, _ = self.identities.gather([key])
+        if len(t) == 1:
+            return {'name': self.identities.name_of(key), 'encoding': t[0]}
+        return {'name': self.identities.name_of(key), 'encoding': t.mean(axis=0), 'templates': t}
+
+    def load(self):
+        uids, counts, names, packed = self.rows()
+        known, r = {}, 0
+        for uid, n, name in zip(uids, counts, names):
+            if n == 1:
+                known[uid] = {'name': name, 'encoding': packed[r]}
+            else:
+                t = packed[r:r + n]
+                known[uid] = {'name': name, 'encoding': t.mean(axis=0), 'templates': t}
+            r += n
+        return known
+
+    def add(self, uid, name, encoding):
+        self.add_many([(uid, name, encoding)])
+
+    def add_many(self, items):
+        # encoding may be a single 128-vector or a (k x 128) template set.
+        # A uid already in the batch is re-enrolled in every batch that holds
+        # the same record; ids are per batch, so a batch that has this uid
+        # for another record is left alone.
+        items = [(identity_key(name, enc), uid, name, enc) for uid, name, enc in items]
+        with self.lock:
+            self.identities.add_many((key, name, enc) for key, _, name, enc in items)
+            members = dict(self._fresh())
+            replaced = {}
+            for key, uid, _, _ in items:
+                old = members.get(str(uid))
+                if old is not None and old != key:
+                    replaced[old] = key
+                members[str(uid)] = key
+            self._commit(members)
+            if replaced:
+                relink_identities(self.identities.admin_folder, replaced, skip=self.folder)
+                self.identities.release(replaced)
+
+    def link(self, uid, key):
+        # enrol a student with a record already stored for another batch
+        with self.lock:
+            self._commit(dict(self._fresh(), **{str(uid): key}))
+
+    def remove(self, uid):
+        with self.lock:
+            members = dict(self._fresh())
+            key = members.pop(str(uid), None)
+            if key is None:
+                return
+            self._commit(members)
+            self.identities.release([key])
+
+    def destroy(self):
+        # the batch folder goes; shared records only once no batch refers to them
+        with self.lock:
+            keys = set(self._fresh().values())
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self._members = None
+            self.identities.release(keys)
+
+    def migrate(self):
+        # One-time move of the batch into the identity store, from the
+        # per-batch packed gallery or, older still, users/<uid>/ folders.
+        # Records identical to ones another batch already moved are stored
+        # once. The old files are deleted only after the new view reads back
+        # the same. Returns (students, bytes of the old files).
+        with self.lock:
+            if not os.path.isdir(self.folder):
+                return 0, 0
+            if self.exists():
+                return len(self), 0  # another writer got here first
+            return self._migrate()
+
+    def _migrate(self):
+        old = load_packed_faces(self.folder)
+        if old is None:
+            old = load_legacy_faces(self.folder)
+        self.add_many((uid, d['name'], d.get('templates', d['encoding'])) for uid, d in sorted(old.items()))
+        new = self.load()
+        if new.keys() != old.keys() or any(
+                new[u]['name'] != d['name'] or not np.array_equal(new[u]['encoding'], d['encoding'])
+                for u, d in old.items()):
+            return len(old), 0
+        paths = [os.path.join(self.folder, f) for f in os.listdir(self.folder)
+                 if f.startswith('gallery.') and (f.endswith('.json') or f.endswith('.npy'))]
+        nbytes = sum(os.path.getsize(p) for p in paths)
+        for p in paths:
+            os.remove(p)
+        users = os.path.join(self.folder, 'users')
+        for root, _, files in os.walk(users):
+            nbytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        shutil.rmtree(users, ignore_errors=True)
+        return len(old), nbytes
+
+    def _fresh(self):
+        self._members = None
+        return self.members
+
+    def _commit(self, members):
+        with self.lock:
+            os.makedirs(self.folder, exist_ok=True)
+            write_json_atomic(self.manifest_path, {'version': 2, 'members': members})
+            self._members = members
+            self._stamp = _file_stamp(self.manifest_path)
+
+def migrate_identities(admin_folder):
+    # moves every batch of an admin that still has its own gallery into the
+    # identity store; the report compares storage before and after
+    report = {'batches': 0, 'migrated': 0, 'memberships': 0, 'identities': 0,
+              'bytes_before': 0, 'bytes_after': 0}
+    for folder in batch_folders(admin_folder):
+        store = GalleryStore(folder)
+        report['batches'] += 1
+        if not store.exists():
+            _, nbytes = store.migrate()
+            report['migrated'] += store.exists()
+            report['bytes_before'] += nbytes
+        report['memberships'] += len(store)
+        report['bytes_after'] += os.path.getsize(store.manifest_path) if store.exists() else 0
+    identities = IdentityStore(admin_folder)
+    report['identities'] = len(identities)
+    if os.path.isdir(identities.folder):
+        report['bytes_after'] += sum(os.path.getsize(os.path.join(identities.folder, f))
+                                     for f in os.listdir(identities.folder))
+    return report
+
+class GalleryCache(QObject):
+    # LRU of loaded batch galleries, keyed by batch folder and checked against
+    # the folder's and manifest's stamps (every store write swaps a new
+    # manifest file in, which changes both). A gallery is kept only as its
+    # GalleryMatcher, in the configured dtype: names and ids live in the
+    # matcher's records, no per-student float64 encodings are held.
+    # Galleries beyond the memory budget are evicted least recently used
+    # first. Loads requested with request() or prewarm() run on one
+    # background thread and are announced with `loaded`, or `failed` with
+    # the error; requests jump ahead of prewarming.
+    loaded = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, budget_mb=256, dtype='float64', tolerance=0.5, parent=None):
+        super().__init__(parent)
+        self.budget = int(budget_mb * 2**20)
+        self.dtype = dtype
+        self.tolerance = tolerance
+        self._entries = {}  # folder -> (stamp, matcher, nbytes), oldest first
+        self._lock = threading.Lock()
+        self._jobs = queue.PriorityQueue()
+        self._seq = 0
+        self._thread = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'prewarmed': 0}
+
+    @staticmethod
+    def stamp(folder):
+        # with the inode, a same-size rewrite within the mtime resolution still shows
+        return _file_stamp(folder), _file_stamp(os.path.join(folder, GalleryStore.MANIFEST))
+
+    @staticmethod
+    def _size(matcher):
+        return matcher.nbytes + sum(200 + len(rec.name) for rec in matcher.records.values())
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(e[2] for e in self._entries.values())
+
+    def get(self, folder):
+        # the cached gallery if it is still current, else None; never loads
+        with self._lock:
+            entry = self._entries.get(folder)
+            if entry is None or entry[0] != self.stamp(folder):
+                return None
+            self._entries[folder] = self._entries.pop(folder)  # most recent
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, folder, matcher, stamp=None, evict=True):
+        # also used after the app's own writes, so the next get is a hit;
+        # with evict=False (prewarming) it only fills spare budget
+        nbytes = self._size(matcher)
+        with self._lock:
+            self._entries.pop(folder, None)
+            total = sum(e[2] for e in self._entries.values()) + nbytes
+            if not evict and total > self.budget:
+                return
+            self._entries[folder] = (stamp or self.stamp(folder), matcher, nbytes)
+            while total > self.budget and len(self._entries) > 1:
+                old = next(iter(self._entries))
+                total -= self._entries.pop(old)[2]
+                self.stats['evictions'] += 1
+
+    def invalidate(self, folder):
+        with self._lock:
+            self._entries.pop(folder, None)
+
+    def load(self, folder, evict=True):
+        matcher = self.get(folder)
+        if matcher is None:
+            with self._lock:
+                self.stats['misses'] += 1
+            # stamped before reading, so a write during the load is not missed
+            stamp = self.stamp(folder)
+            matcher = GalleryMatcher.from_folder(folder, self.tolerance, self.dtype)
+            self.put(folder, matcher, stamp, evict)
+        return matcher
+
+    def request(self, folder):
+        self._submit(0, folder)
+
+    def prewarm(self, folders):
+        for folder in folders:
+            self._submit(1, folder)
+
+    def _submit(self, priority, folder):
+        with self._lock:
+            self._seq += 1
+            self._jobs.put((priority, self._seq, folder))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    priority, _, folder = self._jobs.get(timeout=5)
+                except queue.Empty:
+                    with self._lock:
+                        if self._jobs.empty():
+                            self._thread = None
+                            return
+                    continue
+                if priority and self.get(folder) is not None:
+                    continue
+                try:
+                    matcher = self.load(folder, evict=not priority)
+                except Exception as e:
+                    # one bad gallery must not stop the thread or leave the window waiting
+                    self.failed.emit(folder, f'{type(e).__name__}: {e}')
+                    continue
+                if priority:
+                    self.stats['prewarmed'] += 1
+                else:
+                    self.loaded.emit(folder, matcher)
+        finally:
+            # anything unexpected: the next _submit starts a fresh thread
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+# ---------- Gallery ----------
+def face_templates(data):
+    # (k x 128) encodings of one known_faces entry: its template set when it
+    # was enrolled from several photos, otherwise its single encoding
+    t = data.get('templates')
+    return np.atleast_2d(data['encoding'] if t is None else t)
+
+GALLERY_DTYPES = ('float64', 'float32', 'float16', 'int8')
+
+def quantize(enc, dtype='float64'):
+    # -> (codes, per-row scale or None). int8 keeps one float32 scale per
+    # vector (max |value| / 127); the float types are a plain cast.
+    enc = np.atleast_2d(np.asarray(enc, dtype=np.float64))
+    if dtype != 'int8':
+        return enc.astype(dtype), None
+    scale = np.abs(enc).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(enc / scale[:, None]), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+def dequantize(codes, scale=None):
+    out = codes.astype(np.float64)
+    if scale is not None:
+        out *= scale[:, None]
+    return out
+
+def compact_dots(q, enc, scale=None, block=8192):
+    # q @ enc.T for float64 queries against a float64 or compact gallery.
+    # A compact one is scored with float32 BLAS, widened one block at a
+    # time, so no float64 copy of it is ever made.
+    if enc.dtype == np.float64:
+        return q @ enc.T
+    q32 = q.astype(np.float32)
+    dots = np.empty((len(q), len(enc)))
+    for a in range(0, len(enc), block):
+        rows = enc[a:a + block]
+        if rows.dtype != np.float32:
+            rows = rows.astype(np.float32)
+        dots[:, a:a + block] = q32 @ rows.T
+    if scale is not None:
+        dots *= scale[None, :]
+    return dots
+
+class FaceRecord:
+    # one enrolled student in a matcher: rows of the packed matrix it owns
+    __slots__ = ('name', 'rows')
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+class GalleryMatcher:
+    # All enrolled encodings live in one contiguous (N x 128) matrix with a
+    # parallel id array, so a frame is scored against the whole gallery with
+    # a single matrix product instead of one compare_faces call per user.
+    # A student with a template set simply owns several rows.
+    # dtype picks the stored precision: float32/float16 halve/quarter the
+    # matrix, int8 keeps a per-row scale. Scoring stays on the compact
+    # matrix, widening it a block at a time, and the squared norms are taken
+    # from the dequantized rows so distances are consistent.
+    BLOCK = 8192
+
+    def __init__(self, known_faces=None, tolerance=0.5, dtype='float64'):
+        if dtype not in GALLERY_DTYPES:
+            raise ValueError(f'Unknown gallery dtype {dtype!r}')
+        self.tolerance = tolerance
+        self.dtype = dtype
+        # Recognition workers (one per camera) match while the GUI thread
+        # enrols/deletes. Writers never change rows a reader can see: add
+        # appends past `size`, remove and _grow swap in new arrays. So match
+        # only holds the lock to take a snapshot and scores outside it.
+        self._lock = threading.RLock()
+        self.rebuild(known_faces or {})
+
+    @classmethod
+    def from_folder(cls, batch_folder, tolerance=0.5, dtype='float64'):
+        # a batch not migrated yet (that happens at login or with
+        # migrate-identities) is read from its old files as they are
+        store = GalleryStore(batch_folder)
+        if store.exists():
+            return cls.from_store(store, tolerance, dtype)
+        return cls(load_known_faces(batch_folder), tolerance, dtype)
+
+    @classmethod
+    def from_arrays(cls, encodings, ids, tolerance=0.5, dtype='float64', names=None):
+        # rows of one student may repeat its id (template sets)
+        m = cls(tolerance=tolerance, dtype=dtype)
+        names = names or {}
+        with m._lock:
+            m._alloc(len(encodings))
+            if len(encodings):
+                m._put(0, encodings)
+            m._ids[:len(ids)] = ids
+            m.size = len(encodings)
+            for r, uid in enumerate(m._ids[:m.size].tolist()):
+                rec = m.records.get(uid)
+                if rec is None:
+                    rec = m.records[uid] = FaceRecord(names.get(uid, ''), [])
+                rec.rows.append(r)
+        return m
+
+    @classmethod
+    def from_store(cls, store, tolerance=0.5, dtype='float64'):
+        # straight from the identity store rows, without building known_faces
+        uids, counts, names, packed = store.rows()
+        if not uids:
+            return cls(tolerance=tolerance, dtype=dtype)
+        return cls.from_arrays(packed, np.repeat(uids, counts), tolerance, dtype, dict(zip(uids, names)))
+
+    def _alloc(self, n):
+        cap = max(n, 16)
+        self._enc = np.zeros((cap, 128), dtype=self.dtype)
+        self._scale = np.ones(cap, dtype=np.float32) if self.dtype == 'int8' else None
+        self._sq = np.zeros(cap)
+        self._ids = np.zeros(cap, dtype=np.int64)
+        self.records = {}
+
+    def _put(self, r, encs):
+        codes, scale = quantize(encs, self.dtype)
+        self._enc[r:r + len(codes)] = codes
+        if scale is not None:
+            self._scale[r:r + len(codes)] = scale
+        deq = dequantize(codes, scale)
+        self._sq[r:r + len(codes)] = np.einsum('ij,ij->i', deq, deq)
+
+    def rebuild(self, known_faces):
+        with self._lock:
+            blocks = [face_templates(d) for d in known_faces.values()]
+            n = sum(len(b) for b in blocks)
+            self._alloc(n)
+            if n:
+                self._put(0, np.concatenate(blocks))
+                self._ids[:n] = np.repeat(list(known_faces), [len(b) for b in blocks])
+                r = 0
+                for (uid, d), b in zip(known_faces.items(), blocks):
+                    self.records[uid] = FaceRecord(d.get('name', ''), list(range(r, r + len(b))))
+                    r += len(b)
+            self.size = n
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, uid):
+        return uid in self.records
+
+    @property
+    def nbytes(self):
+        n = self.size
+        return self._enc[:n].nbytes + self._sq[:n].nbytes + self._ids[:n].nbytes + \
+            (self._scale[:n].nbytes if self._scale is not None else 0)
+
+    @property
+    def encodings(self):
+        return dequantize(self._enc[:self.size], None if self._scale is None else self._scale[:self.size])
+
+    @property
+    def ids(self):
+        return self._ids[:self.size]
+
+    def add(self, uid, encoding, name=''):
+        encs = np.atleast_2d(encoding)
+        with self._lock:
+            if uid in self.records:
+                self.remove(uid)
+            while self.size + len(encs) > len(self._ids):
+                self._grow(2 * len(self._ids))
+            r = self.size
+            self._put(r, encs)
+            self._ids[r:r + len(encs)] = uid
+            self.records[uid] = FaceRecord(name, list(range(r, r + len(encs))))
+            self.size += len(encs)
+
+    def remove(self, uid):
+        with self._lock:
+            rec = self.records.pop(uid, None)
+            if rec is None: return
+            self._enc, self._sq, self._ids = self._enc.copy(), self._sq.copy(), self._ids.copy()
+            if self._scale is not None:
+                self._scale = self._scale.copy()
+            for r in sorted(rec.rows, reverse=True):
+                last = self.size - 1
+                if r != last:
+                    # keep the matrix dense by moving the last row into the hole
+                    self._enc[r] = self._enc[last]
+                    self._sq[r] = self._sq[last]
+                    self._ids[r] = self._ids[last]
+                    if self._scale is not None:
+                        self._scale[r] = self._scale[last]
+                    owner = self.records[int(self._ids[r])].rows
+                    owner[owner.index(last)] = r
+                self.size = last
+
+    def _grow(self, cap):
+        for attr in ('_enc', '_sq', '_ids', '_scale'):
+            old = getattr(self, attr)
+            if old is None: continue
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, attr, new)
+
+    def _snapshot(self):
+        with self._lock:
+            n = self.size
+            return (self._enc[:n], self._sq[:n], self._ids[:n],
+                    None if self._scale is None else self._scale[:n])
+
+    def distances(self, encodings, snapshot=None):
+        enc, sq, _, scale = snapshot or self._snapshot()
+        q = np.asarray(encodings, dtype=np.float64).reshape(-1, 128)
+        dots = compact_dots(q, enc, scale, self.BLOCK)
+        # |q - g|^2 = |q|^2 + |g|^2 - 2 q.g for every (face, user) pair at once
+        d2 = (q * q).sum(axis=1)[:, None] + sq[None, :] - 2.0 * dots
+        np.maximum(d2, 0, out=d2)
+        return np.sqrt(d2)
+
+    def match(self, encodings):
+        # Returns (uid, distance) for each face; uid is None when the closest
+        # enrolled face is farther than the tolerance.
+        if not len(encodings):
+            return []
+        snap = self._snapshot()
+        ids = snap[2]
+        if not len(ids):
+            return [(None, None)] * len(encodings)
+        d = self.distances(encodings, snap)
+        best = d.argmin(axis=1)
+        dist = d[np.arange(len(best)), best]
+        return [
+            (int(ids[b]) if dv <= self.tolerance else None, float(dv))
+            for b, dv in zip(best, dist)
+        ]
+
+def quantization_drift(encodings, ids, queries, dtypes=GALLERY_DTYPES[1:], tolerance=0.5,
+                       margin=0.05):
+    # How far each compact dtype's distances move from float64, and how many
+    # match decisions at `tolerance` change: a different top-1 student or a
+    # query crossing the threshold. `margin` selects the pairs near the
+    # threshold, where drift actually matters.
+    ref = GalleryMatcher.from_arrays(encodings, ids, tolerance)
+    d_ref = ref.distances(queries)
+    m_ref = ref.match(queries)
+    near = np.abs(d_ref - tolerance) < margin
+    report = {'gallery': len(encodings), 'queries': len(queries), 'tolerance': tolerance,
+              'float64_bytes': ref.nbytes, 'near_threshold_pairs': int(near.sum()), 'dtypes': {}}
+    for dtype in dtypes:
+        m = GalleryMatcher.from_arrays(encodings, ids, tolerance, dtype)
+        t0 = time.perf_counter()
+        d = m.distances(queries)
+        ms = (time.perf_counter() - t0) * 1000 / max(len(queries), 1)
+        err = np.abs(d - d_ref)
+        got = m.match(queries)
+        report['dtypes'][dtype] = {
+            'bytes': m.nbytes,
+            'max_abs_drift': float(err.max()),
+            'mean_abs_drift': float(err.mean()),
+            'max_drift_near_threshold': float(err[near].max()) if near.any() else 0.0,
+            'decision_flips': sum(a[0] != b[0] for a, b in zip(got, m_ref)),
+            'ms_per_query': ms,
+        }
+    return report
+
+# ---------- ANN index ----------
+def sq_distances(q, x, x_sq=None):
+    if x_sq is None:
+        x_sq = np.einsum('ij,ij->i', x, x)
+    d2 = np.einsum('ij,ij->i', q, q)[:, None] + x_sq[None, :] - 2.0 * (q @ x.T)
+    return np.maximum(d2, 0, out=d2)
+
+def kmeans(x, k, iters=20, seed=0):
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = sq_distances(x, centroids).argmin(axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty cells on random points so every list stays useful
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centroids
+
+class IVFIndex:
+    # Inverted-file index over an admin's whole gallery. k-means centroids
+    # split the encodings into n_lists cells and a query only scans the
+    # n_probe cells nearest to it: raise n_probe for recall, lower it for
+    # latency. Small galleries (< exact_below) and untrained indexes fall
+    # back to exact search. Only the centroids are persisted; rows come
+    # from the batch galleries and are assigned to cells as they are added.
+    # Rows are stored in `dtype` as in GalleryMatcher; centroids, training
+    # and squared norms use the dequantized rows.
+    def __init__(self, n_lists=0, n_probe=8, exact_below=2000, dtype='float64'):
+        if dtype not in GALLERY_DTYPES:
+            raise ValueError(f'Unknown gallery dtype {dtype!r}')
+        if n_probe < 1:
+            raise ValueError('n_probe must be at least 1')
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.exact_below = exact_below
+        self.dtype = dtype
+        self.centroids = None
+        self.trained_size = 0
+        self._lock = threading.RLock()
+        self._keys = []
+        self._names = []
+        self._rows = {}
+        self._enc = np.zeros((64, 128), dtype=dtype)
+        self._scale = np.ones(64, dtype=np.float32) if dtype == 'int8' else None
+        self._sq = np.zeros(64)
+        self._assign = np.full(64, -1, dtype=np.int64)
+        self._lists = None
+        self._live = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def name_of(self, key):
+        r = self._rows.get(key)
+        return None if r is None else self._names[r]
+
+    @property
+    def nbytes(self):
+        n = len(self._keys)
+        return self._enc[:n].nbytes + self._sq[:n].nbytes + (self._scale[:n].nbytes if self._scale is not None else 0)
+
+    def vectors(self, rows):
+        # float64 encodings of the given storage rows
+        return dequantize(self._enc[rows], None if self._scale is None else self._scale[rows])
+
+    def _sq_distances(self, q, rows):
+        d2 = np.einsum('ij,ij->i', q, q)[:, None] + self._sq[rows][None, :] - \
+            2.0 * compact_dots(q, self._enc[rows], None if self._scale is None else self._scale[rows])
+        return np.maximum(d2, 0, out=d2)
+
+    def add(self, batch, uid, name, encoding):
+        self.add_many([(batch, uid, name, encoding)])
+
+    def add_many(self, items):
+        items = list(items)
+        if not items: return
+        with self._lock:
+            for batch, uid, _, _ in items:
+                self._drop((batch, uid))
+            start, end = len(self._keys), len(self._keys) + len(items)
+            if end > len(self._enc):
+                self._grow(max(end, 2 * len(self._enc)))
+            codes, scale = quantize(np.stack([it[3] for it in items]), self.dtype)
+            self._enc[start:end] = codes
+            if scale is not None:
+                self._scale[start:end] = scale
+            deq = dequantize(codes, scale)
+            self._sq[start:end] = np.einsum('ij,ij->i', deq, deq)
+            for batch, uid, name, _ in items:
+                self._rows[(batch, uid)] = len(self._keys)
+                self._keys.append((batch, uid))
+                self._names.append(name)
+            if self.centroids is not None:
+                self._assign[start:end] = sq_distances(deq, self.centroids).argmin(axis=1)
+            self._lists = self._live = None
+
+    def remove(self, batch, uid):
+        with self._lock:
+            self._drop((batch, uid))
+
+    def remove_batch(self, batch):
+        with self._lock:
+            for key in [k for k in self._rows if k[0] == batch]:
+                self._drop(key)
+
+    def _drop(self, key):
+        r = self._rows.pop(key, None)
+        if r is None: return
+        self._keys[r] = None
+        self._assign[r] = -1
+        self._lists = self._live = None
+        if len(self._keys) > 1024 and len(self._rows) < len(self._keys) // 2:
+            self._compact()
+
+    def _compact(self):
+        live = np.array(sorted(self._rows.values()), dtype=np.int64)
+        self._enc[:len(live)] = self._enc[live]
+        if self._scale is not None:
+            self._scale[:len(live)] = self._scale[live]
+        self._sq[:len(live)] = self._sq[live]
+        self._assign[:len(live)] = self._assign[live]
+        self._keys = [self._keys[r] for r in live]
+        self._names = [self._names[r] for r in live]
+        self._rows = {k: i for i, k in enumerate(self._keys)}
+
+    def _grow(self, cap):
+        for attr, fill in (('_enc', 0), ('_scale', 1), ('_sq', 0), ('_assign', -1)):
+            old = getattr(self, attr)
+            if old is None: continue
+            new = np.full((cap,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+
+    def _live_rows(self):
+        if self._live is None:
+            self._live = np.array(sorted(self._rows.values()), dtype=np.int64)
+        return self._live
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            live = self._live_rows()
+            order = live[np.argsort(self._assign[live], kind='stable')]
+            counts = np.bincount(self._assign[live], minlength=len(self.centroids))
+            self._lists = np.split(order, np.cumsum(counts)[:-1])
+        return self._lists
+
+    def train(self, iters=20, seed=0):
+        with self._lock:
+            live = self._live_rows()
+            if not len(live): return
+            k = self.n_lists or int(np.sqrt(len(live)))
+            k = max(1, min(k, len(live)))
+            x = self.vectors(live)
+            self.centroids = kmeans(x, k, iters, seed)
+            self.trained_size = len(live)
+            self._assign[live] = sq_distances(x, self.centroids).argmin(axis=1)
+            self._lists = None
+
+    def exact(self):
+        return (self.centroids is None or len(self._rows) < self.exact_below
+                or self.n_probe >= len(self.centroids))
+
+    def search(self, queries, exact=False):
+        # Returns ((batch, uid), distance) of the nearest row for every query.
+        q = np.asarray(queries, dtype=np.float64).reshape(-1, 128)
+        with self._lock:
+            if not self._rows:
+                return [(None, None)] * len(q)
+            live = self._live_rows()
+            if exact or self.exact():
+                # no holes: scan the storage in place instead of gathering
+                rows = slice(0, len(live)) if live[-1] == len(live) - 1 else live
+                out = []
+                for i in range(0, len(q), 64):
+                    d2 = self._sq_distances(q[i:i + 64], rows)
+                    best = d2.argmin(axis=1)
+                    out += [(self._keys[live[b]], float(np.sqrt(d2[j, b])))
+                            for j, b in enumerate(best)]
+                return out
+            lists = self._inverted_lists()
+            probe = np.argpartition(sq_distances(q, self.centroids), self.n_probe - 1, axis=1)
+            cands = [np.concatenate([lists[j] for j in p[:self.n_probe]]) for p in probe]
+            out = []
+            for qi, rows in zip(q, cands):
+                if not len(rows):
+                    out.append((None, None)); continue
+                d2 = self._sq_distances(qi[None], rows)[0]
+                b = d2.argmin()
+                out.append((self._keys[rows[b]], float(np.sqrt(d2[b]))))
+            return out
+
+    def save(self, path):
+        if self.centroids is None: return
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, centroids=self.centroids, trained_size=self.trained_size,
+                 n_probe=self.n_probe)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as f:
+            centroids = f['centroids']
+            trained_size = int(f['trained_size'])
+        with self._lock:
+            self.centroids = centroids
+            self.trained_size = trained_size
+            live = self._live_rows()
+            if len(live):
+                self._assign[live] = sq_distances(self.vectors(live), centroids).argmin(axis=1)
+            self._lists = None
+        return True
+
+class IndexMatcher:
+    # GalleryMatcher-style front for an IVFIndex. Ids are only unique within
+    # a batch, so it reports the index key (batch folder name, student id)
+    def __init__(self, index, tolerance=0.5):
+        self.index = index
+        self.tolerance = tolerance
+        self.names = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def match(self, encodings):
+        out = []
+        for key, dist in self.index.search(encodings):
+            if key is None or dist > self.tolerance:
+                out.append((None, dist)); continue
+            self.names[key] = self.index.name_of(key)
+            out.append((key, dist))
+        return out
+
+def load_admin_index(admin_folder, n_lists=0, n_probe=8, exact_below=2000, retrain=False,
+                     dtype='float64'):
+    index = IVFIndex(n_lists, n_probe, exact_below, dtype)
+    require_migrated(admin_folder)
+    members = {os.path.basename(folder): batch_members(folder) for folder in batch_folders(admin_folder)}
+    # every record is read once, however many batches share it
+    identities = IdentityStore(admin_folder)
+    keys = sorted({key for m in members.values() for key in m.values()})
+    packed, counts = identities.gather(keys)
+    bounds = np.cumsum([0] + counts)
+    mean = {key: packed[a:b].mean(axis=0) for key, a, b in zip(keys, bounds[:-1], bounds[1:])}
+    for entry, m in members.items():
+        index.add_many((entry, int(uid), identities.name_of(key), mean[key]) for uid, key in m.items())
+    path = os.path.join(admin_folder, ANN_INDEX_FILE)
+    # retrain once the gallery has outgrown the partition it was trained on
+    if retrain or not index.load(path) or len(index) > 4 * max(index.trained_size, 1):
+        index.train()
+        index.save(path)
+    return index
+
+class AdminIndexJob(QObject):
+    # load_admin_index on a background thread: the first build reads every
+    # batch and trains k-means. finished carries the index, or
+    # None and the error message.
+    finished = pyqtSignal(object, str)
+
+    def __init__(self, admin_folder, dtype='float64', parent=None):
+        super().__init__(parent)
+        self.admin_folder = admin_folder
+        self.dtype = dtype
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            index = load_admin_index(self.admin_folder, dtype=self.dtype)
+        except Exception as e:
+            self.finished.emit(None, f'{type(e).__name__}: {e}')
+            return
+        self.finished.emit(index, '')
+
+def ann_recall_check(index, queries):
+    t0 = time.perf_counter()
+    approx = index.search(queries)
+    t1 = time.perf_counter()
+    exact = index.search(queries, exact=True)
+    t2 = time.perf_counter()
+    hits = sum(a[0] == e[0] for a, e in zip(approx, exact))
+    n = max(len(queries), 1)
+    return {
+        'gallery': len(index),
+        'n_lists': 0 if index.centroids is None else len(index.centroids),
+        'n_probe': index.n_probe,
+        'queries': len(queries),
+        'recall_at_1': hits / n,
+        'ann_ms_per_query': 1000 * (t1 - t0) / n,
+        'exact_ms_per_query': 1000 * (t2 - t1) / n,
+    }
+
+# ---------- Attendance model ----------
+STATUSES = ['Present', 'Absent']
+
+class AttendanceModel(QAbstractTableModel):
+    # Table view over the app's attendance dict. Recognition results go
+    # through set_status, which only emits dataChanged when a row's status
+    # actually changes, so the view is not rebuilt on every frame. Rows the
+    # user set by hand are left alone by recognition, as in the recorder.
+    HEADERS = ['ID', 'Name', 'Status']
+    status_edited = pyqtSignal(object, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.known_faces = {}
+        self.attendance = {}
+        self.uids = []
+        self._row_of = {}
+        self.manual = set()
+
+    def reset(self, known_faces, attendance, manual=()):
+        self.beginResetModel()
+        self.known_faces = known_faces
+        self.attendance = attendance
+        self.manual = set(manual) & attendance.keys()
+        self.uids = list(attendance)
+        self._row_of = {uid: r for r, uid in enumerate(self.uids)}
+        self.endResetModel()
+
+    def add_user(self, uid):
+        if uid in self._row_of: return
+        r = len(self.uids)
+        self.beginInsertRows(QModelIndex(), r, r)
+        self.uids.append(uid)
+        self._row_of[uid] = r
+        self.endInsertRows()
+
+    def remove_user(self, uid):
+        r = self._row_of.get(uid)
+        if r is None: return
+        self.beginRemoveRows(QModelIndex(), r, r)
+        del self.uids[r]
+        self._row_of = {u: i for i, u in enumerate(self.uids)}
+        self.manual.discard(uid)
+        self.endRemoveRows()
+
+    def set_status(self, uid, status, manual=False):
+        r = self._row_of.get(uid)
+        if r is None or (uid in self.manual and not manual):
+            return False
+        if manual:
+            self.manual.add(uid)
+        if self.attendance.get(uid) == status:
+            return False
+        self.attendance[uid] = status
+        idx = self.index(r, 2)
+        self.dataChanged.emit(idx, idx, [Qt.DisplayRole, Qt.EditRole])
+        return True
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.uids)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 3
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+        uid = self.uids[index.row()]
+        col = index.column()
+        if col == 0:
+            return str(uid)
+        if col == 1:
+            return self.known_faces.get(uid, {}).get('name', '')
+        return self.attendance.get(uid, 'Absent')
+
+    def flags(self, index):
+        f = super().flags(index)
+        if index.column() == 2:
+            f |= Qt.ItemIsEditable
+        return f
+
+    def setData(self, index, value, role=Qt.EditRole):
+        # manual Present/Absent override from the status editor
+        if role != Qt.EditRole or index.column() != 2 or value not in STATUSES:
+            return False
+        uid = self.uids[index.row()]
+        self.set_status(uid, value, manual=True)
+        self.status_edited.emit(uid, value)
+        return True
+
+class StatusDelegate(QStyledItemDelegate):
+    def createEditor(self, parent, option, index):
+        cb = QComboBox(parent)
+        cb.addItems(STATUSES)
+        cb.activated.connect(lambda _, cb=cb: self.commitData.emit(cb))
+        return cb
+
+    def setEditorData(self, editor, index):
+        editor.setCurrentText(index.data(Qt.EditRole))
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentText(), Qt.EditRole)
+
+# ---------- Metrics ----------
+class RollingHistogram:
+    # Keeps the most recent `size` samples in a ring buffer; percentiles are
+    # only computed when a snapshot is taken.
+    __slots__ = ('values', 'count', 'total')
+
+    def __init__(self, size=1024):
+        self.values = [0.0] * size
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        n = min(self.count, len(self.values))
+        if not n:
+            return {'count': 0, 'sum': 0.0, 'mean': None, 'p50': None, 'p95': None, 'p99': None}
+        recent = np.asarray(self.values[:n])
+        p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+        return {'count': self.count, 'sum': self.total, 'mean': float(recent.mean()),
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+class _StageTimer:
+    __slots__ = ('metrics', 'name', 't0')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, (time.perf_counter() - self.t0) * 1000)
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics:
+    # Opt-in per-stage latency (ms) histograms, counters and gauges for an
+    # attendance session. When disabled every call returns immediately.
+    # Capture, recognition and GUI threads record into it while the writer
+    # takes snapshots, so updates and snapshots hold the lock.
+    def __init__(self, enabled=False, window=1024):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hists = {}
+            self.counters = {}
+            self.gauges = {}
+            self._ticks = {}
+            self.started = time.time()
+
+    def _hist(self, name):
+        h = self.hists.get(name)
+        if h is None:
+            h = self.hists[name] = RollingHistogram(self.window)
+        return h
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def observe(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self._hist(name).add(value)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.gauges[name] = value
+
+    def tick(self, name):
+        # records the interval between events, used for frame rates
+        if not self.enabled: return
+        now = time.perf_counter()
+        with self._lock:
+            last = self._ticks.get(name)
+            self._ticks[name] = now
+            if last is not None:
+                self._hist(name + '_interval').add((now - last) * 1000)
+
+    def _rate(self, name):
+        # with the lock held
+        h = self.hists.get(name + '_interval')
+        if h is None or not h.count:
+            return 0.0
+        n = min(h.count, len(h.values))
+        return 1000.0 * n / max(sum(h.values[:n]), 1e-9)
+
+    def snapshot(self):
+        with self._lock:
+            hists = dict(self.hists)
+            return {
+                'time': time.time(),
+                'uptime_s': time.time() - self.started,
+                'stages_ms': {k: h.summary() for k, h in hists.items()
+                              if not k.endswith('_interval') and k != 'faces_per_frame'},
+                'faces_per_frame': hists['faces_per_frame'].summary() if 'faces_per_frame' in hists else None,
+                'fps': {k[:-9]: self._rate(k[:-9]) for k in hists if k.endswith('_interval')},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+QUANTILES = (('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99'))
+
+def metrics_prometheus(snap):
+    lines = [
+        '# HELP edumark_stage_latency_ms Per-stage latency of the attendance pipeline.',
+        '# TYPE edumark_stage_latency_ms summary',
+    ]
+    for stage, st in sorted(snap['stages_ms'].items()):
+        for q, label in QUANTILES:
+            if st[q] is not None:
+                lines.append(f'edumark_stage_latency_ms{{stage="{stage}",quantile="{label}"}} {st[q]:.3f}')
+        lines.append(f'edumark_stage_latency_ms_sum{{stage="{stage}"}} {st["sum"]:.3f}')
+        lines.append(f'edumark_stage_latency_ms_count{{stage="{stage}"}} {st["count"]}')
+    if snap['faces_per_frame']:
+        lines.append('# TYPE edumark_faces_per_frame summary')
+        for q, label in QUANTILES:
+            lines.append(f'edumark_faces_per_frame{{quantile="{label}"}} {snap["faces_per_frame"][q]:.1f}')
+    lines.append('# TYPE edumark_fps gauge')
+    for name, fps in sorted(snap['fps'].items()):
+        lines.append(f'edumark_fps{{loop="{name}"}} {fps:.2f}')
+    for name, value in sorted(snap['counters'].items()):
+        lines.append(f'# TYPE edumark_{name}_total counter')
+        lines.append(f'edumark_{name}_total {value}')
+    for name, value in sorted(snap['gauges'].items()):
+        lines.append(f'# TYPE edumark_{name} gauge')
+        lines.append(f'edumark_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+class MetricsWriter:
+    # Writes a snapshot every `interval` seconds to a JSON file, or to a
+    # Prometheus text-format file (node_exporter textfile collector) when the
+    # path ends in .prom. Files are replaced atomically.
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.write()
+
+    def write(self):
+        snap = self.metrics.snapshot()
+        if self.path.endswith('.prom'):
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(metrics_prometheus(snap))
+            os.replace(tmp, self.path)
+        else:
+            write_json_atomic(self.path, snap)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+METRICS_OFF = Metrics(False)
+
+# ---------- Tracking ----------
+def box_iou(a, b):
+    # boxes are in face_recognition order: (top, right, bottom, left)
+    h = min(a[2], b[2]) - max(a[0], b[0])
+    w = min(a[1], b[1]) - max(a[3], b[3])
+    inter = max(0, h) * max(0, w)
+    union = (a[2]-a[0]) * (a[1]-a[3]) + (b[2]-b[0]) * (b[1]-b[3]) - inter
+    return inter / union if union > 0 else 0.0
+
+class Track:
+    __slots__ = ('tid', 'box', 'uid', 'dist', 'patch', 'misses')
+
+    def __init__(self, tid, box):
+        self.tid = tid
+        self.box = tuple(int(v) for v in box)
+        self.uid = None
+        self.dist = None
+        self.patch = None
+        self.misses = 0
+
+class FaceTracker:
+    # Full detection only runs every `detect_every` frames, when a face is
+    # lost, or when asked for. In between, each face is followed by template
+    # matching on a downscaled grayscale frame. A track keeps the identity it
+    # was first matched to, so only new or still unknown faces get encoded.
+    def __init__(self, detect_every=10, iou_threshold=0.3, follow_threshold=0.6,
+                 follow_scale=0.25, max_misses=2):
+        self.detect_every = detect_every
+        self.iou_threshold = iou_threshold
+        self.follow_threshold = follow_threshold
+        self.follow_scale = follow_scale
+        self.max_misses = max_misses
+        self.reset()
+
+    def reset(self):
+        self.tracks = []
+        self._next_id = 0
+        self._since_detect = 0
+        self._force = True
+        self._forget = set()
+        self.stats = {
+            'frames': 0, 'detections': 0, 'encoded_faces': 0,
+            'cached_faces': 0, 'cached_frames': 0,
+        }
+
+    def request_detection(self):
+        self._force = True
+
+    def forget(self, uid):
+        self._forget.add(uid)
+        self._force = True
+
+    def step(self, frame, detect, identify):
+        # detect(frame) -> boxes; identify(frame, boxes) -> [(uid, dist)]
+        self.stats['frames'] += 1
+        while self._forget:
+            uid = self._forget.pop()
+            for t in self.tracks:
+                if t.uid == uid:
+                    t.uid = t.dist = None
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None,
+                           fx=self.follow_scale, fy=self.follow_scale,
+                           interpolation=cv2.INTER_AREA)
+        if self._force or self._since_detect >= self.detect_every or not self._follow(small):
+            self._detect(frame, small, detect, identify)
+        else:
+            self._since_detect += 1
+            visible = [t for t in self.tracks if not t.misses]
+            known = sum(1 for t in visible if t.uid is not None)
+            self.stats['cached_faces'] += known
+            if known:
+                self.stats['cached_frames'] += 1
+        return [(t.box, t.uid, t.dist) for t in self.tracks if not t.misses]
+
+    def _detect(self, frame, small, detect, identify):
+        self._force = False
+        self._since_detect = 0
+        self.stats['detections'] += 1
+        boxes = [tuple(int(v) for v in b) for b in detect(frame)]
+        pairs = sorted(
+            ((box_iou(t.box, b), ti, bi)
+             for ti, t in enumerate(self.tracks) for bi, b in enumerate(boxes)),
+            reverse=True,
+        )
+        used_t, used_b = set(), set()
+        for iou, ti, bi in pairs:
+            if iou < self.iou_threshold:
+                break
+            if ti in used_t or bi in used_b:
+                continue
+            used_t.add(ti); used_b.add(bi)
+            t = self.tracks[ti]
+            t.box = boxes[bi]
+            t.misses = 0
+        for ti, t in enumerate(self.tracks):
+            if ti not in used_t:
+                t.misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        for bi, b in enumerate(boxes):
+            if bi not in used_b:
+                self.tracks.append(Track(self._next_id, b))
+                self._next_id += 1
+        pending = [t for t in self.tracks if not t.misses and t.uid is None]
+        if pending:
+            self.stats['encoded_faces'] += len(pending)
+            for t, (uid, dist) in zip(pending, identify(frame, [t.box for t in pending])):
+                t.uid, t.dist = uid, dist
+        self.stats['cached_faces'] += sum(
+            1 for t in self.tracks if not t.misses and t.uid is not None and t not in pending)
+        for t in self.tracks:
+            if not t.misses:
+                t.patch = self._crop(small, t.box)
+
+    def _crop(self, small, box):
+        top, right, bottom, left = (int(round(v * self.follow_scale)) for v in box)
+        h, w = small.shape
+        top, left = max(top, 0), max(left, 0)
+        bottom, right = min(bottom, h), min(right, w)
+        if bottom - top < 8 or right - left < 8:
+            return None
+        return small[top:bottom, left:right].copy()
+
+    def _follow(self, small):
+        # Returns False as soon as a face is lost so a detection is run instead.
+        s = self.follow_scale
+        h, w = small.shape
+        for t in self.tracks:
+            if t.misses or t.patch is None:
+                continue
+            ph, pw = t.patch.shape
+            top, left = int(round(t.box[0] * s)), int(round(t.box[3] * s))
+            y0, x0 = max(top - ph // 2, 0), max(left - pw // 2, 0)
+            y1, x1 = min(top + ph + ph // 2, h), min(left + pw + pw // 2, w)
+            if y1 - y0 < ph or x1 - x0 < pw:
+                return False
+            res = cv2.matchTemplate(small[y0:y1, x0:x1], t.patch, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (dx, dy) = cv2.minMaxLoc(res)
+            if score < self.follow_threshold:
+                return False
+            oy = int(round((y0 + dy) / s)) - t.box[0]
+            ox = int(round((x0 + dx) / s)) - t.box[3]
+            t.box = (t.box[0] + oy, t.box[1] + ox, t.box[2] + oy, t.box[3] + ox)
+        return True
+
+class FrameGate:
+    # Cheap pre-filter in front of detection and encoding. A frame is only
+    # recognized when enough of a small grayscale copy differs from the last
+    # frame that was (or every `refresh` seconds), and a face box is only
+    # encoded when it is big and sharp enough (variance of the Laplacian on
+    # a fixed-size grayscale crop). Rejected faces stay unknown and are
+    # retried at the next detection.
+    # With adaptive=True the recognizer also waits between frames, the
+    # wait growing while the scene stays still and dropping to 0 on motion.
+    def __init__(self, motion_threshold=0.002, pixel_threshold=20, width=160, refresh=5.0,
+                 min_face=40, min_sharpness=30.0, adaptive=False, max_interval=1.0,
+                 interval_step=1.5):
+        self.motion_threshold = motion_threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.refresh = refresh
+        self.min_face = min_face
+        self.min_sharpness = min_sharpness
+        self.adaptive = adaptive
+        self.max_interval = max_interval
+        self.interval_step = interval_step
+        self.reset()
+
+    def reset(self):
+        self.interval = 0.0
+        self._last = None
+        self._last_time = 0.0
+        self.stats = {
+            'frames': 0, 'static_frames': 0, 'faces': 0,
+            'small_faces': 0, 'blurry_faces': 0,
+        }
+
+    def force(self):
+        self._last = None
+
+    def changed(self, frame):
+        self.stats['frames'] += 1
+        h, w = frame.shape[:2]
+        gray = cv2.cvtColor(cv2.resize(frame, (self.width, max(1, h * self.width // w)),
+                                       interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (3, 3), 0)
+        now = time.monotonic()
+        if (self._last is not None and self._last.shape == gray.shape
+                and now - self._last_time < self.refresh):
+            diff = cv2.absdiff(gray, self._last)
+            moved = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+            if moved < self.motion_threshold:
+                self.stats['static_frames'] += 1
+                if self.adaptive:
+                    self.interval = min(self.max_interval,
+                                        max(self.interval * self.interval_step, 0.05))
+                return False
+        self._last, self._last_time = gray, now
+        self.interval = 0.0
+        return True
+
+    def usable(self, frame, box):
+        self.stats['faces'] += 1
+        top, right, bottom, left = box
+        if min(bottom - top, right - left) < self.min_face:
+            self.stats['small_faces'] += 1
+            return False
+        crop = frame[max(top, 0):bottom, max(left, 0):right]
+        if not crop.size:
+            self.stats['small_faces'] += 1
+            return False
+        gray = cv2.cvtColor(cv2.resize(crop, (64, 64), interpolation=cv2.INTER_AREA),
+                            cv2.COLOR_BGR2GRAY)
+        if cv2.Laplacian(gray, cv2.CV_64F).var() < self.min_sharpness:
+            self.stats['blurry_faces'] += 1
+            return False
+        return True
+
+# ---------- Frame sources ----------
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+class FrameSource:
+    # Everything the app reads frames from. read() returns (ok, BGR frame).
+    # With fps set, file-backed sources are paced to real time; without it
+    # they deliver as fast as they are read. size=(w, h) resizes each frame.
+    # Apart from the live camera, sources are frame-exact on every replay.
+    end_message = 'End of input'
+
+    def __init__(self, fps=None, size=None):
+        self.fps = fps
+        self.size = size
+        self.frame_index = 0
+        self._due = None
+
+    def open(self):
+        self.frame_index = 0
+        self._due = None
+        return self
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def _read(self):
+        raise NotImplementedError
+
+    def _pace(self):
+        now = time.perf_counter()
+        if self._due is None:
+            self._due = now
+        elif self._due > now:
+            time.sleep(self._due - now)
+        self._due = max(self._due, now - 1.0) + 1.0 / self.fps
+
+    def read(self):
+        if self.fps:
+            self._pace()
+        ok, frame = self._read()
+        if not ok:
+            return False, None
+        if self.size and (frame.shape[1], frame.shape[0]) != tuple(self.size):
+            frame = cv2.resize(frame, tuple(self.size), interpolation=cv2.INTER_AREA)
+        self.frame_index += 1
+        return True, frame
+
+class CameraSource(FrameSource):
+    end_message = 'Camera error'
+
+    def __init__(self, index=0, fps=None, size=None, mirror=False):
+        super().__init__(fps, size)
+        self.index = index
+        self.mirror = mirror
+        self.cap = None
+
+    def open(self):
+        super().open()
+        self.cap = cv2.VideoCapture(self.index)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        if self.size:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.size[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.size[1])
+        if self.fps:
+            self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+        return self
+
+    def _pace(self):
+        pass  # the camera paces itself
+
+    def _read(self):
+        ret, frame = self.cap.read()
+        if ret and self.mirror:
+            frame = cv2.flip(frame, 1)
+        return ret, frame
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path, fps=None, size=None, loop=False, start=0, stride=1):
+        super().__init__(fps, size)
+        self.path = path
+        self.loop = loop
+        self.start = start
+        self.stride = stride
+        self.position = None
+        self.cap = None
+
+    def open(self):
+        super().open()
+        self.cap = cv2.VideoCapture(self.path)
+        self.source_fps = self.cap.get(cv2.CAP_PROP_FPS) or 25.0
+        self._rewind()
+        return self
+
+    def _rewind(self):
+        self._next = self.start
+        if self.start:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+
+    def _read(self):
+        while True:
+            if self._next % self.stride:
+                # grab() skips the colour conversion of frames we do not use
+                ok = self.cap.grab()
+            else:
+                ok, frame = self.cap.read()
+            if not ok:
+                if self.loop and self._next > self.start:
+                    self._next = self.start
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+                    continue
+                return False, None
+            self._next += 1
+            if not (self._next - 1) % self.stride:
+                self.position = self._next - 1
+                return True, frame
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+class ImageDirSource(FrameSource):
+    def __init__(self, path, fps=None, size=None, loop=False):
+        super().__init__(fps, size)
+        self.path = path
+        self.loop = loop
+        self.files = []
+        self.current = None
+
+    def open(self):
+        super().open()
+        self.files = sorted(f for f in os.listdir(self.path) if f.lower().endswith(IMAGE_EXTS))
+        self._i = 0
+        return self
+
+    def _read(self):
+        while self.files:
+            if self._i >= len(self.files):
+                if not self.loop: break
+                self._i = 0
+            self.current = self.files[self._i]
+            self._i += 1
+            frame = cv2.imread(os.path.join(self.path, self.current))
+            if frame is not None:
+                return True, frame
+        return False, None
+
+class SyntheticSource(FrameSource):
+    # Classroom-like frames built from stored face crops pasted on a fixed
+    # background. Frame i depends only on (seed, i), so runs on machines
+    # without a camera replay exactly the same frames.
+    def __init__(self, crops=None, fps=None, size=(640, 480), faces=4, frames=None, seed=0):
+        super().__init__(fps, None)
+        self.crops = crops
+        self.frame_size = tuple(size)
+        self.faces = faces
+        self.frames = frames
+        self.seed = seed
+
+    def open(self):
+        super().open()
+        w, h = self.frame_size
+        rng = np.random.RandomState(self.seed)
+        images = []
+        if isinstance(self.crops, str) and os.path.isdir(self.crops):
+            for f in sorted(os.listdir(self.crops)):
+                if f.lower().endswith(IMAGE_EXTS):
+                    img = cv2.imread(os.path.join(self.crops, f))
+                    if img is not None:
+                        images.append(img)
+        elif self.crops is not None:
+            images = list(self.crops)
+        if not images:
+            images = [rng.randint(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(self.faces)]
+        grad = np.linspace(40, 120, w, dtype=np.float32)[None, :, None]
+        self._background = np.clip(grad + rng.normal(0, 8, (h, w, 3)), 0, 255).astype(np.uint8)
+        self._faces = []
+        for k in range(self.faces):
+            side = int(min(w, h) * rng.uniform(0.12, 0.25))
+            crop = cv2.resize(images[k % len(images)], (side, side), interpolation=cv2.INTER_AREA)
+            x = int(rng.uniform(0, w - side)); y = int(rng.uniform(0, h - side))
+            self._faces.append((crop, x, y, rng.uniform(0, 2 * np.pi)))
+        return self
+
+    def _read(self):
+        i = self.frame_index
+        if self.frames is not None and i >= self.frames:
+            return False, None
+        w, h = self.frame_size
+        frame = self._background.copy()
+        self.boxes = []
+        for crop, x, y, phase in self._faces:
+            side = crop.shape[0]
+            # slow seated sway, a few pixels either way
+            x = min(max(int(x + 6 * np.sin(i / 20.0 + phase)), 0), w - side)
+            y = min(max(int(y + 3 * np.cos(i / 27.0 + phase)), 0), h - side)
+            frame[y:y + side, x:x + side] = crop
+            self.boxes.append((y, x + side, y + side, x))
+        noise = np.random.RandomState((self.seed * 7919 + i) % (2 ** 31)).randint(0, 4, frame.shape, dtype=np.uint8)
+        return True, cv2.add(frame, noise)
+
+def parse_size(text):
+    if not text:
+        return None
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+def open_source(spec, fps=None, size=None, mirror=False, loop=False):
+    # 'camera:0' (or just a number), 'video:<file>', 'images:<dir>',
+    # 'synthetic:<crop dir>' or a plain video file / image directory path.
+    spec = str(spec)
+    kind, _, arg = spec.partition(':')
+    if not _ or len(kind) == 1:  # no prefix, or a Windows drive letter
+        kind, arg = ('camera', spec) if spec.isdigit() else \
+                    ('images', spec) if os.path.isdir(spec) else ('video', spec)
+    if kind == 'camera':
+        return CameraSource(int(arg or 0), fps, size, mirror)
+    if kind == 'video':
+        return VideoFileSource(arg, fps, size, loop)
+    if kind == 'images':
+        return ImageDirSource(arg, fps, size, loop)
+    if kind == 'synthetic':
+        return SyntheticSource(arg or None, fps, size or (640, 480))
+    raise ValueError(f'Unknown frame source {spec!r}')
+
+# ---------- Detectors ----------
+class FaceDetector:
+    # Every backend takes an RGB image and returns face_recognition style
+    # (top, right, bottom, left) boxes. upsample works like dlib's: the
+    # image is enlarged 2**upsample times first, which finds smaller faces.
+    # detect_batch handles several images at once where the backend can.
+    name = ''
+    batched = False
+
+    def detect(self, rgb, upsample=1):
+        raise NotImplementedError
+
+    def detect_batch(self, images, upsample=1):
+        return [self.detect(im, upsample) for im in images]
+
+    def __call__(self, rgb, upsample=1):
+        return self.detect(rgb, upsample)
+
+def _upscaled(img, upsample):
+    if upsample <= 0:
+        return img, 1
+    f = 2 ** upsample
+    return cv2.resize(img, None, fx=f, fy=f, interpolation=cv2.INTER_LINEAR), f
+
+def _clip_boxes(boxes, shape):
+    h, w = shape[:2]
+    return [(max(0, t), min(w, r), min(h, b), max(0, l)) for t, r, b, l in boxes
+            if b > t and r > l]
+
+class HogDetector(FaceDetector):
+    name = 'hog'
+
+    def detect(self, rgb, upsample=1):
+        return face_recognition.face_locations(rgb, upsample)
+
+class HaarDetector(FaceDetector):
+    name = 'haar'
+
+    def __init__(self, path=None, scale_factor=1.1, min_neighbors=5, min_size=24):
+        path = path or cv2.data.haarcascades + CASCADE_FILE
+        if not os.path.exists(path):
+            raise ValueError(f'Haar cascade not found: {path}')
+        self.cascade = cv2.CascadeClassifier(path)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def detect(self, rgb, upsample=1):
+        # the cascade scans down to min_size itself, so upsample only
+        # matters for faces smaller than that
+        gray, f = _upscaled(cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), upsample - 1)
+        faces = self.cascade.detectMultiScale(gray, self.scale_factor, self.min_neighbors,
+                                              minSize=(self.min_size, self.min_size))
+        return _clip_boxes([(int(y / f), int((x + w) / f), int((y + h) / f), int(x / f))
+                            for x, y, w, h in faces], rgb.shape)
+
+class YuNetDetector(FaceDetector):
+    # OpenCV's FaceDetectorYN with a local face_detection_yunet_*.onnx
+    name = 'yunet'
+
+    def __init__(self, path, score_threshold=0.7, nms_threshold=0.3):
+        if not os.path.exists(path):
+            raise ValueError(f'YuNet model not found: {path}')
+        self.net = cv2.FaceDetectorYN.create(path, '', (320, 320), score_threshold, nms_threshold)
+
+    def detect(self, rgb, upsample=1):
+        # trained on faces >= ~10px, so no enlarging at the default upsample
+        bgr, f = _upscaled(np.ascontiguousarray(rgb[:, :, ::-1]), upsample - 1)
+        self.net.setInputSize((bgr.shape[1], bgr.shape[0]))
+        _, faces = self.net.detect(bgr)
+        if faces is None:
+            return []
+        return _clip_boxes([(int(y / f), int((x + w) / f), int((y + h) / f), int(x / f))
+                            for x, y, w, h in faces[:, :4]], rgb.shape)
+
+class SsdDetector(FaceDetector):
+    # The OpenCV res10 SSD (Caffe .caffemodel + deploy .prototxt). Several
+    # images go through the network as one blob.
+    name = 'ssd'
+    batched = True
+
+    def __init__(self, path, config=None, confidence=0.5, size=300):
+        config = config or os.path.join(os.path.dirname(path), 'deploy.prototxt')
+        for f in (path, config):
+            if not os.path.exists(f):
+                raise ValueError(f'SSD model file not found: {f}')
+        self.net = cv2.dnn.readNet(path, config)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.confidence = confidence
+        self.size = size
+
+    def detect(self, rgb, upsample=1):
+        return self.detect_batch([rgb], upsample)[0]
+
+    def detect_batch(self, images, upsample=1):
+        if not images:
+            return []
+        # the network is fully convolutional, a larger input finds smaller faces
+        side = self.size * 2 ** max(upsample - 1, 0)
+        # the model was trained on BGR; mean is given in the output (BGR) order
+        blob = cv2.dnn.blobFromImages(images, 1.0, (side, side), (104, 177, 123), swapRB=True)
+        self.net.setInput(blob)
+        out = self.net.forward().reshape(-1, 7)
+        results = [[] for _ in images]
+        for img_id, _, conf, x0, y0, x1, y1 in out:
+            if conf < self.confidence or img_id < 0:
+                continue
+            h, w = images[int(img_id)].shape[:2]
+            results[int(img_id)].append((int(y0 * h), int(x1 * w), int(y1 * h), int(x0 * w)))
+        return [_clip_boxes(r, im.shape) for r, im in zip(results, images)]
+
+DETECTORS = {'hog': HogDetector, 'haar': HaarDetector, 'yunet': YuNetDetector, 'ssd': SsdDetector}
+
+def parse_detector(spec='hog'):
+    # 'hog', 'haar[:cascade.xml]', 'yunet:model.onnx', 'ssd:model.caffemodel[,deploy.prototxt]'
+    # Checks the spec without loading anything, so the command line can be
+    # validated before cv2 is imported.
+    kind, _, arg = (spec or 'hog').partition(':')
+    if kind not in DETECTORS:
+        raise ValueError(f'Unknown detector {spec!r}, expected one of {", ".join(DETECTORS)}')
+    if kind in ('yunet', 'ssd') and not arg:
+        raise ValueError(f'{kind} needs a model file, e.g. {kind}:models/face.{"onnx" if kind == "yunet" else "caffemodel"}')
+    for path in filter(None, arg.split(',')):
+        if not os.path.exists(path):
+            raise ValueError(f'{kind} model file not found: {path}')
+    return kind, arg
+
+def make_detector(spec='hog'):
+    kind, arg = parse_detector(spec)
+    try:
+        if kind == 'ssd':
+            return SsdDetector(*arg.split(','))
+        return DETECTORS[kind](arg) if arg else DETECTORS[kind]()
+    except cv2.error as e:
+        raise ValueError(f'Could not load the {kind} detector: {e}')
+
+def load_detection_labels(path):
+    # labels.csv with image,x,y,w,h rows in pixels, one row per face; an
+    # image listed with an empty box has no faces. `path` is the CSV or the
+    # folder holding it. Returns [(image path, [(top, right, bottom, left)])].
+    if os.path.isdir(path):
+        path = os.path.join(path, 'labels.csv')
+    base = os.path.dirname(os.path.abspath(path))
+    samples = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            boxes = samples.setdefault(os.path.join(base, row['image']), [])
+            if (row.get('w') or '').strip():
+                x, y, w, h = (int(float(row[k])) for k in ('x', 'y', 'w', 'h'))
+                boxes.append((y, x + w, y + h, x))
+    return list(samples.items())
+
+def match_detections(found, truth, iou=0.5):
+    # greedy one-to-one matching; returns the indices of matched truth boxes
+    pairs = sorted(((box_iou(f, t), fi, ti) for fi, f in enumerate(found)
+                    for ti, t in enumerate(truth)), reverse=True)
+    used_f, used_t = set(), set()
+    for score, fi, ti in pairs:
+        if score < iou:
+            break
+        if fi not in used_f and ti not in used_t:
+            used_f.add(fi); used_t.add(ti)
+    return used_t
+
+def compare_detectors(specs, samples, upsample=1, max_side=None, iou=0.5, small=40, batch=8,
+                      log=print):
+    # Latency and recall of each backend on a labelled image set. Faces
+    # shorter than `small` pixels (the back of the room) get their own
+    # recall column. Batched backends are timed per image over a batch.
+    frames = []
+    for path, truth in samples:
+        frame = cv2.imread(path)
+        if frame is None:
+            log(f'Skipping unreadable {path}'); continue
+        frames.append((frame, truth))
+    rows = []
+    for spec in specs:
+        det = make_detector(spec)
+        region = RegionDetector(max_side=max_side, upsample=upsample, locate=det)
+        times, found = [], []
+        if det.batched and not max_side:
+            det.detect_batch([np.ascontiguousarray(frames[0][0][:, :, ::-1])], upsample)  # warm-up
+            for i in range(0, len(frames), batch):
+                chunk = [np.ascontiguousarray(f[:, :, ::-1]) for f, _ in frames[i:i + batch]]
+                t = time.perf_counter()
+                found += det.detect_batch(chunk, upsample)
+                times += [(time.perf_counter() - t) * 1000 / len(chunk)] * len(chunk)
+        else:
+            region(frames[0][0])  # warm-up
+            for frame, _ in frames:
+                t = time.perf_counter()
+                found.append(region(frame))
+                times.append((time.perf_counter() - t) * 1000)
+        hits = faces = small_hits = small_faces = n_found = 0
+        for boxes, (_, truth) in zip(found, frames):
+            matched = match_detections(boxes, truth, iou)
+            n_found += len(boxes)
+            hits += len(matched)
+            faces += len(truth)
+            for ti, (top, _, bottom, _) in enumerate(truth):
+                if bottom - top < small:
+                    small_faces += 1
+                    small_hits += ti in matched
+        rows.append({
+            'detector': spec, 'images': len(frames),
+            'mean_ms': statistics.fmean(times) if times else 0.0,
+            'p95_ms': float(np.percentile(times, 95)) if times else 0.0,
+            'recall': hits / faces if faces else None,
+            'recall_small': small_hits / small_faces if small_faces else None,
+            'precision': hits / n_found if n_found else None,
+            'faces': faces, 'small_faces': small_faces, 'found': n_found,
+        })
+        log(f'{spec}: {rows[-1]["mean_ms"]:.1f} ms/image')
+    return rows
+
+# ---------- Pipeline ----------
+def put_latest(q, item):
+    # Bounded queue that never blocks the producer: when the consumer is
+    # behind, the stale item is dropped in favour of the new one.
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+def encoder_workers():
+    # cores this process may use, one left for capture and the GUI
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    return max(1, n - 1)
+
+# tmpfs where there is one, so frame blocks never touch the disk
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# per-process state of the worker pools
+_worker = {}
+
+def _pool_init(detector=None, detect_size=None, gallery=None):
+    # Initializer of every worker pool: one decoder/dlib thread per process,
+    # the pool provides the parallelism, plus the detector and the gallery
+    # matcher (folder, tolerance, dtype) its tasks need. Pool respawns a
+    # worker whose initializer raises, forever, so a failure is kept and
+    # raised by the worker's tasks instead.
+    cv2.setNumThreads(1)
+    try:
+        if detector is not None:
+            _worker['detector'] = RegionDetector(max_side=detect_size, locate=make_detector(detector))
+        if gallery is not None:
+            folder, tolerance, dtype = gallery
+            matcher = GalleryMatcher.from_folder(folder, tolerance, dtype)
+            _worker['recognizer'] = FaceRecognizer(matcher, detector=_worker.get('detector'))
+    except Exception as e:
+        _worker['error'] = e
+
+def _pool_state():
+    if 'error' in _worker:
+        raise _worker['error']
+    return _worker
+
+def worker_pool(workers, detector=None, detect_size=None, gallery=None, threads=False):
+    # threads=True when the caller already runs threads (the GUI, capture,
+    # gallery cache): a forked child inherits their locks mid-use, so the
+    # workers come from a fork server instead, or spawn where there is none
+    ctx = multiprocessing
+    if threads:
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ctx.Pool(workers, _pool_init, (detector, detect_size, gallery))
+
+def _encode_shared_faces(args):
+    path, shape, locs = args
+    block = _worker.get('frame_block')
+    if block is None or block.filename != path:
+        block = _worker['frame_block'] = np.memmap(path, 'uint8', 'r')
+    rgb = block[:int(np.prod(shape))].reshape(shape)
+    return face_recognition.face_encodings(rgb, locs)
+
+class ParallelEncoder:
+    # Splits a frame's faces across a persistent process pool. The frame is
+    # written once into a shared memory-mapped block (converted to RGB on
+    # the way in) and each worker encodes a contiguous slice of the boxes
+    # from it, so only the boxes and the 128-d results are pickled.
+    # pool.map keeps the slices in order, so encodings line up with boxes.
+    # Frames with fewer than min_faces faces are encoded in-process, where
+    # the pool round trip would cost more than it saves. Several camera
+    # threads can encode at once; each has its own frame block.
+    def __init__(self, workers=None, min_faces=4):
+        self.workers = workers or encoder_workers()
+        self.min_faces = min_faces
+        self._pool = None
+        self._local = threading.local()
+        self._blocks = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _frame_block(self, nbytes):
+        block = getattr(self._local, 'block', None)
+        if block is None or block.size < nbytes:
+            with self._lock:
+                if block is not None:
+                    self._release_block(block.filename)
+                # a new name per block, workers re-map when it changes
+                self._count += 1
+                path = os.path.join(SHM_DIR, f'edumark-frame-{os.getpid()}-{id(self)}-{self._count}')
+                block = self._local.block = self._blocks[path] = \
+                    np.memmap(path, 'uint8', 'w+', shape=(nbytes,))
+        return block
+
+    def _release_block(self, path):
+        self._blocks.pop(path, None)
+        os.remove(path)
+
+    def encode(self, frame, locs):
+        # frame is BGR, locs are (top, right, bottom, left) boxes
+        locs = list(locs)
+        if self.workers < 2 or len(locs) < self.min_faces:
+            return face_recognition.face_encodings(frame[:, :, ::-1], locs)
+        with self._lock:
+            if self._pool is None:
+                # first used from a recognition thread, long after the app's
+                # other threads started
+                self._pool = worker_pool(self.workers, threads=True)
+            pool = self._pool
+        block = self._frame_block(frame.nbytes)
+        np.copyto(block[:frame.nbytes].reshape(frame.shape), frame[:, :, ::-1])
+        parts = min(self.workers, len(locs))
+        bounds = np.linspace(0, len(locs), parts + 1).astype(int)
+        tasks = [(block.filename, frame.shape, locs[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        return [enc for part in pool.map(_encode_shared_faces, tasks) for enc in part]
+
+    def close(self):
+        # call once the pipelines using the encoder have stopped
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+            for path in list(self._blocks):
+                self._release_block(path)
+            self._local = threading.local()
+
+class RegionDetector:
+    # Detection limited to regions of interest, each given as (x, y, w, h,
+    # upsample) fractions of the frame, and optionally run on a copy of each
+    # region downscaled to max_side. Boxes are mapped back to full-frame
+    # coordinates, so encoding and the overlay use the full-resolution
+    # frame. refine re-detects each coarse box on a padded full-resolution
+    # crop for a tighter box. locate is any FaceDetector (HOG by default).
+    def __init__(self, rois=(), max_side=None, upsample=1, refine=False, locate=None):
+        self.rois = [tuple(r) for r in rois]
+        self.max_side = max_side
+        self.upsample = upsample
+        self.refine = refine
+        self.locate = locate or HogDetector()
+
+    def regions(self, shape):
+        # -> [(x0, y0, x1, y1, upsample)] in pixels
+        h, w = shape[:2]
+        if not self.rois:
+            return [(0, 0, w, h, self.upsample)]
+        out = []
+        for x, y, rw, rh, up in self.rois:
+            x0, y0 = max(0, int(x * w)), max(0, int(y * h))
+            x1, y1 = min(w, int(round((x + rw) * w))), min(h, int(round((y + rh) * h)))
+            if x1 - x0 >= 16 and y1 - y0 >= 16:
+                out.append((x0, y0, x1, y1, up))
+        return out
+
+    def __call__(self, frame):
+        crops = []
+        for x0, y0, x1, y1, up in self.regions(frame.shape):
+            region = frame[y0:y1, x0:x1]
+            s = 1.0
+            if self.max_side and max(region.shape[:2]) > self.max_side:
+                s = self.max_side / max(region.shape[:2])
+                region = cv2.resize(region, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+            crops.append((np.ascontiguousarray(region[:, :, ::-1]), s, x0, y0, x1, y1, up))
+        if self.locate.batched:
+            found = [None] * len(crops)
+            for up in {c[6] for c in crops}:
+                idx = [i for i, c in enumerate(crops) if c[6] == up]
+                for i, res in zip(idx, self.locate.detect_batch([crops[i][0] for i in idx], up)):
+                    found[i] = res
+        else:
+            found = [self.locate(c[0], c[6]) for c in crops]
+        boxes = []
+        for (_, s, x0, y0, x1, y1, _), locs in zip(crops, found):
+            for top, right, bottom, left in locs:
+                box = (int(top / s) + y0, min(int(right / s) + x0, x1),
+                       min(int(bottom / s) + y0, y1), int(left / s) + x0)
+                if self.refine and s < 1:
+                    box = self._refine(frame, box)
+                # overlapping regions can find the same face twice
+                if all(box_iou(box, b) < 0.5 for b in boxes):
+                    boxes.append(box)
+        return boxes
+
+    def _refine(self, frame, box):
+        top, right, bottom, left = box
+        pad = (bottom - top) // 4
+        h, w = frame.shape[:2]
+        y0, x0 = max(0, top - pad), max(0, left - pad)
+        y1, x1 = min(h, bottom + pad), min(w, right + pad)
+        crop = np.ascontiguousarray(frame[y0:y1, x0:x1, ::-1])
+        # HOG misses faces under ~80px unless upsampled
+        found = self.locate(crop, 1 if min(crop.shape[:2]) < 160 else 0)
+        if len(found) != 1:
+            return box
+        t, r, b, l = found[0]
+        return (t + y0, r + x0, b + y0, l + x0)
+
+class FaceRecognizer:
+    def __init__(self, matcher, tracker=None, metrics=METRICS_OFF, encoder=None, gate=None,
+                 detector=None):
+        self.matcher = matcher
+        self.tracker = tracker
+        self.metrics = metrics
+        self.encoder = encoder
+        self.gate = gate
+        self.detector = detector
+
+    def detect(self, frame):
+        with self.metrics.stage('detect'):
+            if self.detector is not None:
+                return self.detector(frame)
+            return face_recognition.face_locations(frame[:, :, ::-1])
+
+    def identify(self, frame, locs):
+        if not len(locs):
+            return []
+        keep = list(range(len(locs)))
+        if self.gate is not None:
+            keep = [i for i in keep if self.gate.usable(frame, locs[i])]
+            self.metrics.count('faces_gated', len(locs) - len(keep))
+        results = [(None, None)] * len(locs)
+        if not keep:
+            return results
+        good = [locs[i] for i in keep]
+        with self.metrics.stage('encode'):
+            if self.encoder is not None:
+                encs = self.encoder.encode(frame, good)
+            else:
+                encs = face_recognition.face_encodings(frame[:, :, ::-1], good)
+        with self.metrics.stage('match'):
+            for i, match in zip(keep, self.matcher.match(encs)):
+                results[i] = match
+        return results
+
+    def process(self, frame):
+        # None means the gate found nothing new, the last results still hold
+        if self.gate is not None:
+            with self.metrics.stage('gate'):
+                changed = self.gate.changed(frame)
+            if not changed:
+                self.metrics.count('frames_static')
+                return None
+        if self.tracker is not None:
+            results = self.tracker.step(frame, self.detect, self.identify)
+        else:
+            locs = self.detect(frame)
+            results = [(loc, uid, dist) for loc, (uid, dist) in zip(locs, self.identify(frame, locs))]
+        if self.metrics.enabled:
+            self.metrics.observe('faces_per_frame', len(results))
+            self.metrics.gauge('gallery_size', len(self.matcher))
+        return results
+
+    def gallery_changed(self, uid=None):
+        if self.gate is not None:
+            self.gate.force()
+        if self.tracker is None: return
+        if uid is not None:
+            self.tracker.forget(uid)
+        else:
+            self.tracker.request_detection()
+
+class FramePipeline(QObject):
+    # Capture and recognition run on their own threads. The GUI only gets
+    # signals: frame_ready at camera rate (coalesced, fetch the frame with
+    # latest_frame) and results_ready whenever the recognizer finishes one.
+    frame_ready = pyqtSignal()
+    results_ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, recognizer, source, metrics=METRICS_OFF, parent=None):
+        super().__init__(parent)
+        self.recognizer = recognizer
+        self.source = source
+        self.metrics = metrics
+        self.dropped = 0
+        self._frames = queue.Queue(maxsize=1)
+        self._display = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, daemon=True),
+            threading.Thread(target=self._recognize_loop, daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+        put_latest(self._frames, None)
+        for t in self._threads:
+            t.join(timeout=2)
+        self._threads = []
+
+    def running(self):
+        return any(t.is_alive() for t in self._threads)
+
+    def latest_frame(self):
+        with self._lock:
+            frame, self._display = self._display, None
+        return frame
+
+    def _capture_loop(self):
+        self.source.open()
+        try:
+            while not self._stop.is_set():
+                with self.metrics.stage('capture'):
+                    ret, frame = self.source.read()
+                if not ret:
+                    self.failed.emit(self.source.end_message)
+                    break
+                self.metrics.tick('capture')
+                with self._lock:
+                    pending = self._display is not None
+                    self._display = frame
+                if not pending:
+                    self.frame_ready.emit()
+                else:
+                    self.metrics.count('display_dropped')
+                dropped = put_latest(self._frames, frame)
+                self.dropped += dropped
+                self.metrics.count('frames_dropped', dropped)
+        finally:
+            self.source.release()
+            put_latest(self._frames, None)
+
+    def _recognize_loop(self):
+        while not self._stop.is_set():
+            frame = self._frames.get()
+            if frame is None:
+                break
+            try:
+                with self.metrics.stage('recognize'):
+                    results = self.recognizer.process(frame)
+            except ServerError as e:
+                self.failed.emit(str(e))
+                break
+            except Exception as e:
+                # a dead recognition thread must not leave the video running
+                self._stop.set()
+                self.failed.emit(f'Recognition stopped: {type(e).__name__}: {e}')
+                break
+            gate = self.recognizer.gate
+            if results is not None:
+                self.metrics.tick('recognize')
+                self.metrics.count('frames_recognized')
+                if not self._stop.is_set():
+                    self.results_ready.emit(results)
+            if gate is not None and gate.interval:
+                # still scene: back off, the capture thread keeps only the latest frame
+                self._stop.wait(gate.interval)
+
+# ---------- Offline attendance ----------
+
+def offline_units(inputs, stride, unit_frames=300, unit_images=20):
+    # Splits every input into independent work units: frame ranges of a
+    # video (each worker seeks to its own range) or chunks of an image
+    # folder. Unit ids are stable so interrupted runs can resume.
+    units = []
+    for src, path in enumerate(inputs):
+        if os.path.isdir(path):
+            files = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTS))
+            for i in range(0, len(files), unit_images):
+                units.append({'id': f'{path}#{i}', 'src': src, 'kind': 'images', 'path': path,
+                              'start': i, 'files': files[i:i + unit_images]})
+            continue
+        cap = cv2.VideoCapture(path)
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        # keep unit boundaries on the stride so every unit samples the same frames
+        step = max(stride, unit_frames // stride * stride)
+        if total <= 0:
+            units.append({'id': f'{path}#0', 'src': src, 'kind': 'video', 'path': path,
+                          'start': 0, 'end': None})
+        for i in range(0, max(total, 0), step):
+            units.append({'id': f'{path}#{i}', 'src': src, 'kind': 'video', 'path': path,
+                          'start': i, 'end': min(i + step, total)})
+    return units
+
+def iter_unit_frames(unit, stride):
+    # yields (position, label, BGR frame)
+    if unit['kind'] == 'images':
+        for i, name in enumerate(unit['files'], unit['start']):
+            if i % stride: continue
+            frame = cv2.imread(os.path.join(unit['path'], name))
+            if frame is not None:
+                yield i, name, frame
+        return
+    name = os.path.basename(unit['path'])
+    with VideoFileSource(unit['path'], start=unit['start'], stride=stride) as src:
+        while True:
+            ret, frame = src.read()
+            if not ret or (unit['end'] is not None and src.position >= unit['end']):
+                break
+            secs = int(src.position / src.source_fps)
+            yield src.position, f'{name}@{secs // 3600:02d}:{secs // 60 % 60:02d}:{secs % 60:02d}', frame
+
+def _offline_run_unit(args):
+    unit, stride = args
+    recognizer = _pool_state()['recognizer']
+    seen = {}
+    frames = 0
+    for pos, label, frame in iter_unit_frames(unit, stride):
+        frames += 1
+        for loc, uid, dist in recognizer.process(frame) or ():
+            if uid is None: continue
+            prev = seen.get(uid)
+            if prev is None:
+                seen[uid] = [unit['src'], pos, label, dist]
+            elif dist < prev[3]:
+                prev[3] = dist
+    return unit['id'], frames, seen
 
-DB_NAME = "face_recognition.db"
-CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+def merge_offline_seen(found, seen):
+    for uid, (src, pos, label, dist) in seen.items():
+        key = str(uid)
+        prev = found.get(key)
+        if prev is None:
+            found[key] = [src, pos, label, dist]
+            continue
+        if (src, pos) < (prev[0], prev[1]):
+            prev[:3] = [src, pos, label]
+        prev[3] = min(prev[3], dist)
 
-GLOBAL_STYLESHEET = """
-QMainWindow, QWidget {
-    background-color: #2E3440;
-    color: #ECEFF4;
-    font-family: Helvetica;
-    font-size: 13px;
-}
-QTabWidget::pane { border: none; }
-QTabBar::tab {
-    background: #3B4252;
-    color: #ECEFF4;
-    padding: 10px 20px;
-    font-size: 14px;
-    min-width: 120px;
-    min-height: 40px;
-}
-QTabBar::tab:selected {
-    background: #88C0D0;
-    color: #2E3440;
-}
-QPushButton {
-    background-color: #88C0D0;
-    color: #2E3440;
-    border: none;
-    border-radius: 5px;
-    padding: 8px 16px;
-    font-weight: bold;
-    font-size: 14px;
-    min-height: 36px;
-}
-QPushButton:hover {
-    background-color: #81A1C1;
-}
-QLineEdit, QComboBox, QListWidget, QTableWidget {
-    background-color: #3B4252;
-    border: 1px solid #4C566A;
-    border-radius: 4px;
-    selection-background-color: #88C0D0;
-    selection-color: #2E3440;
-    font-size: 13px;
-}
-QHeaderView::section {
-    background-color: #3B4252;
-    padding: 6px;
-    border: 1px solid #4C566A;
-    font-size: 13px;
-}
-"""
+def run_offline_attendance(batch_folder, inputs, stride=5, workers=None, checkpoint=None,
+                           resume=False, tolerance=0.5, log=print, detector='hog', dtype='float64'):
+    # Returns {uid: [source index, position, label, best distance]} for every
+    # student seen in the inputs.
+    units = offline_units(inputs, stride)
+    state = {'inputs': list(inputs), 'stride': stride, 'done': [], 'found': {}}
+    if resume and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            saved = json.load(f)
+        if saved.get('inputs') == state['inputs'] and saved.get('stride') == stride:
+            state = saved
+        else:
+            log('Checkpoint is for different inputs, starting over')
+    done = set(state['done'])
+    todo = [u for u in units if u['id'] not in done]
+    log(f'{len(units)} work units, {len(todo)} to do')
+    workers = workers or os.cpu_count() or 1
+    # a bad detector or gallery fails here rather than in every worker;
+    # each worker builds its matcher straight from the store, in the chosen precision
+    make_detector(detector)
+    GalleryMatcher.from_folder(batch_folder, tolerance, dtype)
+    t0 = time.perf_counter()
+    frames = 0
+    with worker_pool(workers, detector, gallery=(batch_folder, tolerance, dtype)) as pool:
+        for n, (uid, count, seen) in enumerate(
+                pool.imap_unordered(_offline_run_unit, [(u, stride) for u in todo]), 1):
+            frames += count
+            merge_offline_seen(state['found'], seen)
+            state['done'].append(uid)
+            if checkpoint:
+                write_json_atomic(checkpoint, state)
+            elapsed = time.perf_counter() - t0
+            log(f'[{n}/{len(todo)}] {uid}: {count} frames, '
+                f'{frames / max(elapsed, 1e-9):.1f} frames/s, {len(state["found"])} students seen')
+    return {int(k): v for k, v in state['found'].items()}
 
-def update_schema():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(time_slots)")
-    cols = [c[1] for c in cur.fetchall()]
-    if 'batch_id' not in cols:
-        cur.execute("ALTER TABLE time_slots ADD COLUMN batch_id INTEGER")
-        conn.commit()
-    conn.close()
-
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE IF NOT EXISTS admin (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL
-                   )''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS batch (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_id INTEGER,
-                    batch_name TEXT,
-                    UNIQUE(admin_id,batch_name),
-                    FOREIGN KEY(admin_id) REFERENCES admin(id)
-                   )''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS time_slots (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_id INTEGER,
-                    batch_id INTEGER,
-                    start_time TEXT,
-                    end_time TEXT,
-                    FOREIGN KEY(admin_id) REFERENCES admin(id)
-                   )''')
-    conn.commit()
-    conn.close()
-    update_schema()
+# ---------- Bulk enrolment ----------
+def _parse_student_stem(stem):
+    # '1234_Jane_Doe' or '1234_Jane_Doe_2' -> (1234, 'Jane Doe')
+    parts = stem.split('_')
+    if len(parts) < 2 or not parts[0].isdigit():
+        return None, None
+    if len(parts) > 2 and parts[-1].isdigit():
+        parts = parts[:-1]
+    return int(parts[0]), ' '.join(parts[1:])
 
-def get_admin_folder(username):
-    path = os.path.join('data', f'admin_{username}')
-    os.makedirs(path, exist_ok=True)
-    return path
+def collect_enrolment(source):
+    # Returns ({uid: {'name', 'images'}}, failures). `source` is a CSV
+    # manifest with id,name,image columns (one row per photo, or several
+    # photos separated by ';'), or a folder holding either <id>_<name>/
+    # sub-folders of photos or <id>_<name>[_n].jpg files.
+    students, failures = {}, []
 
-def get_batch_folder(admin_folder, batch_id, batch_name):
-    path = os.path.join(admin_folder, f'batch_{batch_id}_{batch_name}')
-    os.makedirs(os.path.join(path, 'users'), exist_ok=True)
-    return path
+    def add(uid, name, path):
+        st = students.setdefault(uid, {'name': name, 'images': []})
+        st['images'].append(path)
 
-def load_known_faces(batch_folder):
-    known = {}
-    user_dir = os.path.join(batch_folder, 'users')
-    if not os.path.isdir(user_dir):
-        return known
-    for uid in os.listdir(user_dir):
+    if os.path.isfile(source):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    uid = int(row['id'])
+                except (KeyError, TypeError, ValueError):
+                    failures.append((row.get('id', ''), '', 'ID must be numeric')); continue
+                for path in (row.get('image') or row.get('images') or '').split(';'):
+                    if path.strip():
+                        add(uid, (row.get('name') or '').strip(), os.path.join(base, path.strip()))
+        return students, failures
+    for entry in sorted(os.listdir(source)):
+        path = os.path.join(source, entry)
+        stem = os.path.splitext(entry)[0] if os.path.isfile(path) else entry
+        uid, name = _parse_student_stem(stem)
+        if os.path.isdir(path):
+            if uid is None:
+                failures.append(('', path, 'folder name is not <id>_<name>')); continue
+            for f in sorted(os.listdir(path)):
+                if f.lower().endswith(IMAGE_EXTS):
+                    add(uid, name, os.path.join(path, f))
+        elif entry.lower().endswith(IMAGE_EXTS):
+            if uid is None:
+                failures.append(('', path, 'file name is not <id>_<name>')); continue
+            add(uid, name, path)
+    return students, failures
+
+def _enrolment_image(path):
+    frame = cv2.imread(path)
+    if frame is None:
+        return None
+    # ID photos are often far larger than HOG needs
+    scale = min(1.0, 1024.0 / max(frame.shape[:2]))
+    return cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+
+def _encode_enrolment_photo(task):
+    uid, path = task
+    small = _enrolment_image(path)
+    if small is None:
+        return uid, path, None, None, 'unreadable image'
+    rgb = np.ascontiguousarray(small[:, :, ::-1])
+    locs = _pool_state()['detector'].locate(rgb)
+    if not locs:
+        return uid, path, None, None, 'no face'
+    if len(locs) > 1:
+        return uid, path, None, None, f'{len(locs)} faces'
+    enc = face_recognition.face_encodings(rgb, locs)
+    if not enc:
+        return uid, path, None, None, 'encoding failed'
+    top, right, bottom, left = locs[0]
+    return uid, path, enc[0], small[top:bottom, left:right].copy(), None
+
+def _encode_enrolment_remote(server, task):
+    # a thin client's photo: the recognition server detects and encodes it
+    uid, path = task
+    small = _enrolment_image(path)
+    if small is None:
+        return uid, path, None, None, 'unreadable image'
+    for _ in range(5):
         try:
-            u = int(uid)
-        except:
-            continue
-        info_file = os.path.join(user_dir, uid, 'info.txt')
-        enc_file = os.path.join(user_dir, uid, 'encoding.npy')
-        if os.path.exists(info_file) and os.path.exists(enc_file):
-            name = open(info_file).read().strip()
-            encoding = np.load(enc_file)
-            known[u] = {'name': name, 'encoding': encoding}
-    return known
+            faces = server.encode(small)
+            break
+        except ServerBusy as e:
+            time.sleep(e.retry_after)
+        except ServerError as e:
+            return uid, path, None, None, str(e)
+    else:
+        return uid, path, None, None, 'recognition server busy'
+    if not faces:
+        return uid, path, None, None, 'no face'
+    if len(faces) > 1:
+        return uid, path, None, None, f'{len(faces)} faces'
+    (top, right, bottom, left), enc = faces[0]
+    return uid, path, enc, small[top:bottom, left:right].copy(), None
+
+def encode_enrolment(students, workers=None, templates='mean', max_templates=5, progress=None,
+                     detector='hog', threads=False, server=None):
+    # Detects and encodes every photo on a process pool, or with a
+    # RecognitionClient `server` on that server, a few photos in flight.
+    # Returns (items for GalleryStore.add_many, failures, {uid: face crop}).
+    # templates='mean' stores the average of a student's photos,
+    # templates='set' keeps up to max_templates encodings per student.
+    # threads=True when called from a thread of the app (see worker_pool).
+    tasks = [(uid, path) for uid, st in students.items() for path in st['images']]
+    encs, crops, failures = {}, {}, []
+    if server is not None:
+        pool = ThreadPool(workers or 4)
+        work = pool.imap_unordered(lambda task: _encode_enrolment_remote(server, task), tasks)
+    else:
+        # a detector that cannot load fails here, not in every worker
+        make_detector(detector)
+        pool = worker_pool(workers or os.cpu_count() or 1, detector, threads=threads)
+        work = pool.imap_unordered(_encode_enrolment_photo, tasks, chunksize=4)
+    with pool:
+        for n, (uid, path, enc, crop, err) in enumerate(work, 1):
+            if err:
+                failures.append((uid, path, err))
+            else:
+                encs.setdefault(uid, []).append((path, enc))
+                crops.setdefault(uid, crop)
+            if progress:
+                progress(n, len(tasks))
+    items = []
+    for uid, st in students.items():
+        got = [e for _, e in sorted(encs.get(uid, []), key=lambda pe: pe[0])]
+        if not got:
+            failures.append((uid, '', 'no usable photo')); continue
+        if templates == 'set':
+            items.append((uid, st['name'], np.stack(got[:max_templates])))
+        else:
+            items.append((uid, st['name'], np.mean(got, axis=0)))
+    return items, failures, crops
+
+def commit_enrolment(store, items, crops, replace=False):
+    # one atomic manifest commit for the whole import
+    failures = []
+    if not replace:
+        failures = [(uid, '', 'already enrolled') for uid, _, _ in items if uid in store]
+        items = [it for it in items if it[0] not in store]
+    store.add_many(items)
+    crop_dir = os.path.join(store.folder, 'crops')
+    os.makedirs(crop_dir, exist_ok=True)
+    for uid, _, _ in items:
+        if uid in crops:
+            cv2.imwrite(os.path.join(crop_dir, f'{uid}.jpg'), crops[uid])
+    return items, failures
+
+class BulkEnrolJob(QObject):
+    # runs encode_enrolment off the GUI thread; the commit happens in the
+    # finished slot so all gallery writes stay on the GUI thread. finished
+    # carries the result, or None and the error message.
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(object, str)
+
+    def __init__(self, source, workers=None, templates='mean', detector='hog', server=None, parent=None):
+        super().__init__(parent)
+        self.source = source
+        self.workers = workers
+        self.templates = templates
+        self.detector = detector
+        self.server = server
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            students, failures = collect_enrolment(self.source)
+            items, more, crops = encode_enrolment(students, self.workers, self.templates,
+                                                  progress=self.progress.emit, detector=self.detector,
+                                                  threads=True, server=self.server)
+        except Exception as e:
+            self.finished.emit(None, f'{type(e).__name__}: {e}')
+            return
+        self.finished.emit((items, failures + more, crops), '')
+
+# ---------- Recognition server ----------
+class ServerError(Exception):
+    pass
+
+class ServerBusy(ServerError):
+    # 503: the queue was full or the frame waited longer than max_delay
+    def __init__(self, message, retry_after=0.1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _serve_frame(task):
+    # decode, detect (unless the client sent boxes) and encode one frame
+    kind, jpeg, boxes = task
+    frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    if boxes is None:
+        boxes = _pool_state()['detector'](frame)
+    if kind == 'detect' or not boxes:
+        return boxes, []
+    return boxes, face_recognition.face_encodings(np.ascontiguousarray(frame[:, :, ::-1]), boxes)
+
+class _ServeRequest:
+    __slots__ = ('kind', 'gallery', 'payload', 'boxes', 'encodings', 'matches', 't0',
+                 'done', 'status', 'result')
+
+    def __init__(self, kind, gallery, payload, boxes=None):
+        self.kind = kind
+        self.gallery = gallery
+        self.payload = payload
+        self.boxes = boxes
+        self.encodings = []
+        self.matches = None
+        self.t0 = time.perf_counter()
+        self.done = threading.Event()
+
+    def finish(self, status, result):
+        self.status = status
+        self.result = result
+        self.done.set()
+
+class _ServeHandler(BaseHTTPRequestHandler):
+    # JPEG in, JSON out. POST /detect, /encode (?boxes=t,r,b,l;... skips
+    # detection) and /recognize?admin=<username>&batch=<id>; POST /match
+    # takes {"encodings": [[128 floats], ...]} instead of an image.
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes; with Nagle on, every reply
+    # would wait out the client's delayed ACK
+    disable_nagle_algorithm = True
+    KINDS = {'/detect': 'detect', '/encode': 'encode', '/recognize': 'recognize', '/match': 'match'}
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, self.server.app.health())
+
+    def do_POST(self):
+        app = self.server.app
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        kind = self.KINDS.get(url.path)
+        if kind is None:
+            return self._reply(404, {'error': 'not found'})
+        q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        gallery = boxes = None
+        try:
+            if kind in ('recognize', 'match'):
+                gallery = (q['admin'], int(q['batch']))
+            if q.get('boxes'):
+                boxes = [tuple(int(v) for v in b.split(',')) for b in q['boxes'].split(';')]
+            payload = json.loads(body)['encodings'] if kind == 'match' else body
+        except (KeyError, ValueError, TypeError) as e:
+            return self._reply(400, {'error': f'bad request: {e}'})
+        item = _ServeRequest(kind, gallery, payload, boxes)
+        app.submit(item)
+        if not item.done.wait(app.max_delay + 60):
+            return self._reply(504, {'error': 'timed out'})
+        self._reply(item.status, item.result)
+
+class _ServeHTTP(ThreadingHTTPServer):
+    # every kiosk keeps a connection open; the default backlog of 5 resets
+    # connects under load
+    request_queue_size = 128
+    daemon_threads = True
+
+class RecognitionServer:
+    # Headless detect/encode/match for thin kiosks, on localhost by default.
+    # Handler threads only parse requests and queue them. One batcher thread
+    # takes whatever is queued, waiting up to max_wait_ms for max_batch
+    # frames, and spreads the batch over the worker pool; up to two batches
+    # are in flight. A finisher thread matches every face of a batch against
+    # each gallery with one matrix product and answers the requests.
+    # Backpressure: a full queue is answered 503 straight away, and a frame
+    # that waited longer than max_delay gets 503 instead of being processed,
+    # since a kiosk only wants fresh results.
+    def __init__(self, host='127.0.0.1', port=8765, detector='hog', detect_size=None, workers=None,
+                 max_batch=0, max_wait_ms=5.0, max_queue=64, max_delay=1.0,
+                 gallery_cache_mb=256, gallery_dtype='float64', tolerance=0.5):
+        self.host = host
+        self.port = port
+        self.detector = detector
+        self.detect_size = detect_size
+        self.workers = workers or encoder_workers()
+        self.max_batch = max_batch or 2 * self.workers
+        self.max_wait = max_wait_ms / 1000
+        self.max_delay = max_delay
+        self.gallery_dtype = gallery_dtype
+        self.tolerance = tolerance
+        self.galleries = GalleryCache(gallery_cache_mb, gallery_dtype, tolerance)
+        self.stats = {'requests': 0, 'rejected': 0, 'expired': 0, 'errors': 0,
+                      'batches': 0, 'frames': 0}
+        self._queue = queue.Queue(max_queue)
+        self._results = queue.Queue()
+        self._inflight = threading.Semaphore(2)
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        # finisher thread only
+        self._db = None
+        self._folders = {}   # (admin, batch id) -> folder
+        self._pool = None
+        self._threads = []
+        self.httpd = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        # a detector that cannot load fails here, before the pool exists
+        make_detector(self.detector)
+        # the pool forks before any thread or socket exists
+        if self.workers > 1:
+            self._pool = worker_pool(self.workers, self.detector, self.detect_size)
+        else:
+            _pool_init(self.detector, self.detect_size)
+            _pool_state()
+        self.httpd = _ServeHTTP((self.host, self.port), _ServeHandler)
+        self.httpd.app = self
+        self.port = self.httpd.server_address[1]
+        self._threads = [threading.Thread(target=self._batch_loop, daemon=True),
+                         threading.Thread(target=self._finish_loop, daemon=True),
+                         threading.Thread(target=self.httpd.serve_forever, daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def close(self):
+        self._stop.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        for t in self._threads:
+            t.join(timeout=2)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def health(self):
+        with self._stats_lock:
+            st = dict(self.stats)
+        st.update(queue=self._queue.qsize(), workers=self.workers, max_batch=self.max_batch,
+                  detector=self.detector, mean_batch=st['frames'] / max(st['batches'], 1))
+        return st
+
+    def submit(self, item):
+        self._count('requests')
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count('rejected')
+            item.finish(503, {'error': 'server busy', 'retry_ms': int(self.max_delay * 500)})
+
+    def _batch_loop(self):
+        while not self._stop.is_set():
+            # the next batch collects while the pool still works on this one
+            if not self._inflight.acquire(timeout=0.5):
+                continue
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                self._inflight.release()
+                continue
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                wait = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        now = time.perf_counter()
+        live = []
+        for item in batch:
+            if now - item.t0 > self.max_delay:
+                self._count('expired')
+                item.finish(503, {'error': 'frame expired in the queue',
+                                  'retry_ms': int(self.max_delay * 500)})
+            else:
+                live.append(item)
+        frames = [item for item in live if item.kind != 'match']
+        tasks = [(item.kind, item.payload, item.boxes) for item in frames]
+        if self._pool is not None and tasks:
+            self._pool.map_async(_serve_frame, tasks, chunksize=1,
+                                 callback=lambda out: self._results.put((live, frames, out, now)),
+                                 error_callback=lambda e: self._results.put((live, frames, e, now)))
+            return
+        try:
+            out = [_serve_frame(t) for t in tasks]
+        except Exception as e:
+            out = e
+        self._results.put((live, frames, out, now))
+
+    def _finish_loop(self):
+        # matching and replies; the only thread touching _gallery
+        while not self._stop.is_set():
+            try:
+                live, frames, out, started = self._results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                if isinstance(out, Exception):
+                    raise out
+                self._finish(live, frames, out, started)
+            except Exception as e:
+                for item in live:
+                    if not item.done.is_set():
+                        self._count('errors')
+                        item.finish(500, {'error': f'{type(e).__name__}: {e}'})
+            finally:
+                self._inflight.release()
+
+    def _gallery(self, admin, batch_id):
+        folder = self._folders.get((admin, batch_id))
+        if folder is None:
+            if self._db is None:
+                self._db = Database()
+            row = self._db.query("SELECT b.id, b.batch_name FROM batch b JOIN admin a ON a.id=b.admin_id "
+                                 "WHERE a.username=? AND b.id=?", (admin, batch_id))
+            if not row:
+                return None
+            folder = self._folders[(admin, batch_id)] = get_batch_folder(get_admin_folder(admin), *row[0])
+        return self.galleries.load(folder)
+
+    def _finish(self, live, frames, out, started):
+        for item, res in zip(frames, out):
+            if res is None:
+                item.finish(400, {'error': 'not a decodable image'})
+            else:
+                item.boxes, item.encodings = res
+        groups = {}
+        for item in live:
+            if item.kind == 'match':
+                item.encodings = item.payload
+            if item.kind in ('recognize', 'match') and not item.done.is_set():
+                groups.setdefault(item.gallery, []).append(item)
+        names = {}
+        for gallery, items in groups.items():
+            matcher = self._gallery(*gallery)
+            if matcher is None:
+                for item in items:
+                    item.finish(404, {'error': f'no batch {gallery[1]} for admin {gallery[0]}'})
+                continue
+            names[gallery] = matcher.records
+            matches = iter(matcher.match([enc for item in items for enc in item.encodings]))
+            for item in items:
+                item.matches = [next(matches) for _ in item.encodings]
+        for item in live:
+            if not item.done.is_set():
+                item.finish(200, self._response(item, names.get(item.gallery, {}), len(live), started))
+        if live:
+            self._count('batches')
+            self._count('frames', len(live))
+
+    @staticmethod
+    def _response(item, records, batch_size, started):
+        faces = []
+        for i in range(len(item.boxes) if item.kind != 'match' else len(item.encodings)):
+            face = {}
+            if item.kind != 'match':
+                face['box'] = [int(v) for v in item.boxes[i]]
+            if item.kind == 'encode':
+                face['encoding'] = [float(v) for v in item.encodings[i]]
+            if item.matches is not None:
+                uid, dist = item.matches[i]
+                face.update(id=uid, name=records[uid].name if uid in records else '', distance=dist)
+            faces.append(face)
+        return {'faces': faces, 'batch': batch_size, 'queue_ms': (started - item.t0) * 1000}
+
+class RecognitionClient:
+    # Talks to a RecognitionServer over one keep-alive connection per thread
+    # (every camera pipeline recognizes on its own thread). Frames are BGR
+    # arrays, or bytes that are already JPEG.
+    def __init__(self, url, timeout=10.0, quality=80):
+        parts = urlsplit(url if '://' in url else 'http://' + url)
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 8765
+        self.url = f'http://{self.host}:{self.port}'
+        self.timeout = timeout
+        self.quality = quality
+        self._local = threading.local()
+
+    def jpeg(self, frame):
+        if isinstance(frame, bytes):
+            return frame
+        ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buf.tobytes()
+
+    def _request(self, method, path, body=None, query=None, ctype='image/jpeg'):
+        if query:
+            path += '?' + urlencode(query)
+        headers = {'Content-Type': ctype} if body is not None else {}
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port,
+                                                                     timeout=self.timeout)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = json.loads(resp.read() or b'{}')
+                break
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                conn.close()
+                self._local.conn = None
+                # a kept-alive connection the server dropped fails once
+                if attempt:
+                    raise ServerError(f'Recognition server {self.url}: {e}') from e
+        if resp.status == 503:
+            raise ServerBusy(data.get('error', 'server busy'), data.get('retry_ms', 100) / 1000)
+        if resp.status != 200:
+            raise ServerError(f'Recognition server {self.url}: {data.get("error", resp.status)}')
+        return data
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def detect(self, frame):
+        return [tuple(f['box']) for f in self._request('POST', '/detect', self.jpeg(frame))['faces']]
+
+    def encode(self, frame, boxes=None):
+        query = {'boxes': ';'.join(','.join(map(str, b)) for b in boxes)} if boxes else None
+        faces = self._request('POST', '/encode', self.jpeg(frame), query)['faces']
+        return [(tuple(f['box']), np.array(f['encoding'])) for f in faces]
+
+    def recognize(self, frame, admin, batch_id):
+        faces = self._request('POST', '/recognize', self.jpeg(frame),
+                              {'admin': admin, 'batch': batch_id})['faces']
+        return [(tuple(f['box']), f['id'], f['distance']) for f in faces]
+
+    def match(self, encodings, admin, batch_id):
+        body = json.dumps({'encodings': [[float(v) for v in e] for e in encodings]}).encode()
+        faces = self._request('POST', '/match', body, {'admin': admin, 'batch': batch_id},
+                              'application/json')['faces']
+        return [(f['id'], f['distance']) for f in faces]
 
-def save_face_encoding(user_folder, encoding):
-    np.save(os.path.join(user_folder, 'encoding.npy'), encoding)
+class RemoteDetector(FaceDetector):
+    # a thin client's detector for enrolment, run by the server
+    name = 'remote'
+
+    def __init__(self, client):
+        self.client = client
+
+    def detect(self, rgb, upsample=1):
+        return self.client.detect(np.ascontiguousarray(rgb[:, :, ::-1]))
+
+class RemoteRecognizer:
+    # FaceRecognizer stand-in for thin kiosks: frames go to the server as
+    # JPEG. The FrameGate still runs here, so static frames are never sent.
+    # A busy server only means the last results hold a little longer; a
+    # server unreachable for give_up seconds ends the camera's session.
+    def __init__(self, client, admin, batch_id, metrics=METRICS_OFF, gate=None, give_up=5.0):
+        self.client = client
+        self.admin = admin
+        self.batch_id = batch_id
+        self.metrics = metrics
+        self.gate = gate
+        # detection runs on the server, so no local tracker or detection areas
+        self.tracker = None
+        self.detector = None
+        self.give_up = give_up
+        self._failing_since = None
+
+    def process(self, frame):
+        if self.gate is not None:
+            with self.metrics.stage('gate'):
+                changed = self.gate.changed(frame)
+            if not changed:
+                self.metrics.count('frames_static')
+                return None
+        try:
+            with self.metrics.stage('remote'):
+                results = self.client.recognize(frame, self.admin, self.batch_id)
+        except ServerBusy as e:
+            self.metrics.count('server_busy')
+            time.sleep(min(e.retry_after, 1.0))
+            return None
+        except ServerError:
+            now = time.monotonic()
+            if self._failing_since is None:
+                self._failing_since = now
+            if now - self._failing_since > self.give_up:
+                raise
+            self.metrics.count('server_errors')
+            time.sleep(0.5)
+            return None
+        self._failing_since = None
+        if self.metrics.enabled:
+            self.metrics.observe('faces_per_frame', len(results))
+        return results
+
+    def gallery_changed(self, uid=None):
+        # the server reloads the gallery itself once the store changes
+        if self.gate is not None:
+            self.gate.force()
+
+def run_load(send, frames, clients=4, duration=10.0, rate=None):
+    # Each client thread sends frames through `send` (one connection per
+    # thread) for `duration` seconds. Closed loop by default: the next
+    # frame goes as soon as the last is answered. With `rate` (requests/s
+    # over all clients) sends are paced instead, which is how overload and
+    # the server's backpressure show up. Busy answers are retried after the
+    # server's retry hint, as RemoteRecognizer does.
+    latencies, counts = [], {'ok': 0, 'busy': 0, 'errors': 0}
+    last_error = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    stop_at = start + duration
+
+    def client(k):
+        i, due = k, start + (k / rate if rate else 0)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                break
+            if rate:
+                if due > now:
+                    time.sleep(min(due - now, stop_at - now))
+                    continue
+                due += clients / rate
+            t = time.perf_counter()
+            try:
+                send(frames[i % len(frames)])
+                kind = 'ok'
+            except ServerBusy as e:
+                kind, backoff = 'busy', e.retry_after
+            except ServerError as e:
+                kind = 'errors'
+                last_error[:] = [str(e)]
+            ms = (time.perf_counter() - t) * 1000
+            with lock:
+                counts[kind] += 1
+                if kind == 'ok':
+                    latencies.append(ms)
+            if kind == 'busy':
+                time.sleep(min(backoff, max(stop_at - time.perf_counter(), 0)))
+            i += clients
+
+    threads = [threading.Thread(target=client, args=(k,), daemon=True) for k in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+    return dict(counts, clients=clients, rate=rate, seconds=elapsed,
+                requests=sum(counts.values()), throughput=counts['ok'] / elapsed,
+                p50_ms=float(p50), p95_ms=float(p95), p99_ms=float(p99), max_ms=float(lat.max()),
+                last_error=last_error[0] if last_error else None)
+
+# ---------- Warm-up ----------
+def warm_up(detector='hog', server=None):
+    # Loads the recognition stack ahead of the first session: the imports
+    # (face_recognition reads the dlib models), the detector, and one
+    # detection and encoding so first-call allocations are out of the way.
+    # A thin client only checks that its recognition server answers.
+    if server is not None:
+        with STARTUP.phase('server health'):
+            server.health()
+        return RemoteDetector(server)
+    for mod in (np, cv2, face_recognition):
+        LazyModule.resolve(mod)
+    with STARTUP.phase('detector'):
+        det = make_detector(detector)
+    with STARTUP.phase('first inference'):
+        blank = np.zeros((150, 150, 3), np.uint8)
+        det.detect(blank)
+        face_recognition.face_encodings(blank, [(0, 150, 150, 0)])
+    return det
+
+class WarmupJob(QObject):
+    # warm_up on a background thread; finished carries the detector, or
+    # the error message if the stack could not load
+    finished = pyqtSignal(object, str)
+
+    def __init__(self, detector='hog', server=None, parent=None):
+        super().__init__(parent)
+        self.detector = detector
+        self.server = server
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        t = time.perf_counter()
+        try:
+            det = warm_up(self.detector, self.server)
+        except Exception as e:
+            self.finished.emit(None, f'{type(e).__name__}: {e}')
+            return
+        STARTUP.add('warm-up', t)
+        self.finished.emit(det, '')
+
+# ---------- Detection areas ----------
+def fit_frame(frame, width, height):
+    h, w = frame.shape[:2]
+    s = min(width / w, height / h)
+    if s >= 1:
+        return frame
+    return cv2.resize(frame, (int(w * s), int(h * s)), interpolation=cv2.INTER_AREA)
+
+class RoiCanvas(QLabel):
+    # A still frame with the detection areas drawn on it; drag to add one.
+    def __init__(self, frame, rois, parent=None):
+        super().__init__(parent)
+        self.frame = fit_frame(frame, 800, 600)
+        self.rois = [list(r) for r in rois]
+        self.upsample = 1
+        self._drag = None
+        self.setFixedSize(self.frame.shape[1], self.frame.shape[0])
+        self.redraw()
+
+    def _fraction(self, pos):
+        return (min(max(pos.x() / self.width(), 0.0), 1.0),
+                min(max(pos.y() / self.height(), 0.0), 1.0))
+
+    def redraw(self, extra=None):
+        img = self.frame.copy()
+        h, w = img.shape[:2]
+        for i, (x, y, rw, rh, up) in enumerate(self.rois + ([extra] if extra else [])):
+            p0, p1 = (int(x * w), int(y * h)), (int((x + rw) * w), int((y + rh) * h))
+            cv2.rectangle(img, p0, p1, (255, 160, 0), 2)
+            cv2.putText(img, f'{i + 1}' + (' x2' if up > 1 else ''), (p0[0] + 4, p0[1] + 18),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 160, 0), 2)
+        self._img = img  # QImage does not copy the buffer
+        self.setPixmap(QPixmap.fromImage(QImage(img.data, w, h, 3 * w, QImage.Format_BGR888)))
+
+    def _rect(self, pos):
+        (x0, y0), (x1, y1) = self._drag, self._fraction(pos)
+        return [min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0), self.upsample]
+
+    def mousePressEvent(self, event):
+        self._drag = self._fraction(event.pos())
+
+    def mouseMoveEvent(self, event):
+        if self._drag:
+            self.redraw(self._rect(event.pos()))
+
+    def mouseReleaseEvent(self, event):
+        if not self._drag: return
+        rect = self._rect(event.pos())
+        self._drag = None
+        if rect[2] > 0.02 and rect[3] > 0.02:
+            self.rois.append(rect)
+        self.redraw()
+
+class RoiDialog(QDialog):
+    def __init__(self, frame, rois, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Detection Areas')
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel('Drag to add an area. Faces are only detected inside the areas; '
+                                'with none, the whole frame is used.'))
+        self.canvas = RoiCanvas(frame, rois)
+        layout.addWidget(self.canvas)
+        row = QHBoxLayout()
+        mode = QComboBox()
+        mode.addItems(['Normal faces', 'Small / distant faces (2x)'])
+        mode.currentIndexChanged.connect(lambda i: setattr(self.canvas, 'upsample', i + 1))
+        undo_btn = QPushButton('Remove Last')
+        clear_btn = QPushButton('Clear')
+        save_btn = QPushButton('Save')
+        for btn in (undo_btn, clear_btn, save_btn):
+            btn.setStyleSheet("background-color:#88C0D0; color:#2E3440;")
+        row.addWidget(mode); row.addWidget(undo_btn); row.addWidget(clear_btn); row.addWidget(save_btn)
+        layout.addLayout(row)
+        undo_btn.clicked.connect(lambda: (self.canvas.rois[-1:] and self.canvas.rois.pop(),
+                                          self.canvas.redraw()))
+        clear_btn.clicked.connect(lambda: (self.canvas.rois.clear(), self.canvas.redraw()))
+        save_btn.clicked.connect(self.accept)
+
+    def rois(self):
+        return [tuple(r) for r in self.canvas.rois]
 
 class FaceRecognitionApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, source='camera:0', source_fps=None, source_size=None,
+                 metrics=False, overlay=False, metrics_file=None, metrics_interval=10.0,
+                 encode_workers=None, gate=None, detect_size=None, refine=False, detector='hog',
+                 gallery_cache_mb=256, gallery_dtype='float64', server=None):
         super().__init__()
-        init_db()
+        with STARTUP.phase('database'):
+            self.db = Database()
+        # one capture/recognition pipeline per source in a session
+        self.source_specs = [source] if isinstance(source, str) else list(source)
+        self.source_fps = source_fps
+        self.source_size = source_size
+        # kept for the whole run so sessions don't pay for pool start-up
+        self.encoder = ParallelEncoder(encode_workers)
+        # FrameGate options, None recognizes every frame
+        self.gate_options = gate
+        # longest side detection runs at, None = full resolution
+        self.detect_size = detect_size
+        self.refine = refine
+        # the same backend finds faces for enrolment and attendance; the
+        # pipeline gets its own instance since DNN nets are not thread-safe.
+        # Built by the warm-up after login, None until then.
+        self.detector_spec = detector
+        self.face_detector = None
+        self.warmup = None
+        # thin client: detection, encoding and matching run on this server
+        self.server = RecognitionClient(server) if server else None
+        self.startup_timing = False
+        self.gallery_cache = GalleryCache(gallery_cache_mb, gallery_dtype, parent=self)
+        self.gallery_cache.loaded.connect(self._gallery_loaded)
+        self.gallery_cache.failed.connect(self._gallery_failed)
+        self.loading_batch = False
+        # the pending reload is of the running session's batch: keep its statuses
+        self._keep_attendance = False
+        self.metrics = Metrics(metrics or overlay or bool(metrics_file))
+        self.overlay = overlay
+        self.metrics_writer = None
+        if metrics_file:
+            self.metrics_writer = MetricsWriter(self.metrics, metrics_file, metrics_interval)
+            self.metrics_writer.start()
         self.admin_info = None
         self.batches = []
+        # {uid: {'name'}} of the current batch; the encodings live only in
+        # its matcher, the gallery cache's compact copy
         self.known_faces = {}
+        # created at login, it is the first thing that needs numpy
+        self.gallery_dtype = gallery_dtype
+        self.matcher = None
         self.attendance = {}
         self.selected_batch = None
         self.selected_slot = None
+        self.selected_slot_label = None
+        self.recorder = None
         self.admin_folder = None
         self.batch_folder = None
-        self.cap = None
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
+        self.store = None
+        self.ann_index = None
+        # built in the background when all batches are first recognised;
+        # gallery writes during a build make it start over
+        self.index_job = None
+        self.index_writes = 0
+        self.gate_matcher = None
+        self.pipelines = []
+        self.face_boxes = {}
+        self._failed = set()
 
         self.setWindowTitle('Edumark: Face Recognition Attendance')
         self.setGeometry(200, 100, 1000, 700)
-        self._setup_ui()
+        with STARTUP.phase('build UI'):
+            self._setup_ui()
 
     def _setup_ui(self):
         app = QApplication.instance()
@@ -204,23 +4101,86 @@ class FaceRecognitionApp(QMainWindow):
     def login(self):
         uname = self.username_input.text().strip()
         pwd = self.password_input.text().strip()
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id,name,username FROM admin WHERE username=? AND password=?",
-            (uname, pwd)
-        )
-        row = cur.fetchone()
-        conn.close()
+        row = self.db.find_admin(uname, pwd)
         if row:
             self.admin_info = row
             QMessageBox.information(self, 'Success', f'Welcome {row[1]}')
             self.admin_folder = get_admin_folder(row[2])
+            self.ann_index = None
+            # batches that still have their own gallery move into the identity store
+            migrate_identities(self.admin_folder)
+            self._start_warmup()
+            if self.all_batches_cb.isChecked():
+                self._start_index()
+            if self.matcher is None:
+                self.matcher = GalleryMatcher(dtype=self.gallery_dtype)
             self._refresh_batches()
             self.stack.setCurrentWidget(self.dashboard_widget)
+            # load the other batches in the background so switching is instant
+            self.gallery_cache.prewarm(get_batch_folder(self.admin_folder, bid, name)
+                                       for bid, name in self.batches[1:])
         else:
             QMessageBox.warning(self, 'Error', 'Invalid credentials')
 
+    def _start_warmup(self):
+        if self.face_detector is not None or self.warmup is not None: return
+        self.statusBar().showMessage('Loading face recognition...')
+        self.warmup = WarmupJob(self.detector_spec, self.server, self)
+        self.warmup.finished.connect(self._warmed)
+        self.warmup.start()
+
+    def _warmed(self, detector, error):
+        self.warmup = None
+        if self.startup_timing:
+            STARTUP.add('to recognition ready', STARTUP.t0)
+            print(STARTUP.report())
+            if error:
+                print(f'Warm-up failed: {error}')
+            QApplication.instance().quit()
+            return
+        if error:
+            # _batch_ready retries on the next attempt
+            self.statusBar().showMessage(f'Face recognition failed to load: {error}')
+            return
+        self.face_detector = detector
+        if not self.loading_batch:
+            self.statusBar().showMessage('Face recognition ready', 3000)
+
+    def _start_index(self):
+        if self.ann_index is not None or self.index_job is not None or self.server is not None: return
+        self.statusBar().showMessage('Building the all-batches index...')
+        self.index_job = AdminIndexJob(self.admin_folder, self.gallery_dtype, self)
+        self.index_job.writes = self.index_writes
+        self.index_job.finished.connect(self._index_built)
+        self.index_job.start()
+
+    def _index_built(self, index, error):
+        job, self.index_job = self.index_job, None
+        if error:
+            self.statusBar().showMessage(f'Could not build the all-batches index: {error}')
+            return
+        if job.admin_folder != self.admin_folder or job.writes != self.index_writes:
+            # another admin logged in, or a gallery changed after the build read it
+            self._start_index()
+            return
+        self.ann_index = index
+        self.statusBar().showMessage('All-batches index ready', 3000)
+
+    def _all_batches_toggled(self, on):
+        if on and self.admin_info:
+            self._start_index()
+
+    def _index_edited(self):
+        self.index_writes += 1
+
+    def time_startup(self, shown):
+        # --startup-timing: runs once the event loop is up, then warms up
+        # as a login would and prints the phases when that finishes
+        STARTUP.add('first event loop', shown)
+        STARTUP.add('to login window', STARTUP.t0)
+        self.startup_timing = True
+        self._start_warmup()
+
     def register(self):
         dlg = QDialog(self)
         dlg.setWindowTitle('Register Admin')
@@ -242,14 +4202,7 @@ class FaceRecognitionApp(QMainWindow):
             name, uname, pwd = name_in.text(), user_in.text(), pwd_in.text()
             if name and uname and pwd:
                 try:
-                    conn = sqlite3.connect(DB_NAME)
-                    cur = conn.cursor()
-                    cur.execute(
-                        "INSERT INTO admin(name,username,password) VALUES(?,?,?)",
-                        (name, uname, pwd)
-                    )
-                    conn.commit()
-                    conn.close()
+                    self.db.add_admin(name, uname, pwd)
                     QMessageBox.information(self, 'Success', 'Registered Successfully')
                 except sqlite3.IntegrityError:
                     QMessageBox.warning(self, 'Error', 'Username already exists')
@@ -305,11 +4258,7 @@ class FaceRecognitionApp(QMainWindow):
 
     def _refresh_batches(self):
         self.batch_combo.clear()
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-        cur.execute("SELECT id,batch_name FROM batch WHERE admin_id=?", (self.admin_info[0],))
-        self.batches = cur.fetchall()
-        conn.close()
+        self.batches = self.db.batches(self.admin_info[0])
         for bid, name in self.batches:
             self.batch_combo.addItem(name, bid)
         if self.batches:
@@ -319,12 +4268,7 @@ class FaceRecognitionApp(QMainWindow):
         text, ok = QInputDialog.getText(self, 'Add Batch', 'Batch Name:')
         if ok and text:
             try:
-                conn = sqlite3.connect(DB_NAME)
-                cur = conn.cursor()
-                cur.execute("INSERT INTO batch(admin_id,batch_name) VALUES(?,?)",
-                            (self.admin_info[0], text))
-                conn.commit()
-                conn.close()
+                self.db.add_batch(self.admin_info[0], text)
                 self._refresh_batches()
             except sqlite3.IntegrityError:
                 QMessageBox.warning(self, 'Error', 'Batch exists')
@@ -335,11 +4279,13 @@ class FaceRecognitionApp(QMainWindow):
         bid = self.batch_combo.itemData(idx)
         name = self.batch_combo.currentText()
         if QMessageBox.question(self, 'Confirm', f'Delete batch {name}?') == QMessageBox.Yes:
-            conn = sqlite3.connect(DB_NAME)
-            cur = conn.cursor()
-            cur.execute("DELETE FROM batch WHERE id=?", (bid,))
-            conn.commit(); conn.close()
-            shutil.rmtree(get_batch_folder(self.admin_folder, bid, name), ignore_errors=True)
+            self.db.delete_batch(bid)
+            folder = get_batch_folder(self.admin_folder, bid, name)
+            GalleryStore(folder).destroy()
+            self.gallery_cache.invalidate(folder)
+            self._index_edited()
+            if self.ann_index:
+                self.ann_index.remove_batch(os.path.basename(folder))
             self._refresh_batches()
 
     def change_batch(self, idx):
@@ -347,11 +4293,59 @@ class FaceRecognitionApp(QMainWindow):
         bid, name = self.batches[idx]
         self.selected_batch = (bid, name)
         self.batch_folder = get_batch_folder(self.admin_folder, bid, name)
-        self.known_faces = load_known_faces(self.batch_folder)
-        self.attendance = {uid: 'Absent' for uid in self.known_faces}
-        self._refresh_attendance_table()
-        self._refresh_user_list()
+        self.store = GalleryStore(self.batch_folder)
         self._refresh_timeslot_list()
+        matcher = self.gallery_cache.get(self.batch_folder)
+        self.loading_batch = matcher is None
+        self._keep_attendance = False
+        if self.loading_batch:
+            # shown empty until the background load lands in _gallery_loaded
+            self.statusBar().showMessage(f'Loading {name}...')
+            self.gallery_cache.request(self.batch_folder)
+            matcher = GalleryMatcher(dtype=self.gallery_dtype)
+        self._show_gallery(matcher)
+
+    def _gallery_loaded(self, folder, matcher):
+        if folder != self.batch_folder: return
+        self.loading_batch = False
+        self.store = GalleryStore(folder)
+        self._show_gallery(matcher, self._keep_attendance)
+        self._keep_attendance = False
+        self.statusBar().clearMessage()
+
+    def _gallery_failed(self, folder, error):
+        if folder != self.batch_folder: return
+        self.loading_batch = self._keep_attendance = False
+        self.statusBar().showMessage(f'Could not load {self.selected_batch[1]}: {error}')
+
+    def _show_gallery(self, matcher, keep=False):
+        # keep: a reload of the same batch, statuses and manual overrides stay
+        known = {uid: {'name': rec.name} for uid, rec in matcher.records.items()}
+        self.known_faces = known
+        self.matcher = matcher
+        for pipeline in self.pipelines:
+            if isinstance(pipeline.recognizer, FaceRecognizer) and not self.gate_matcher:
+                pipeline.recognizer.matcher = matcher
+        if keep:
+            for uid in known.keys() - self.attendance.keys():
+                if self.recorder:
+                    self.recorder.add(uid, known[uid]['name'])
+            self.attendance = {uid: self.attendance.get(uid, 'Absent') for uid in self.known_faces}
+        else:
+            self.attendance = {uid: 'Absent' for uid in self.known_faces}
+        self._refresh_attendance_table(keep)
+        self._refresh_user_list()
+        for pipeline in self.pipelines:
+            pipeline.recognizer.gallery_changed()
+
+    def _batch_ready(self):
+        if self.face_detector is None:
+            self._start_warmup()
+            QMessageBox.information(self, 'Please wait', 'Face recognition is still loading')
+            return False
+        if self.loading_batch:
+            QMessageBox.information(self, 'Please wait', 'The batch is still loading')
+        return self.selected_batch is not None and not self.loading_batch
 
     # ---------- Attendance ----------
     def _build_attendance_ui(self, parent):
@@ -360,88 +4354,282 @@ class FaceRecognitionApp(QMainWindow):
         start_btn = QPushButton('Start Attendance')
         stop_btn = QPushButton('Stop Attendance')
         export_btn = QPushButton('Export CSV')
-        for btn in (start_btn, stop_btn, export_btn):
+        report_btn = QPushButton('Report')
+        roi_btn = QPushButton('Detection Areas')
+        for btn in (start_btn, stop_btn, export_btn, report_btn, roi_btn):
             btn.setStyleSheet("background-color:#88C0D0; color:#2E3440;")
+        self.all_batches_cb = QCheckBox('Recognise all batches')
+        self.all_batches_cb.toggled.connect(self._all_batches_toggled)
         ctrl.addWidget(start_btn); ctrl.addWidget(stop_btn); ctrl.addWidget(export_btn)
+        ctrl.addWidget(report_btn); ctrl.addWidget(roi_btn)
+        ctrl.addWidget(self.all_batches_cb)
         layout.addLayout(ctrl)
         start_btn.clicked.connect(self.select_and_start)
         stop_btn.clicked.connect(self.stop_attendance)
         export_btn.clicked.connect(self.export_csv)
+        report_btn.clicked.connect(self.export_report)
+        roi_btn.clicked.connect(self.edit_rois)
+        if self.server is not None:
+            # the server detects on whole frames
+            roi_btn.setEnabled(False)
+            roi_btn.setToolTip('Detection areas only apply to local recognition, not with --server')
 
         content = QHBoxLayout()
-        self.video_label = QLabel(); self.video_label.setFixedSize(640, 480)
-        content.addWidget(self.video_label)
-        self.att_table = QTableWidget(0, 3)
-        self.att_table.setHorizontalHeaderLabels(['ID', 'Name', 'Status'])
+        # one preview tile per camera, laid out in a grid inside 640x480
+        self.video_grid = QWidget(); self.video_grid.setFixedSize(640, 480)
+        self.video_layout = QGridLayout(self.video_grid)
+        self.video_layout.setContentsMargins(0, 0, 0, 0)
+        self.video_layout.setSpacing(2)
+        self.video_labels = []
+        content.addWidget(self.video_grid)
+        self.att_model = AttendanceModel(self)
+        self.att_model.status_edited.connect(self._status_edited)
+        self.att_table = QTableView()
+        self.att_table.setModel(self.att_model)
+        self.att_table.setItemDelegateForColumn(2, StatusDelegate(self.att_table))
         self.att_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.att_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.att_table.verticalHeader().hide()
+        self.att_table.setEditTriggers(QAbstractItemView.AllEditTriggers)
         content.addWidget(self.att_table)
         layout.addLayout(content)
 
     def select_and_start(self):
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, start_time || ' - ' || end_time FROM time_slots "
-            "WHERE admin_id=? AND batch_id=?",
-            (self.admin_info[0], self.selected_batch[0])
-        )
-        slots = cur.fetchall()
-        conn.close()
+        if not self._batch_ready(): return
+        if self.all_batches_cb.isChecked() and self.server is None and self.ann_index is None:
+            self._start_index()
+            QMessageBox.information(self, 'Please wait', 'The all-batches index is still building'); return
+        slots = self.db.time_slots(self.admin_info[0], self.selected_batch[0])
         if not slots:
             QMessageBox.warning(self, 'Error', 'No time slots defined'); return
         items = [s[1] for s in slots]
         sel, ok = QInputDialog.getItem(self, 'Select Time Slot', 'Time Slot:', items, 0, False)
         if ok:
             idx = items.index(sel)
+            self.stop_attendance()
             self.selected_slot = slots[idx][0]
+            self.selected_slot_label = sel
             self.attendance = {uid: 'Absent' for uid in self.known_faces}
             self._refresh_attendance_table()
-            self.cap = cv2.VideoCapture(0)
-            self.timer.start(30)
+            roster = [(uid, d['name']) for uid, d in self.known_faces.items()]
+            session = self.db.start_session(self.admin_info[0], self.selected_batch[0],
+                                            self.selected_slot, sel, roster)
+            self.recorder = AttendanceRecorder(self.db, session, roster)
+            matcher = self.matcher
+            if self.server is not None and any(self.db.rois(self.admin_info[0], self.selected_batch[0], spec)
+                                               for spec in self.source_specs):
+                QMessageBox.information(self, 'Recognition server',
+                                        'Detection areas only apply to local recognition; '
+                                        'the server looks at whole frames')
+            if self.all_batches_cb.isChecked() and self.server is not None:
+                QMessageBox.information(self, 'Recognition server',
+                                        'Recognising all batches needs local recognition; '
+                                        'using the selected batch')
+            elif self.all_batches_cb.isChecked():
+                matcher = self.gate_matcher = IndexMatcher(self.ann_index)
+            self.metrics.reset()
+            self._make_video_tiles(len(self.source_specs))
+            # Each camera gets its own capture and recognition threads, tracker,
+            # gate and detector; the matcher, encoder pool and attendance state
+            # are shared. Results are merged on the GUI thread by student id.
+            for cam, spec in enumerate(self.source_specs):
+                source = open_source(spec, self.source_fps, self.source_size, mirror=True)
+                gate = FrameGate(**self.gate_options) if self.gate_options is not None else None
+                if self.server is not None:
+                    recognizer = RemoteRecognizer(self.server, self.admin_info[2],
+                                                  self.selected_batch[0], self.metrics, gate)
+                else:
+                    rois = self.db.rois(self.admin_info[0], self.selected_batch[0], spec)
+                    detector = RegionDetector(rois, self.detect_size, refine=self.refine,
+                                              locate=make_detector(self.detector_spec))
+                    recognizer = FaceRecognizer(matcher, FaceTracker(), self.metrics, self.encoder,
+                                                gate, detector)
+                pipeline = FramePipeline(recognizer, source, self.metrics)
+                pipeline.frame_ready.connect(lambda cam=cam: self.update_frame(cam))
+                pipeline.results_ready.connect(lambda results, cam=cam: self.apply_results(cam, results))
+                pipeline.failed.connect(lambda msg, cam=cam: self._pipeline_failed(cam, msg))
+                self.pipelines.append(pipeline)
+            self._failed = set()
+            for pipeline in self.pipelines:
+                pipeline.start()
 
-    def update_frame(self):
-        ret, frame = self.cap.read()
-        if not ret: return
-        frame = cv2.flip(frame, 1)
-        rgb = frame[:, :, ::-1]
-        locs = face_recognition.face_locations(rgb)
-        encs = face_recognition.face_encodings(rgb, locs)
-        for loc, enc in zip(locs, encs):
+    def _make_video_tiles(self, n):
+        for label in self.video_labels:
+            self.video_layout.removeWidget(label)
+            label.deleteLater()
+        cols = int(np.ceil(np.sqrt(n)))
+        rows = int(np.ceil(n / cols))
+        w = (self.video_grid.width() - 2 * (cols - 1)) // cols
+        h = (self.video_grid.height() - 2 * (rows - 1)) // rows
+        self.video_labels = []
+        for i in range(n):
+            label = QLabel(); label.setFixedSize(w, h)
+            self.video_layout.addWidget(label, i // cols, i % cols)
+            self.video_labels.append(label)
+
+    def edit_rois(self):
+        if not self.selected_batch: return
+        if self.server is not None:
+            QMessageBox.information(self, 'Detection Areas',
+                                    'Detection areas only apply to local recognition, not with a '
+                                    'recognition server'); return
+        if self.pipelines:
+            QMessageBox.warning(self, 'Error', 'Stop attendance before editing detection areas'); return
+        spec = self.source_specs[0]
+        if len(self.source_specs) > 1:
+            spec, ok = QInputDialog.getItem(self, 'Detection Areas', 'Camera:', self.source_specs, 0, False)
+            if not ok: return
+        with open_source(spec, size=self.source_size, mirror=True) as src:
+            ok, frame = src.read()
+        if not ok:
+            QMessageBox.warning(self, 'Error', f'Could not read a frame from {spec}'); return
+        # areas are saved for this batch and this camera/source
+        admin_id, batch_id = self.admin_info[0], self.selected_batch[0]
+        current = self.db.rois(admin_id, batch_id, spec, inherited=False)
+        dlg = RoiDialog(frame, current, self)
+        if dlg.exec_() == QDialog.Accepted:
+            self.db.set_rois(admin_id, batch_id, spec, dlg.rois())
+
+    def update_frame(self, cam=0):
+        if cam >= len(self.pipelines): return
+        pipeline = self.pipelines[cam]
+        frame = pipeline.latest_frame()
+        if frame is None: return
+        self.metrics.tick('display')
+        label = self.video_labels[cam]
+        with self.metrics.stage('convert'):
+            # Shrink first and draw on the thumbnail: cheaper than copying and
+            # drawing on the full frame, and the worker may still be reading it.
+            h, w = frame.shape[:2]
+            s = min(label.width() / w, label.height() / h, 1.0)
+            if s < 1:
+                thumb = cv2.resize(frame, (int(w * s), int(h * s)), interpolation=cv2.INTER_AREA)
+            else:
+                thumb = frame.copy()
+            detector = pipeline.recognizer.detector
+            if detector is not None and detector.rois:
+                for x0, y0, x1, y1, _ in detector.regions(frame.shape):
+                    cv2.rectangle(thumb, (int(x0 * s), int(y0 * s)), (int(x1 * s), int(y1 * s)),
+                                  (255, 160, 0), 1)
+            font = max(0.4, 0.8 * s)
+            for (top, right, bottom, left), name in self.face_boxes.get(cam, ()):
+                top, right, bottom, left = (int(v * s) for v in (top, right, bottom, left))
+                cv2.rectangle(thumb, (left, top), (right, bottom), (0, 255, 0), 2)
+                cv2.putText(thumb, name, (left, top - 6), cv2.FONT_HERSHEY_SIMPLEX, font, (200, 200, 200), 1)
+            if self.overlay and cam == 0:
+                self._draw_overlay(thumb)
+            h, w, _ = thumb.shape
+            img = QImage(thumb.data, w, h, 3*w, QImage.Format_BGR888)
+            label.setPixmap(QPixmap.fromImage(img))
+
+    def _draw_overlay(self, frame):
+        # worker threads keep recording, so read one consistent snapshot
+        snap = self.metrics.snapshot()
+        hists, fps = snap['stages_ms'], snap['fps']
+        stages = '  '.join(
+            f"{k} {hists[k]['p95']:.1f}"
+            for k in ('capture', 'detect', 'encode', 'match', 'convert', 'table')
+            if k in hists and hists[k]['count'])
+        lines = [
+            f"Display {fps.get('display', 0.0):.1f} fps  "
+            f"Recognition {fps.get('recognize', 0.0):.1f} fps  "
+            f"Dropped {snap['counters'].get('frames_dropped', 0)}",
+            f'p95 ms: {stages}',
+            f"Cameras {len(self.pipelines)}  "
+            f"Faces {sum(len(b) for b in self.face_boxes.values())}  "
+            f"Gallery {snap['gauges'].get('gallery_size', 0)}",
+        ]
+        gates = [p.recognizer.gate for p in self.pipelines if p.recognizer.gate is not None]
+        if gates:
+            g = self._sum_stats(gates)
+            lines.append(f"Static skipped {g['static_frames']}  "
+                         f"Faces gated {g['small_faces'] + g['blurry_faces']}  "
+                         f"Wait {max(x.interval for x in gates) * 1000:.0f} ms")
+        for i, text in enumerate(lines):
+            y = 20 + 20 * i
+            cv2.putText(frame, text, (8, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 3)
+            cv2.putText(frame, text, (8, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+
+    def apply_results(self, cam, results):
+        if cam >= len(self.pipelines): return
+        with self.metrics.stage('table'):
+            self._apply_results(cam, results)
+        self._show_tracking_stats()
+
+    def _apply_results(self, cam, results):
+        # set_status and recorder.seen are keyed by student, so a student seen
+        # by several cameras is still one row and one attendance event
+        boxes = []
+        for loc, uid, dist in results:
             name = 'Unknown'
-            for uid, data in self.known_faces.items():
-                if face_recognition.compare_faces([data['encoding']], enc, tolerance=0.5)[0]:
-                    name = data['name']
-                    self.attendance[uid] = 'Present'
-                    break
-            top, right, bottom, left = loc
-            cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-            cv2.putText(frame, name, (left, top-10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200,200,200), 2)
-        h, w, _ = frame.shape
-        img = QImage(frame.data, w, h, 3*w, QImage.Format_BGR888)
-        self.video_label.setPixmap(QPixmap.fromImage(img))
-        self._refresh_attendance_table()
+            if isinstance(uid, tuple):
+                # all-batches index: a student of another batch is only named
+                key, uid = uid, uid[1] if uid[0] == os.path.basename(self.batch_folder) else None
+                if uid is None and self.gate_matcher:
+                    name = self.gate_matcher.names.get(key, name)
+            # the user may have been deleted while the worker was busy
+            if uid is not None and uid in self.known_faces:
+                name = self.known_faces[uid]['name']
+                self.att_model.set_status(uid, 'Present')
+                if self.recorder:
+                    self.recorder.seen(uid, dist)
+            boxes.append((loc, name))
+        self.face_boxes[cam] = boxes
+
+    @staticmethod
+    def _sum_stats(parts):
+        total = {}
+        for part in parts:
+            for k, v in part.stats.items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    def _show_tracking_stats(self):
+        trackers = [p.recognizer.tracker for p in self.pipelines if p.recognizer.tracker is not None]
+        if not trackers: return
+        st = self._sum_stats(trackers)
+        msg = (f"Frames: {st['frames']}  Detections: {st['detections']}  "
+               f"Encoded faces: {st['encoded_faces']}  "
+               f"Frames reusing cached identities: {st['cached_frames']}")
+        gates = [p.recognizer.gate for p in self.pipelines if p.recognizer.gate is not None]
+        if gates:
+            g = self._sum_stats(gates)
+            msg += (f"  Static frames skipped: {g['static_frames']}/{g['frames']}"
+                    f"  Small/blurry faces skipped: {g['small_faces']}/{g['blurry_faces']}")
+        self.statusBar().showMessage(msg)
+
+    def _pipeline_failed(self, cam, msg):
+        # one camera failing leaves the others running; the session ends with the last
+        if cam >= len(self.pipelines): return
+        self._failed.add(cam)
+        self.pipelines[cam].stop()
+        self.face_boxes.pop(cam, None)
+        self.video_labels[cam].clear()
+        if len(self._failed) < len(self.pipelines):
+            self.statusBar().showMessage(f'{self.source_specs[cam]}: {msg}')
+            return
+        self.stop_attendance()
+        QMessageBox.warning(self, 'Error', msg)
 
     def stop_attendance(self):
-        if self.cap:
-            self.timer.stop()
-            self.cap.release()
-            self.cap = None
-            self.video_label.clear()
-
-    def _refresh_attendance_table(self):
-        self.att_table.setRowCount(0)
-        for uid, status in self.attendance.items():
-            r = self.att_table.rowCount()
-            self.att_table.insertRow(r)
-            self.att_table.setItem(r, 0, QTableWidgetItem(str(uid)))
-            self.att_table.setItem(r, 1, QTableWidgetItem(self.known_faces[uid]['name']))
-            cb = QComboBox()
-            cb.addItems(['Present', 'Absent'])
-            cb.setCurrentText(status)
-            cb.currentTextChanged.connect(lambda s, uid=uid: self.attendance.__setitem__(uid, s))
-            self.att_table.setCellWidget(r, 2, cb)
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        if self.pipelines:
+            for pipeline in self.pipelines:
+                pipeline.stop()
+            self.pipelines = []
+            self.gate_matcher = None
+            self.face_boxes = {}
+            for label in self.video_labels:
+                label.clear()
+
+    def _status_edited(self, uid, status):
+        if self.recorder:
+            self.recorder.set_status(uid, status, manual=True)
+
+    def _refresh_attendance_table(self, keep_manual=False):
+        self.att_model.reset(self.known_faces, self.attendance,
+                             self.att_model.manual if keep_manual else ())
 
     def export_csv(self):
         if not self.selected_slot:
@@ -457,27 +4645,119 @@ class FaceRecognitionApp(QMainWindow):
             for uid, status in self.attendance.items():
                 writer.writerow([
                     now,
-                    self.selected_slot,
+                    self.selected_slot_label,
                     uid,
                     self.known_faces[uid]['name'],
                     status
                 ])
         QMessageBox.information(self, 'Export Success', f'Saved to {path}')
 
+    def export_report(self):
+        dlg = QDialog(self)
+        dlg.setWindowTitle('Attendance Report')
+        form = QFormLayout(dlg)
+        today = datetime.now()
+        from_in = QLineEdit(today.strftime('%Y-%m-01'))
+        to_in = QLineEdit(today.strftime('%Y-%m-%d'))
+        scope = QComboBox(); scope.addItems(['Current batch', 'All batches'])
+        kind = QComboBox(); kind.addItems(['Per session', 'Per student summary'])
+        form.addRow('From (YYYY-MM-DD):', from_in)
+        form.addRow('To (YYYY-MM-DD):', to_in)
+        form.addRow('Batches:', scope)
+        form.addRow('Report:', kind)
+        btns = QHBoxLayout()
+        ok = QPushButton('OK'); cancel = QPushButton('Cancel')
+        ok.clicked.connect(dlg.accept)
+        cancel.clicked.connect(dlg.reject)
+        btns.addWidget(ok); btns.addWidget(cancel)
+        form.addRow(btns)
+        if dlg.exec_() != QDialog.Accepted: return
+        path, _ = QFileDialog.getSaveFileName(
+            self, 'Save Report', f'attendance_report_{today:%Y-%m-%d}.csv',
+            'CSV Files (*.csv);;Parquet Files (*.parquet)'
+        )
+        if not path: return
+        if self.recorder:
+            self.recorder.flush()
+        batch_ids = [self.selected_batch[0]] if scope.currentIndex() == 0 and self.selected_batch else None
+        try:
+            n = export_attendance_report(self.db, path, self.admin_info[0],
+                                         from_in.text().strip() or None,
+                                         to_in.text().strip() or None,
+                                         batch_ids, kind.currentIndex() == 1)
+        except ImportError:
+            QMessageBox.warning(self, 'Error', 'Parquet export needs pyarrow'); return
+        except Exception as e:
+            QMessageBox.warning(self, 'Error', f'Could not export the report: {e}'); return
+        QMessageBox.information(self, 'Export Success', f'Saved {n} rows to {path}')
+
     # ---------- User Management ----------
     def _build_user_ui(self, parent):
         layout = QVBoxLayout(parent)
         btns = QHBoxLayout()
         add_btn = QPushButton('Register User')
         del_btn = QPushButton('Delete User')
-        for btn in (add_btn, del_btn):
+        self.bulk_btn = QPushButton('Bulk Import')
+        for btn in (add_btn, del_btn, self.bulk_btn):
             btn.setStyleSheet("background-color:#88C0D0; color:#2E3440;")
-        btns.addWidget(add_btn); btns.addWidget(del_btn)
+        btns.addWidget(add_btn); btns.addWidget(del_btn); btns.addWidget(self.bulk_btn)
         layout.addLayout(btns)
         self.user_list = QListWidget()
         layout.addWidget(self.user_list)
         add_btn.clicked.connect(self.register_user)
         del_btn.clicked.connect(self.delete_user)
+        self.bulk_btn.clicked.connect(self.bulk_import)
+
+    def bulk_import(self):
+        if not self._batch_ready(): return
+        kinds = ['Photo folder', 'CSV manifest']
+        kind, ok = QInputDialog.getItem(self, 'Bulk Import', 'Import from:', kinds, 0, False)
+        if not ok: return
+        if kind == kinds[0]:
+            source = QFileDialog.getExistingDirectory(self, 'Photo folder')
+        else:
+            source, _ = QFileDialog.getOpenFileName(self, 'CSV manifest', '', 'CSV Files (*.csv)')
+        if not source: return
+        modes = ['Average of photos', 'Keep each photo as a template']
+        mode, ok = QInputDialog.getItem(self, 'Bulk Import', 'Multiple photos:', modes, 0, False)
+        if not ok: return
+        self.bulk_btn.setEnabled(False)
+        self._bulk_folder = self.batch_folder
+        self._bulk_job = BulkEnrolJob(source, templates='set' if mode == modes[1] else 'mean',
+                                      detector=self.detector_spec, server=self.server)
+        self._bulk_job.progress.connect(
+            lambda n, total: self.statusBar().showMessage(f'Encoding photos: {n}/{total}'))
+        self._bulk_job.finished.connect(self._bulk_import_done)
+        self._bulk_job.start()
+
+    def _bulk_import_done(self, result, error):
+        self.bulk_btn.setEnabled(True)
+        self._bulk_job = None
+        self.statusBar().clearMessage()
+        if error:
+            QMessageBox.warning(self, 'Bulk Import', f'Bulk import failed: {error}'); return
+        items, failures, crops = result
+        store = GalleryStore(self._bulk_folder)
+        items, more = commit_enrolment(store, items, crops)
+        failures += more
+        if self._bulk_folder == self.batch_folder and items:
+            # reloaded in the background like a batch switch; _gallery_loaded
+            # keeps the running session's statuses
+            self.store = store
+            self.loading_batch = self._keep_attendance = True
+            self.gallery_cache.request(self._bulk_folder)
+        self._index_edited()
+        if self.ann_index:
+            batch = os.path.basename(self._bulk_folder)
+            self.ann_index.add_many((batch, uid, name, face_templates({'encoding': enc}).mean(axis=0))
+                                    for uid, name, enc in items)
+        msg = f'Enrolled {len(items)} students.'
+        if failures:
+            msg += f'\n{len(failures)} problems:\n' + '\n'.join(
+                f'{uid} {os.path.basename(path)}: {err}' for uid, path, err in failures[:20])
+            if len(failures) > 20:
+                msg += f'\n... and {len(failures) - 20} more'
+        QMessageBox.information(self, 'Bulk Import', msg)
 
     def _refresh_user_list(self):
         self.user_list.clear()
@@ -486,19 +4766,26 @@ class FaceRecognitionApp(QMainWindow):
             self.user_list.addItem(item)
 
     def register_user(self):
-        cap = cv2.VideoCapture(0)
-        cascade = cv2.CascadeClassifier(CASCADE_PATH)
-        ret, frame = cap.read()
-        cap.release()
+        if not self._batch_ready(): return
+        source = open_source(self.source_specs[0], None, self.source_size)
+        with source:
+            ret, frame = source.read()
         if not ret:
-            QMessageBox.warning(self, 'Error', 'Camera error'); return
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = cascade.detectMultiScale(gray, 1.1, 5)
-        if not len(faces):
-            QMessageBox.warning(self, 'Error', 'No face detected'); return
-        x, y, w, h = faces[0]
-        rgb = frame[:, :, ::-1]
-        encs = face_recognition.face_encodings(rgb, [(y, x+w, y+h, x)])
+            QMessageBox.warning(self, 'Error', source.end_message); return
+        rgb = np.ascontiguousarray(frame[:, :, ::-1])
+        try:
+            faces = self.face_detector.detect(rgb)
+            if not len(faces):
+                QMessageBox.warning(self, 'Error', 'No face detected'); return
+            # the person enrolling is the one closest to the camera
+            top, right, bottom, left = max(faces, key=lambda b: (b[2] - b[0]) * (b[1] - b[3]))
+            x, y, w, h = left, top, right - left, bottom - top
+            if self.server is not None:
+                encs = [enc for _, enc in self.server.encode(frame, [(top, right, bottom, left)])]
+            else:
+                encs = face_recognition.face_encodings(rgb, [(top, right, bottom, left)])
+        except ServerError as e:
+            QMessageBox.warning(self, 'Error', str(e)); return
         if not encs:
             QMessageBox.warning(self, 'Error', 'Encoding failed'); return
         enc = encs[0]
@@ -509,15 +4796,43 @@ class FaceRecognitionApp(QMainWindow):
             uid = int(uid_str)
         except:
             QMessageBox.warning(self, 'Error', 'ID must be numeric'); return
-        user_dir = os.path.join(self.batch_folder, 'users', str(uid))
-        if os.path.exists(user_dir):
+        if uid in self.store:
             QMessageBox.warning(self, 'Error', 'User exists'); return
-        os.makedirs(user_dir)
-        with open(os.path.join(user_dir, 'info.txt'), 'w') as f:
-            f.write(name)
-        save_face_encoding(user_dir, enc)
-        self.known_faces = load_known_faces(self.batch_folder)
+        # ids are per batch: the same id elsewhere may be this student or another
+        elsewhere = find_student(self.admin_folder, uid)
+        reuse = False
+        if elsewhere:
+            other = self.store.identities.name_of(elsewhere[0][1])
+            ans = QMessageBox.question(
+                self, 'ID used in another batch',
+                f'ID {uid} is {other} in {len(elsewhere)} other batch(es).\n'
+                f'Yes: this is {other}, add them here with their existing face data.\n'
+                'No: this is a different student, enrol them in this batch only.',
+                QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+            if ans == QMessageBox.Cancel: return
+            reuse = ans == QMessageBox.Yes
+        if reuse:
+            self.store.link(uid, elsewhere[0][1])
+            record = self.store.record(uid)
+        else:
+            self.store.add(uid, name, enc)
+            record = {'name': name, 'encoding': enc}
+        name = record['name']
+        # keep the face crop so synthetic sources can replay enrolled faces
+        os.makedirs(os.path.join(self.batch_folder, 'crops'), exist_ok=True)
+        cv2.imwrite(os.path.join(self.batch_folder, 'crops', f'{uid}.jpg'), frame[y:y+h, x:x+w])
+        self.known_faces[uid] = {'name': name}
+        self.matcher.add(uid, record.get('templates', record['encoding']), name)
+        self.gallery_cache.put(self.batch_folder, self.matcher)
+        self._index_edited()
+        if self.ann_index:
+            self.ann_index.add(os.path.basename(self.batch_folder), uid, name, record['encoding'])
+        for pipeline in self.pipelines:
+            pipeline.recognizer.gallery_changed()
         self.attendance[uid] = 'Absent'
+        self.att_model.add_user(uid)
+        if self.recorder:
+            self.recorder.add(uid, name)
         self._refresh_user_list()
 
     def delete_user(self):
@@ -525,9 +4840,22 @@ class FaceRecognitionApp(QMainWindow):
         if not item: return
         uid = int(item.text().split(',')[0].split(':')[1].strip())
         if QMessageBox.question(self, 'Confirm', f'Delete user {uid}?') == QMessageBox.Yes:
-            path = os.path.join(self.batch_folder, 'users', str(uid))
-            shutil.rmtree(path, ignore_errors=True)
+            self.store.remove(uid)
+            try:
+                os.remove(os.path.join(self.batch_folder, 'crops', f'{uid}.jpg'))
+            except OSError:
+                pass
             self.known_faces.pop(uid, None)
+            self.matcher.remove(uid)
+            self.gallery_cache.put(self.batch_folder, self.matcher)
+            self._index_edited()
+            if self.ann_index:
+                self.ann_index.remove(os.path.basename(self.batch_folder), uid)
+            # tracks carry the index key when recognising all batches
+            key = (os.path.basename(self.batch_folder), uid) if self.gate_matcher else uid
+            for pipeline in self.pipelines:
+                pipeline.recognizer.gallery_changed(key)
+            self.att_model.remove_user(uid)
             self.attendance.pop(uid, None)
             self._refresh_user_list()
 
@@ -548,28 +4876,14 @@ class FaceRecognitionApp(QMainWindow):
 
     def _refresh_timeslot_list(self):
         self.slot_list.clear()
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, start_time || ' - ' || end_time FROM time_slots "
-            "WHERE admin_id=? AND batch_id=?",
-            (self.admin_info[0], self.selected_batch[0])
-        )
-        for sid, label in cur.fetchall():
+        for sid, label in self.db.time_slots(self.admin_info[0], self.selected_batch[0]):
             self.slot_list.addItem(f"{sid}: {label}")
-        conn.close()
 
     def add_timeslot(self):
         start, ok1 = QInputDialog.getText(self, 'Start Time', 'Enter HH:MM')
         end, ok2 = QInputDialog.getText(self, 'End Time', 'Enter HH:MM')
         if not(ok1 and ok2): return
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO time_slots(admin_id,batch_id,start_time,end_time) VALUES(?,?,?,?)",
-            (self.admin_info[0], self.selected_batch[0], start, end)
-        )
-        conn.commit(); conn.close()
+        self.db.add_time_slot(self.admin_info[0], self.selected_batch[0], start, end)
         self._refresh_timeslot_list()
 
     def delete_timeslot(self):
@@ -577,21 +4891,643 @@ class FaceRecognitionApp(QMainWindow):
         if not item: return
         sid = int(item.text().split(':')[0])
         if QMessageBox.question(self, 'Confirm', f'Delete time slot {sid}?') == QMessageBox.Yes:
-            conn = sqlite3.connect(DB_NAME)
-            cur = conn.cursor()
-            cur.execute("DELETE FROM time_slots WHERE id=?", (sid,))
-            conn.commit(); conn.close()
+            self.db.delete_time_slot(sid)
             self._refresh_timeslot_list()
 
     def logout(self):
         self.stop_attendance()
         self.stack.setCurrentWidget(self.login_widget)
 
-if __name__ == '__main__':
+    def closeEvent(self, event):
+        self.stop_attendance()
+        self.encoder.close()
+        if self.metrics_writer:
+            self.metrics_writer.stop()
+        super().closeEvent(event)
+
+# ---------- Benchmarks ----------
+def time_call(fn, repeat=5, number=1):
+    fn()  # warm-up
+    runs = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - t) / number * 1000)
+    return {'median_ms': statistics.median(runs), 'min_ms': min(runs), 'repeat': repeat}
+
+def synthetic_gallery(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return {uid: {'name': f'Student {uid}', 'encoding': rng.normal(0, 0.1, 128)}
+            for uid in range(1, n + 1)}
+
+def bench_gallery_load(results, work, sizes):
+    for n in sizes:
+        folder = os.path.join(work, f'batch_{n}_bench')
+        os.makedirs(folder)
+        faces = synthetic_gallery(n)
+        GalleryStore(folder).add_many((uid, d['name'], d['encoding']) for uid, d in faces.items())
+        results[f'load_known_faces/{n}'] = time_call(lambda: load_known_faces(folder))
+        results[f'matcher_rebuild/{n}'] = time_call(lambda: GalleryMatcher(faces))
+
+def bench_matching(results, sizes, faces_per_frame):
+    rng = np.random.RandomState(1)
+    for n in sizes:
+        matcher = GalleryMatcher(synthetic_gallery(n))
+        for f in faces_per_frame:
+            q = matcher.encodings[rng.randint(n, size=f)] + rng.normal(0, 0.02, (f, 128))
+            results[f'match/{n}x{f}'] = time_call(lambda: matcher.match(q), number=10)
+        # compact representations at a crowded frame's worth of faces
+        q = matcher.encodings[rng.randint(n, size=30)] + rng.normal(0, 0.02, (30, 128))
+        for dtype in GALLERY_DTYPES[1:]:
+            compact = GalleryMatcher.from_arrays(matcher.encodings, matcher.ids, dtype=dtype)
+            results[f'match/{n}x30/{dtype}'] = time_call(lambda: compact.match(q), number=10)
+
+def bench_detection(results, resolutions, crops):
+    recognizer = FaceRecognizer(GalleryMatcher(synthetic_gallery(100)))
+    for w, h in resolutions:
+        src = SyntheticSource(crops, size=(w, h), faces=4, seed=2).open()
+        _, frame = src.read()
+        boxes = src.boxes
+        results[f'detect/{w}x{h}'] = time_call(lambda: recognizer.detect(frame), repeat=3)
+        if max(w, h) > 640:
+            scaled = RegionDetector(max_side=640)
+            results[f'detect/{w}x{h}/at640'] = time_call(lambda: scaled(frame), repeat=3)
+        # encode the pasted crops directly so the number does not depend on
+        # whether HOG happens to find the synthetic faces
+        results[f'encode/{w}x{h}/{len(boxes)}faces'] = time_call(
+            lambda: recognizer.identify(frame, boxes), repeat=3)
+    # crowded classroom frame, serial vs split across the encoder pool
+    src = SyntheticSource(crops, size=(1920, 1080), faces=30, seed=3).open()
+    _, frame = src.read()
+    boxes = src.boxes
+    results[f'encode/crowd/{len(boxes)}faces'] = time_call(
+        lambda: recognizer.identify(frame, boxes), repeat=3)
+    encoder = ParallelEncoder()
+    try:
+        parallel = FaceRecognizer(recognizer.matcher, encoder=encoder)
+        results[f'encode/crowd/{len(boxes)}faces/{encoder.workers}procs'] = time_call(
+            lambda: parallel.identify(frame, boxes), repeat=3)
+    finally:
+        encoder.close()
+
+def bench_attendance_table(results, work, sizes):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication.instance() or QApplication([])
+    cwd = os.getcwd()
+    os.chdir(work)  # the window opens its database in the working directory
+    try:
+        win = FaceRecognitionApp(source='synthetic:')
+        # shown (offscreen) so the numbers include layout and painting
+        win.stack.setCurrentWidget(win.dashboard_widget)
+        win.show()
+        for n in sizes:
+            win.known_faces = synthetic_gallery(n)
+            win.attendance = {uid: 'Absent' for uid in win.known_faces}
+
+            def refresh():
+                win._refresh_attendance_table()
+                app.processEvents()
+            results[f'refresh_attendance_table/{n}'] = time_call(refresh)
+            uids = list(win.attendance)
+
+            def frame_update(state=[0]):
+                # one recognition result's worth of status changes
+                state[0] += 1
+                status = STATUSES[state[0] % 2]
+                for uid in uids[:10]:
+                    win.att_model.set_status(uid, status)
+                app.processEvents()
+            results[f'attendance_update/{n}'] = time_call(frame_update, number=10)
+        win.close()
+        win.db.close()
+        win.deleteLater()
+    finally:
+        os.chdir(cwd)
+
+def bench_sqlite(results, work):
+    db = Database(os.path.join(work, 'bench.db'))
+    admin = db.add_admin('Bench', 'bench', 'bench')
+    with db.lock, db.conn:
+        db.conn.executemany("INSERT INTO batch(admin_id,batch_name) VALUES(?,?)",
+                            ((admin, f'batch {i}') for i in range(200)))
+        db.conn.executemany(
+            "INSERT INTO time_slots(admin_id,batch_id,start_time,end_time) VALUES(?,?,?,?)",
+            ((admin, 1 + i % 200, f'{8 + i % 10:02d}:00', f'{9 + i % 10:02d}:00') for i in range(4000)))
+    results['sqlite/find_admin'] = time_call(lambda: db.find_admin('bench', 'bench'), number=100)
+    results['sqlite/batches'] = time_call(lambda: db.batches(admin), number=100)
+    results['sqlite/time_slots'] = time_call(lambda: db.time_slots(admin, 17), number=100)
+    roster = [(uid, f'Student {uid}') for uid in range(300)]
+    session = db.start_session(admin, 1, 1, '08:00 - 09:00', roster)
+    events = [(session, uid, name, 'Present', '2025-01-01T08:00:00', 0.4, 0, None) for uid, name in roster]
+    results['sqlite/record_events/300'] = time_call(lambda: db.record_events(events))
+    db.close()
+
+def run_benchmarks(quick=False, crops=None, log=print):
+    sizes = [100, 1000] if quick else [100, 1000, 10000]
+    stages = [
+        ('gallery load', lambda r, w: bench_gallery_load(r, w, sizes)),
+        ('matching', lambda r, w: bench_matching(r, sizes, [1, 10, 30, 60])),
+        ('detection/encoding', lambda r, w: bench_detection(
+            r, [(640, 480)] if quick else [(320, 240), (640, 480), (1280, 720), (1920, 1080)], crops)),
+        ('attendance table', lambda r, w: bench_attendance_table(r, w, [300] if quick else [300, 1000])),
+        ('sqlite', bench_sqlite),
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='edumark-bench-') as work:
+        for name, stage in stages:
+            log(f'Running {name} benchmarks...')
+            stage(results, work)
+    return {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+def compare_benchmarks(current, baseline, threshold=0.2, floor_ms=0.05):
+    # Returns (rows, regressions). Runs are compared on their best time,
+    # which is far less noisy than the median; a regression is more than
+    # `threshold` (0.2 = 20%) slower and more than `floor_ms` in absolute terms.
+    rows, regressions = [], []
+    for key, cur in current['results'].items():
+        base = baseline.get('results', {}).get(key)
+        if base is None:
+            rows.append((key, None, cur['min_ms'], None)); continue
+        ratio = cur['min_ms'] / max(base['min_ms'], 1e-9)
+        rows.append((key, base['min_ms'], cur['min_ms'], ratio))
+        if ratio > 1 + threshold and cur['min_ms'] - base['min_ms'] > floor_ms:
+            regressions.append(key)
+    return rows, regressions
+
+# ---------- Command line ----------
+def cmd_ann_check(args):
+    admin_folder = get_admin_folder(args.admin)
+    try:
+        index = load_admin_index(admin_folder, args.lists, args.probe, exact_below=0,
+                                 retrain=args.retrain, dtype=args.gallery_dtype)
+    except ValueError as e:
+        print(e); return 1
+    if not len(index):
+        print('No enrolled students'); return 1
+    # queries are enrolled encodings plus noise of roughly same-person size
+    rng = np.random.RandomState(args.seed)
+    rows = index._live_rows()
+    picked = rows[rng.randint(len(rows), size=args.queries)]
+    queries = index.vectors(picked) + rng.normal(0, args.noise, (len(picked), 128))
+    print(json.dumps(ann_recall_check(index, queries), indent=2))
+    return 0
+
+def cmd_quant_check(args):
+    rng = np.random.RandomState(args.seed)
+    if args.admin:
+        if Database().admin_id(args.admin) is None:
+            print(f'Unknown admin {args.admin}'); return 1
+        admin_folder = get_admin_folder(args.admin)
+        try:
+            require_migrated(admin_folder)
+        except ValueError as e:
+            print(e); return 1
+        # each stored record once, however many batches share it
+        encodings = IdentityStore(admin_folder).gather(sorted(batch_references(admin_folder)))[0]
+    else:
+        encodings = np.stack([d['encoding'] for d in synthetic_gallery(args.synthetic, args.seed).values()])
+    if not len(encodings):
+        print('No enrolled students'); return 1
+    # same-person-sized perturbations spread across the tolerance, so there
+    # are plenty of queries on both sides of it
+    picked = rng.randint(len(encodings), size=args.queries)
+    radius = rng.uniform(0.5, 1.5, args.queries) * args.tolerance
+    noise = rng.normal(0, 1, (args.queries, 128))
+    noise *= (radius / np.linalg.norm(noise, axis=1))[:, None]
+    report = quantization_drift(encodings, np.arange(len(encodings)), encodings[picked] + noise,
+                                tolerance=args.tolerance)
+    print(f"{report['gallery']} encodings, {report['queries']} queries, "
+          f"{report['near_threshold_pairs']} pairs within 0.05 of tolerance {args.tolerance}")
+    print(f"{'dtype':8} {'MB':>8} {'max drift':>10} {'mean drift':>11} {'near tol':>9} "
+          f"{'flips':>6} {'ms/query':>9}")
+    print(f"{'float64':8} {report['float64_bytes'] / 2**20:8.2f}")
+    for dtype, r in report['dtypes'].items():
+        print(f"{dtype:8} {r['bytes'] / 2**20:8.2f} {r['max_abs_drift']:10.2e} {r['mean_abs_drift']:11.2e} "
+              f"{r['max_drift_near_threshold']:9.2e} {r['decision_flips']:6d} {r['ms_per_query']:9.3f}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+def cmd_report(args):
+    db = Database()
+    admin_id = db.admin_id(args.admin)
+    if admin_id is None:
+        print(f'Unknown admin {args.admin}'); return 1
+    batch_ids = None
+    if args.batch:
+        batch_ids = [bid for bid, name in db.batches(admin_id) if name in args.batch]
+    n = export_attendance_report(db, args.out, admin_id, args.date_from, args.date_to,
+                                 batch_ids, args.summary)
+    print(f'Wrote {n} rows to {args.out}')
+    return 0
+
+def parse_roi(text):
+    # 'x,y,w,h[,upsample]' as fractions of the frame
+    vals = [float(v) for v in text.split(',')]
+    if len(vals) not in (4, 5) or not all(0 <= v <= 1 for v in vals[:4]):
+        raise argparse.ArgumentTypeError('expected x,y,w,h fractions of the frame [,upsample]')
+    return tuple(vals[:4]) + (int(vals[4]) if len(vals) == 5 else 1,)
+
+def cmd_roi(args):
+    db = Database()
+    admin_id, batch_id = db.admin_id(args.admin), None
+    if admin_id is None:
+        print(f'Unknown admin {args.admin}'); return 1
+    if args.batch:
+        batch_id = db.batch_id(admin_id, args.batch)
+        if batch_id is None:
+            print(f'Unknown batch {args.batch}'); return 1
+    if args.clear or args.add:
+        current = [] if args.clear else db.rois(admin_id, batch_id, args.source, inherited=False)
+        db.set_rois(admin_id, batch_id, args.source, list(current) + (args.add or []))
+    # with no batch, batch_id=NULL matches nothing and only the any-batch areas remain
+    rows = db.rois(admin_id, batch_id, args.source)
+    for x, y, w, h, up in rows:
+        print(f'{x:.3f},{y:.3f},{w:.3f},{h:.3f} upsample {up}')
+    if not rows:
+        print('No detection areas, the whole frame is used')
+    return 0
+
+def cmd_detect_compare(args):
+    samples = load_detection_labels(args.labels)
+    if not samples:
+        print(f'No labelled images in {args.labels}'); return 1
+    try:
+        rows = compare_detectors(args.backend or ['hog', 'haar'], samples, args.upsample,
+                                 args.detect_size, args.iou, args.small, args.batch_size)
+    except ValueError as e:
+        print(e); return 1
+    pct = lambda v: '-' if v is None else f'{v * 100:.1f}%'
+    print(f"{'detector':30} {'ms/img':>8} {'p95 ms':>8} {'recall':>8} {'small':>8} {'precision':>9}")
+    for r in rows:
+        print(f"{r['detector'][:30]:30} {r['mean_ms']:8.1f} {r['p95_ms']:8.1f} {pct(r['recall']):>8} "
+              f"{pct(r['recall_small']):>8} {pct(r['precision']):>9}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+def cmd_offline(args):
+    db = Database()
+    admin_id = db.admin_id(args.admin)
+    if admin_id is None:
+        print(f'Unknown admin {args.admin}'); return 1
+    bid, bname = db.batch_id(admin_id, args.batch), args.batch
+    if bid is None:
+        print(f'Unknown batch {args.batch}'); return 1
+    slots = dict(db.time_slots(admin_id, bid))
+    if args.slot not in slots:
+        print(f'Unknown time slot {args.slot} for batch {bname}'); return 1
+    batch_folder = get_batch_folder(get_admin_folder(args.admin), bid, bname)
+    known = load_known_faces(batch_folder)
+    checkpoint = args.checkpoint or f'offline_{bid}_{args.slot}.ckpt.json'
+    try:
+        found = run_offline_attendance(batch_folder, args.inputs, args.stride, args.workers,
+                                       checkpoint, args.resume, args.tolerance, detector=args.detector,
+                                       dtype=args.gallery_dtype)
+    except (ValueError, OSError, ImportError) as e:
+        print(f'Offline attendance failed: {e}'); return 1
+    roster = [(uid, d['name']) for uid, d in known.items()]
+    session = db.start_session(admin_id, bid, args.slot, slots[args.slot], roster)
+    # the recordings carry no wall-clock time, so first_seen is when they were processed
+    seen = datetime.now().isoformat(timespec='seconds')
+    db.record_events([
+        (session, uid, known[uid]['name'], 'Present', seen, dist, 0, label)
+        for uid, (src, pos, label, dist) in found.items() if uid in known
+    ])
+    db.end_session(session)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Date', 'Time Slot', 'User ID', 'Name', 'Status', 'First Seen', 'Best Distance',
+                             'Source'])
+            today = datetime.now().strftime('%Y-%m-%d')
+            for uid, d in known.items():
+                hit = found.get(uid)
+                writer.writerow([today, slots[args.slot], uid, d['name'],
+                                 'Present' if hit else 'Absent',
+                                 seen if hit else '', f'{hit[3]:.4f}' if hit else '',
+                                 hit[2] if hit else ''])
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print(f'{len(found)}/{len(known)} students present, session {session}')
+    return 0
+
+def cmd_bench(args):
+    report = run_benchmarks(args.quick, args.crops)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {args.out}')
+    if not args.baseline:
+        for key, r in report['results'].items():
+            print(f"{key:45s} {r['median_ms']:10.3f} ms")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows, regressions = compare_benchmarks(report, baseline, args.threshold)
+    for key, base, cur, ratio in rows:
+        flag = '  REGRESSION' if key in regressions else ''
+        if ratio is None:
+            print(f'{key:45s} {"-":>10s} {cur:10.3f} ms      new')
+        else:
+            print(f'{key:45s} {base:10.3f} {cur:10.3f} ms {ratio:6.2f}x{flag}')
+    return 1 if regressions else 0
+
+def cmd_enroll(args):
+    db = Database()
+    admin_id = db.admin_id(args.admin)
+    if admin_id is None:
+        print(f'Unknown admin {args.admin}'); return 1
+    batch_id = db.batch_id(admin_id, args.batch)
+    if batch_id is None:
+        print(f'Unknown batch {args.batch}'); return 1
+    store = GalleryStore(get_batch_folder(get_admin_folder(args.admin), batch_id, args.batch))
+    if is_legacy_batch(store.folder):
+        print(f'Batch {args.batch} still has its own gallery; log in once or run migrate-identities first')
+        return 1
+    students, failures = collect_enrolment(args.source)
+    print(f'{len(students)} students, {sum(len(s["images"]) for s in students.values())} photos')
+    t0 = time.perf_counter()
+    try:
+        items, more, crops = encode_enrolment(students, args.workers or None, args.templates,
+                                              args.max_templates, detector=args.detector)
+    except (ValueError, OSError, ImportError) as e:
+        print(f'Enrolment failed: {e}'); return 1
+    items, dupes = commit_enrolment(store, items, crops, args.replace)
+    failures += more + dupes
+    print(f'Enrolled {len(items)} students in {time.perf_counter() - t0:.1f}s, {len(failures)} problems')
+    for uid, path, err in failures:
+        print(f'  {uid} {path}: {err}')
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'image', 'problem'])
+            writer.writerows(failures)
+    return 0
+
+def cmd_migrate_identities(args):
+    db = Database()
+    admins = [args.admin] if args.admin else [r[0] for r in db.query("SELECT username FROM admin")]
+    for uname in admins:
+        r = migrate_identities(get_admin_folder(uname))
+        print(f"{uname}: {r['migrated']}/{r['batches']} batches migrated, {r['memberships']} "
+              f"student-batch entries share {r['identities']} stored records; "
+              f"{r['bytes_before'] / 1024:.0f} KiB of old galleries removed, "
+              f"{r['bytes_after'] / 1024:.0f} KiB now")
+    return 0
+
+def cmd_serve(args):
+    server = RecognitionServer(args.host, args.port, args.detector, args.detect_size, args.workers or None,
+                               args.max_batch, args.max_wait_ms, args.max_queue, args.max_delay,
+                               args.gallery_cache_mb, args.gallery_dtype, args.tolerance)
+    try:
+        server.start()
+    except (ValueError, OSError) as e:
+        server.close()
+        print(f'Could not start the recognition server: {e}'); return 1
+    print(f'Recognition server on {server.url}, {server.workers} workers, '
+          f'batches of up to {server.max_batch} (Ctrl+C stops)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+def cmd_loadgen(args):
+    client = RecognitionClient(args.server)
+    if args.mode == 'recognize':
+        if not (args.admin and args.batch):
+            print('recognize needs --admin and --batch'); return 1
+        db = Database()
+        admin_id = db.admin_id(args.admin)
+        if admin_id is None:
+            print(f'Unknown admin {args.admin}'); return 1
+        batch_id = db.batch_id(admin_id, args.batch)
+        if batch_id is None:
+            print(f'Unknown batch {args.batch}'); return 1
+        send = lambda jpeg: client.recognize(jpeg, args.admin, batch_id)
+    else:
+        send = getattr(client, args.mode)
+    frames = []
+    with open_source(args.source, None, parse_size(args.size)) as source:
+        while len(frames) < args.frames:
+            ret, frame = source.read()
+            if not ret:
+                break
+            frames.append(client.jpeg(frame))
+    if not frames:
+        print(f'No frames from {args.source}'); return 1
+    try:
+        before = client.health()
+    except ServerError as e:
+        print(e); return 1
+    report = run_load(send, frames, args.clients, args.duration, args.rate)
+    after = client.health()
+    batches = after['batches'] - before['batches']
+    report['server_mean_batch'] = (after['frames'] - before['frames']) / max(batches, 1)
+    for key in ('rejected', 'expired', 'errors'):
+        report[f'server_{key}'] = after[key] - before[key]
+    print(f"{report['clients']} clients, {report['seconds']:.1f}s: {report['ok']} ok, "
+          f"{report['busy']} busy, {report['errors']} errors")
+    if report['last_error']:
+        print(f"last error: {report['last_error']}")
+    print(f"throughput {report['throughput']:.1f} frames/s, latency p50 {report['p50_ms']:.1f} "
+          f"p95 {report['p95_ms']:.1f} p99 {report['p99_ms']:.1f} max {report['max_ms']:.1f} ms")
+    print(f"server: mean batch {report['server_mean_batch']:.2f}, rejected {report['server_rejected']}, "
+          f"expired {report['server_expired']}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Edumark: Face Recognition Attendance')
+    parser.add_argument('--source', action='append',
+                        help="frame source: camera:N, video:FILE, images:DIR or synthetic:CROPDIR; "
+                             "repeat for a multi-camera session (default $EDUMARK_SOURCE or camera:0, "
+                             "';'-separated there)")
+    parser.add_argument('--fps', type=float, help='pace the source to this frame rate')
+    parser.add_argument('--size', help='resize frames to WxH, e.g. 640x480')
+    parser.add_argument('--metrics', action='store_true', help='collect per-stage latency metrics')
+    parser.add_argument('--overlay', action='store_true', help='show FPS/latency on the video')
+    parser.add_argument('--metrics-file', help='write metrics snapshots here (.json or .prom)')
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help='seconds between snapshots')
+    parser.add_argument('--encode-workers', type=int, default=0,
+                        help='processes for per-face encoding (default: cores - 1, 1 disables)')
+    parser.add_argument('--gate', action='store_true',
+                        help='skip static frames and small/blurry faces before recognition')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='with --gate, slow recognition down while the scene is still')
+    parser.add_argument('--motion-threshold', type=float, default=0.002,
+                        help='fraction of changed pixels that counts as motion')
+    parser.add_argument('--min-face', type=int, default=40, help='smallest face to encode, in pixels')
+    parser.add_argument('--min-sharpness', type=float, default=30.0,
+                        help='Laplacian variance below which a face is too blurry to encode')
+    parser.add_argument('--max-interval', type=float, default=1.0,
+                        help='longest adaptive wait between recognitions, in seconds')
+    parser.add_argument('--gallery-cache-mb', type=float, default=256,
+                        help='memory budget for cached batch galleries')
+    parser.add_argument('--gallery-dtype', choices=GALLERY_DTYPES, default='float64',
+                        help='precision the matcher keeps encodings in (see quant-check)')
+    parser.add_argument('--detector', default=os.environ.get('EDUMARK_DETECTOR', 'hog'),
+                        help="face detector: hog, haar[:cascade.xml], yunet:model.onnx "
+                             "or ssd:model.caffemodel[,deploy.prototxt]")
+    parser.add_argument('--detect-size', type=int,
+                        help='run detection on frames downscaled to this longest side, e.g. 640')
+    parser.add_argument('--refine', action='store_true',
+                        help='with --detect-size, re-detect each face on the full-resolution crop')
+    parser.add_argument('--startup-timing', action='store_true',
+                        help='print how long each start-up phase takes, then exit')
+    parser.add_argument('--server', default=os.environ.get('EDUMARK_SERVER'),
+                        help='thin client: recognise on this server (see serve), e.g. 127.0.0.1:8765')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('ann-check', help='compare ANN search against brute force')
+    p.add_argument('--admin', required=True, help='admin username')
+    p.add_argument('--lists', type=int, default=0, help='IVF cells (default sqrt(N))')
+    p.add_argument('--probe', type=int, default=8, help='cells scanned per query')
+    p.add_argument('--queries', type=int, default=1000)
+    p.add_argument('--noise', type=float, default=0.03, help='per-dimension query noise')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--retrain', action='store_true')
+    p.set_defaults(func=cmd_ann_check)
+    p = sub.add_parser('quant-check', help='measure distance drift of the compact gallery dtypes')
+    p.add_argument('--admin', help="use this admin's enrolled galleries")
+    p.add_argument('--synthetic', type=int, default=10000, help='synthetic gallery size without --admin')
+    p.add_argument('--queries', type=int, default=2000)
+    p.add_argument('--tolerance', type=float, default=0.5)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', help='also write the report to this JSON file')
+    p.set_defaults(func=cmd_quant_check)
+    p = sub.add_parser('report', help='export attendance history to CSV or Parquet')
+    p.add_argument('--admin', required=True, help='admin username')
+    p.add_argument('--from', dest='date_from', help='first session date, YYYY-MM-DD')
+    p.add_argument('--to', dest='date_to', help='last session date, YYYY-MM-DD')
+    p.add_argument('--batch', action='append', help='batch name (repeatable, default all)')
+    p.add_argument('--summary', action='store_true', help='per-student percentages')
+    p.add_argument('--out', required=True, help='.csv or .parquet file')
+    p.set_defaults(func=cmd_report)
+    p = sub.add_parser('offline', help='take attendance from recorded videos or photo folders')
+    p.add_argument('--admin', required=True, help='admin username')
+    p.add_argument('--batch', required=True, help='batch name')
+    p.add_argument('--slot', required=True, type=int, help='time slot id')
+    p.add_argument('inputs', nargs='+', help='video files or image directories')
+    p.add_argument('--stride', type=int, default=5, help='process every Nth frame')
+    p.add_argument('--workers', type=int, default=0, help='worker processes (default: all cores)')
+    p.add_argument('--tolerance', type=float, default=0.5)
+    p.add_argument('--csv', help='also write the result to this CSV file')
+    p.add_argument('--checkpoint', help='progress file (default offline_<batch>_<slot>.ckpt.json)')
+    p.add_argument('--resume', action='store_true', help='continue an interrupted run')
+    p.set_defaults(func=cmd_offline)
+    p = sub.add_parser('enroll', help='bulk-enrol students from a photo folder or CSV manifest')
+    p.add_argument('--admin', required=True, help='admin username')
+    p.add_argument('--batch', required=True, help='batch name')
+    p.add_argument('source', help='folder of <id>_<name> photos/sub-folders, or CSV with id,name,image')
+    p.add_argument('--workers', type=int, default=0, help='worker processes (default: all cores)')
+    p.add_argument('--templates', choices=['mean', 'set'], default='mean',
+                   help='average several photos, or keep them as a template set')
+    p.add_argument('--max-templates', type=int, default=5)
+    p.add_argument('--replace', action='store_true', help='re-enrol students already in the batch')
+    p.add_argument('--report', help='write the problems to this CSV file')
+    p.set_defaults(func=cmd_enroll)
+    p = sub.add_parser('roi', help='list or set the detection areas of a camera/batch')
+    p.add_argument('--admin', required=True, help='admin username')
+    p.add_argument('--batch', help='batch name (default: areas for all batches)')
+    p.add_argument('--source', default='', help="source spec, e.g. camera:1 (default: any source)")
+    p.add_argument('--add', type=parse_roi, action='append',
+                   help='x,y,w,h fractions of the frame [,upsample], repeatable')
+    p.add_argument('--clear', action='store_true', help='remove the existing areas first')
+    p.set_defaults(func=cmd_roi)
+    p = sub.add_parser('detect-compare', help='compare detector latency and recall on labelled images')
+    p.add_argument('labels', help='labels.csv (image,x,y,w,h per face) or the folder holding it')
+    p.add_argument('--backend', action='append',
+                   help='detector spec as for --detector, repeatable (default: hog and haar)')
+    p.add_argument('--upsample', type=int, default=1)
+    p.add_argument('--iou', type=float, default=0.5, help='overlap that counts as a hit')
+    p.add_argument('--small', type=int, default=40, help='faces shorter than this count as small')
+    p.add_argument('--batch-size', type=int, default=8, help='images per call for batched backends')
+    p.add_argument('--out', help='also write the results to this JSON file')
+    p.set_defaults(func=cmd_detect_compare)
+    p = sub.add_parser('migrate-identities',
+                       help='move per-batch galleries into the shared per-admin identity store')
+    p.add_argument('--admin', help='admin username (default: all admins)')
+    p.set_defaults(func=cmd_migrate_identities)
+    p = sub.add_parser('serve', help='run the headless recognition server for thin clients')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--workers', type=int, default=0, help='worker processes (default: cores - 1)')
+    p.add_argument('--max-batch', type=int, default=0, help='frames per batch (default: 2 x workers)')
+    p.add_argument('--max-wait-ms', type=float, default=5.0,
+                   help='how long a batch waits to fill once it has a frame')
+    p.add_argument('--max-queue', type=int, default=64, help='queued frames before answering busy')
+    p.add_argument('--max-delay', type=float, default=1.0,
+                   help='seconds a frame may wait before it is answered busy instead')
+    p.add_argument('--tolerance', type=float, default=0.5)
+    p.set_defaults(func=cmd_serve)
+    p = sub.add_parser('loadgen', help='measure recognition server throughput and tail latency')
+    p.add_argument('server', nargs='?', default='127.0.0.1:8765')
+    p.add_argument('--mode', choices=['recognize', 'encode', 'detect'], default='recognize')
+    p.add_argument('--admin', help='admin username (recognize)')
+    p.add_argument('--batch', help='batch name (recognize)')
+    p.add_argument('--source', default='synthetic:', help='frames to send, a source spec as for --source')
+    p.add_argument('--size', help='resize frames to WxH first')
+    p.add_argument('--frames', type=int, default=30, help='distinct frames to cycle through')
+    p.add_argument('--clients', type=int, default=4, help='concurrent clients')
+    p.add_argument('--duration', type=float, default=10.0, help='seconds')
+    p.add_argument('--rate', type=float, help='total requests/s, paced (default: closed loop)')
+    p.add_argument('--out', help='also write the results to this JSON file')
+    p.set_defaults(func=cmd_loadgen)
+    p = sub.add_parser('bench', help='benchmark the recognition hot path without camera or GUI')
+    p.add_argument('--out', default='bench_results.json', help='JSON results file')
+    p.add_argument('--baseline', help='earlier results file to compare against')
+    p.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown (0.2 = 20%%)')
+    p.add_argument('--crops', help='face crop folder for the detection/encoding frames')
+    p.add_argument('--quick', action='store_true', help='smaller sizes, for CI smoke runs')
+    p.set_defaults(func=cmd_bench)
+    args = parser.parse_args(argv)
+    try:
+        parse_detector(args.detector)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.command:
+        return args.func(args)
+    gate = None
+    if args.gate or args.adaptive:
+        gate = {'motion_threshold': args.motion_threshold, 'min_face': args.min_face,
+                'min_sharpness': args.min_sharpness, 'adaptive': args.adaptive,
+                'max_interval': args.max_interval}
+    sources = args.source or os.environ.get('EDUMARK_SOURCE', 'camera:0').split(';')
+    t = time.perf_counter()
     app = QApplication(sys.argv)
-    win = FaceRecognitionApp()
+    STARTUP.add('QApplication', t)
+    t = time.perf_counter()
+    win = FaceRecognitionApp(sources, args.fps, parse_size(args.size), args.metrics,
+                             args.overlay, args.metrics_file, args.metrics_interval,
+                             args.encode_workers or None, gate, args.detect_size, args.refine,
+                             args.detector, args.gallery_cache_mb, args.gallery_dtype, args.server)
     win.show()
-    sys.exit(app.exec_())
+    STARTUP.add('window', t)
+    if args.startup_timing:
+        t = time.perf_counter()
+        QTimer.singleShot(0, lambda: win.time_startup(t))
+    return app.exec_()
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 
 # In[ ]:
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import threading
+import multiprocessing
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import Main
+
+
+def encoding(seed):
+    return np.random.RandomState(seed).rand(128)
+
+
+def write_legacy(batch_folder, faces):
+    for uid, (name, enc) in faces.items():
+        d = os.path.join(batch_folder, 'users', str(uid))
+        os.makedirs(d)
+        with open(os.path.join(d, 'info.txt'), 'w') as f:
+            f.write(name)
+        np.save(os.path.join(d, 'encoding.npy'), enc)
+
+
+def write_packed(batch_folder, faces):
+    # faces: {uid: (name, k x 128 rows)}
+    os.makedirs(batch_folder, exist_ok=True)
+    rows, entries = [], {}
+    for uid, (name, encs) in faces.items():
+        encs = np.atleast_2d(encs)
+        entries[str(uid)] = [name, list(range(len(rows), len(rows) + len(encs)))]
+        rows.extend(encs)
+    np.save(os.path.join(batch_folder, 'gallery.1.npy'), np.array(rows))
+    with open(os.path.join(batch_folder, 'gallery.json'), 'w') as f:
+        json.dump({'file': 'gallery.1.npy', 'entries': entries}, f)
+
+
+@pytest.fixture
+def admin(tmp_path):
+    return str(tmp_path / 'admin_a')
+
+
+def test_legacy_folders_migrate_and_are_removed(admin):
+    batch = Main.get_batch_folder(admin, 1, 'B1')
+    write_legacy(batch, {7: ('Seven', encoding(7)), 8: ('Eight', encoding(8))})
+    report = Main.migrate_identities(admin)
+    assert report['migrated'] == 1 and report['memberships'] == 2
+    known = Main.GalleryStore(batch).load()
+    assert {u: d['name'] for u, d in known.items()} == {7: 'Seven', 8: 'Eight'}
+    assert np.array_equal(known[7]['encoding'], encoding(7))
+    assert not os.path.exists(os.path.join(batch, 'users'))
+
+
+def test_packed_galleries_migrate_with_shared_records_stored_once(admin):
+    templates = np.stack([encoding(1), encoding(2)])
+    faces = {1: ('One', templates), 2: ('Two', encoding(3))}
+    b1 = Main.get_batch_folder(admin, 1, 'B1')
+    b2 = Main.get_batch_folder(admin, 2, 'B2')
+    write_packed(b1, faces)
+    write_packed(b2, faces)
+    report = Main.migrate_identities(admin)
+    assert report['migrated'] == 2 and report['memberships'] == 4
+    assert report['identities'] == 2
+    for batch in (b1, b2):
+        known = Main.GalleryStore(batch).load()
+        assert np.array_equal(known[1]['templates'], templates)
+        assert np.array_equal(known[2]['encoding'], encoding(3))
+        assert not [f for f in os.listdir(batch) if f.startswith('gallery.')]
+
+
+def test_readers_leave_unmigrated_batches_alone(admin):
+    batch = Main.get_batch_folder(admin, 1, 'B1')
+    write_legacy(batch, {7: ('Seven', encoding(7))})
+    assert Main.load_known_faces(batch)[7]['name'] == 'Seven'
+    assert Main.GalleryMatcher.from_folder(batch).records[7].name == 'Seven'
+    with pytest.raises(ValueError, match='migrate-identities'):
+        Main.load_admin_index(admin)
+    assert Main.is_legacy_batch(batch)
+    assert not Main.GalleryStore(batch).exists()
+
+
+def test_failed_read_back_keeps_the_old_files(admin, monkeypatch):
+    batch = Main.get_batch_folder(admin, 1, 'B1')
+    write_packed(batch, {1: ('One', encoding(1))})
+    monkeypatch.setattr(Main.GalleryStore, 'load', lambda self: {})
+    assert Main.GalleryStore(batch).migrate() == (1, 0)
+    assert os.path.exists(os.path.join(batch, 'gallery.json'))
+    assert os.path.exists(os.path.join(batch, 'gallery.1.npy'))
+
+
+def test_ids_are_per_batch(admin):
+    b1 = Main.GalleryStore(Main.get_batch_folder(admin, 1, 'B1'))
+    b2 = Main.GalleryStore(Main.get_batch_folder(admin, 2, 'B2'))
+    b3 = Main.GalleryStore(Main.get_batch_folder(admin, 3, 'B3'))
+    b1.add(1, 'Alice', encoding(1))
+    b3.link(1, b1.key_of(1))
+    # a different student reusing id 1 leaves Alice alone
+    b2.add(1, 'Bob', encoding(2))
+    assert b1.record(1)['name'] == 'Alice' and b2.record(1)['name'] == 'Bob'
+    # re-enrolling Alice reaches the batch sharing her record, not Bob's
+    b1.add(1, 'Alice', encoding(3))
+    assert np.array_equal(b3.record(1)['encoding'], encoding(3))
+    assert np.array_equal(b2.record(1)['encoding'], encoding(2))
+    assert len(Main.IdentityStore(admin)) == 2
+
+
+def test_concurrent_adds_from_threads(admin):
+    batch = Main.get_batch_folder(admin, 1, 'B1')
+
+    def enrol(t):
+        # a store object of its own, like the app and the cache thread
+        store = Main.GalleryStore(batch)
+        for i in range(20):
+            uid = t * 100 + i
+            store.add(uid, f'S{uid}', encoding(uid))
+
+    threads = [threading.Thread(target=enrol, args=(t,)) for t in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    known = Main.GalleryStore(batch).load()
+    assert len(known) == 120
+    assert all(np.array_equal(d['encoding'], encoding(uid)) for uid, d in known.items())
+    assert len(Main.IdentityStore(admin)) == 120
+
+
+def _enrol_process(admin, batch_no, start):
+    store = Main.GalleryStore(Main.get_batch_folder(admin, batch_no, f'B{batch_no}'))
+    for uid in range(start, start + 15):
+        store.add(uid, f'S{uid}', encoding(uid))
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_concurrent_adds_from_processes(admin):
+    ctx = multiprocessing.get_context('fork')
+    # two processes per batch, all four sharing the identity store
+    jobs = [ctx.Process(target=_enrol_process, args=(admin, b, start))
+            for b, start in [(1, 0), (1, 100), (2, 200), (2, 300)]]
+    for p in jobs:
+        p.start()
+    for p in jobs:
+        p.join()
+    assert all(p.exitcode == 0 for p in jobs)
+    for b, starts in [(1, (0, 100)), (2, (200, 300))]:
+        known = Main.GalleryStore(Main.get_batch_folder(admin, b, f'B{b}')).load()
+        assert sorted(known) == [u for s in starts for u in range(s, s + 15)]
+        assert all(np.array_equal(d['encoding'], encoding(uid)) for uid, d in known.items())
+    assert len(Main.IdentityStore(admin)) == 60